@@ -20,6 +20,46 @@ class Spatial(CkanCommand):
         spatial extents
             Creates or updates the extent geometry column for datasets with
             an extent defined in the 'spatial' extra.
+
+        spatial subdivide
+            Regenerates the pieces of the stored extents checked by the
+            spatial queries, which must be done after changing
+            ckan.spatial.subdivide_max_vertices.
+
+        spatial precompute
+            Precomputes the results of the spatial queries for the hot
+            regions defined in the config (ckan.spatial.hot_regions and
+            ckan.spatial.default_map_extent).
+
+        spatial histogram [size]
+            Updates the extent histogram used to plan spatial searches,
+            with a grid of size x size cells. Default is 32.
+
+        spatial verify-wms [workers]
+            Checks the resource URLs left pending by the harvesters (when
+            ckan.spatial.harvest.wms_check is "deferred"), or whose check
+            expired, and flags the resources that are WMS endpoints as
+            verified. The URLs are checked concurrently, with 8 workers by
+            default.
+
+        spatial import-pool {job-id} [workers]
+            Imports the objects of a harvest job with a pool of worker
+            processes (4 by default), in batches of 50 objects. Concurrent
+            imports of the same document are serialized.
+
+        spatial harvest-stats {job-id}
+            Shows the time taken by each step of the stages of a harvest
+            job (number of times, total, median, 95th percentile and
+            maximum seconds), and its counters.
+
+        spatial harvest-bench {path} [copies] [profile-file]
+            Runs the XML files in a directory (e.g. ckanext/spatial/tests/xml)
+            through the parsing, validation and extraction steps of the
+            GEMINI harvesters, without making any remote requests or writing
+            to the database, and shows the documents processed per second
+            and the time taken by each step. The files can be processed
+            several times, and the run can be profiled with cProfile,
+            saving the profile to the given file.
       
     The commands should be run from the ckanext-spatial directory and expect
     a development.ini file to be present. Most of the time you will
@@ -31,7 +71,7 @@ class Spatial(CkanCommand):
 
     summary = __doc__.split('\n')[0]
     usage = __doc__
-    max_args = 2 
+    max_args = 4 
     min_args = 0
 
     def command(self):
@@ -46,6 +86,20 @@ class Spatial(CkanCommand):
             self.initdb()    
         elif cmd == 'extents':
             self.update_extents()
+        elif cmd == 'subdivide':
+            self.subdivide()
+        elif cmd == 'precompute':
+            self.precompute()
+        elif cmd == 'histogram':
+            self.update_histogram()
+        elif cmd == 'verify-wms':
+            self.verify_wms()
+        elif cmd == 'import-pool':
+            self.import_pool()
+        elif cmd == 'harvest-stats':
+            self.harvest_stats()
+        elif cmd == 'harvest-bench':
+            self.harvest_bench()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -56,8 +110,10 @@ class Spatial(CkanCommand):
             srid = None
 
         from ckanext.spatial.model import setup as db_setup
+        from ckanext.spatial.model.harvest_state import setup as harvest_state_setup
         
         db_setup(srid)
+        harvest_state_setup()
 
         print 'DB tables created'
 
@@ -95,3 +151,102 @@ class Spatial(CkanCommand):
 
         print msg
 
+    def subdivide(self):
+        from ckan.model import Session
+        from ckanext.spatial.model.package_extent import subdivide_geometry, subdivide_enabled
+
+        subdivide_geometry()
+        Session.commit()
+
+        if subdivide_enabled():
+            print 'Extents subdivided'
+        else:
+            print 'Subdivision disabled, pieces of the extents removed'
+
+    def precompute(self):
+        from ckanext.spatial.lib import update_hot_regions
+
+        count = update_hot_regions()
+
+        print 'Results precomputed for %i hot regions' % count
+
+    def update_histogram(self):
+        from ckanext.spatial.lib import update_extent_histogram
+
+        size = int(self.args[1]) if len(self.args) >= 2 else None
+
+        count = update_extent_histogram(size)
+
+        print 'Extent histogram updated with %i extents' % count
+
+    def verify_wms(self):
+        from ckanext.spatial.lib.wms_check import verify_pending_checks
+
+        if len(self.args) >= 2:
+            checked, updated = verify_pending_checks(int(self.args[1]))
+        else:
+            checked, updated = verify_pending_checks()
+
+        print 'Checked %i URLs, %i resources verified as WMS' % (checked, updated)
+
+    def import_pool(self):
+        from ckanext.spatial.lib.import_pool import import_job_objects
+
+        if len(self.args) < 2:
+            print 'Please provide a harvest job id'
+            sys.exit(1)
+        job_id = unicode(self.args[1])
+        if len(self.args) >= 3:
+            total, imported = import_job_objects(job_id, int(self.args[2]))
+        else:
+            total, imported = import_job_objects(job_id)
+
+        print 'Imported %i out of %i objects' % (imported, total)
+
+    def harvest_stats(self):
+        from ckanext.spatial.lib.stats import get_job_stats
+
+        if len(self.args) < 2:
+            print 'Please provide a harvest job id'
+            sys.exit(1)
+        stats = get_job_stats(unicode(self.args[1]))
+        if not stats:
+            print 'No stats recorded for job %s' % self.args[1]
+            return
+
+        for stage in ('gather', 'fetch', 'import'):
+            if not stage in stats:
+                continue
+            print '%s stage' % stage.capitalize()
+            self._print_steps(stats[stage]['steps'])
+            for name, value in sorted(stats[stage]['counters'].iteritems()):
+                print '  %s: %i' % (name, value)
+            print ''
+
+    def harvest_bench(self):
+        from ckanext.spatial.lib.bench import run_benchmark
+
+        if len(self.args) < 2:
+            print 'Please provide a directory with XML files'
+            sys.exit(1)
+        copies = int(self.args[2]) if len(self.args) >= 3 else 1
+        profile = self.args[3] if len(self.args) >= 4 else None
+
+        result = run_benchmark(self.args[1], copies, profile)
+
+        print 'Processed %i documents in %.2f seconds (%.1f documents per second)' % \
+              (result['documents'], result['seconds'], result['documents_per_second'])
+        print '%i invalid, %i errors' % (result['invalid'], result['errors'])
+        print ''
+        self._print_steps(result['steps'])
+        if profile:
+            import pstats
+            print ''
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+
+    def _print_steps(self, steps):
+        print '  %-16s %8s %10s %8s %8s %8s' % ('step', 'count', 'total', 'p50', 'p95', 'max')
+        for step, step_stats in sorted(steps.iteritems()):
+            print '  %-16s %8i %10.2f %8.3f %8.3f %8.3f' % (step, step_stats['count'],
+                    step_stats['total'], step_stats['p50'], step_stats['p95'],
+                    step_stats['max'])
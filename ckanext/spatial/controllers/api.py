@@ -10,8 +10,9 @@ from ckan.lib.base import request, config, abort
 from ckan.controllers.api import ApiController as BaseApiController
 from ckan.model import Session
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject
 from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query
+from ckanext.spatial.lib.stats import get_job_stats
 
 
 class ApiController(BaseApiController):
@@ -76,3 +77,10 @@ class HarvestMetadataApiController(BaseApiController):
         html = transformer(xml)
         return etree.tostring(html, pretty_print=True)
 
+    def job_stats(self,id):
+        job = Session.query(HarvestJob).filter(HarvestJob.id==id).first()
+
+        if job is None:
+            abort(404)
+        return self._finish_ok(get_job_stats(job.id))
+
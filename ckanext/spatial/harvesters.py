@@ -12,27 +12,30 @@ TODO: Harvesters for generic INSPIRE CSW servers
 '''
 import cgitb
 import warnings
-import urllib2
 from urlparse import urlparse
-from datetime import datetime
+from datetime import datetime, timedelta
 from string import Template
 from numbers import Number
 import sys
 import uuid
 import os
+import re
 import logging
-import difflib
+import hashlib
+from contextlib import contextmanager
 
 from lxml import etree
 from pylons import config
-from sqlalchemy.sql import update, bindparam
-from sqlalchemy.exc import InvalidRequestError
-from owslib import wms
+from paste.deploy.converters import asbool
+from sqlalchemy.sql import update, bindparam, and_
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
 
 from ckan import model
-from ckan.model import Session, Package
+from ckan.model import Session
 from ckan.lib.munge import munge_title_to_name
 from ckan.plugins.core import SingletonPlugin, implements
+from ckan.plugins import IConfigurable
 from ckan.lib.helpers import json
 
 from ckan import logic
@@ -40,15 +43,37 @@ from ckan.logic import get_action, ValidationError
 from ckan.lib.navl.validators import not_empty
 
 from ckanext.harvest.interfaces import IHarvester
-from ckanext.harvest.model import HarvestObject, HarvestGatherError, \
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
                                     HarvestObjectError
 
-from ckanext.spatial.model import GeminiDocument
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.model import GeminiDocument, HarvestUrlState, HarvestSourceState, \
+                                   HarvestRemovedRecord, ValidationResult, HarvestObjectDigest, \
+                                   HarvestDiff
+from ckanext.spatial.model import harvest_state
+from ckanext.spatial.model.harvest_state import setup as setup_harvest_state_model
+from ckanext.spatial.lib.csw_client import CswService, DEFAULT_CLIENT_TTL, \
+                                           DEFAULT_FULL_RECORDS_PAGE, DEFAULT_MAX_PAGE, \
+                                           modified_since_filter
+from ckanext.spatial.lib import fetch
+from ckanext.spatial.lib.fetch import fetch_all, fetch_url, read_url, DEFAULT_WORKERS, \
+                                     DEFAULT_WORKERS_PER_HOST, DEFAULT_TIMEOUT, DEFAULT_MAX_SIZE
+from ckanext.spatial.lib.names import allocate_package_name
+from ckanext.spatial.lib.locks import advisory_lock, advisory_locks, LockNotAvailable
+from ckanext.spatial.lib.diff import bounded_unified_diff, DEFAULT_MAX_HUNKS, DEFAULT_MAX_LINES, \
+                                     DEFAULT_MAX_BYTES
+from ckanext.spatial.lib.wms_check import is_wms, defer_check, set_recommended_wms_preview
+from ckanext.spatial.lib.local_files import iter_documents, parse_documents, \
+                                           DEFAULT_LOCAL_WORKERS, DEFAULT_LOCAL_CHUNK_SIZE
+from ckanext.spatial.lib import stats
 from ckanext.spatial.validation import Validators
 
 log = logging.getLogger(__name__)
 
+# Modification date (eg 2012-05-01 10:00 or 01-May-2012 10:00) and size
+# (eg 1.2K, 5120 or -) of an entry in an Apache-style index
+LISTING_COLUMNS_RE = re.compile(r'^\s*(?P<modified>(\d{4}-\d{2}-\d{2}|\d{2}-\w{3}-\d{4})'
+                                r'\s+\d{2}:\d{2}(:\d{2})?)\s+(?P<size>[\d.]+[KMGT]?|-)')
+
 def text_traceback():
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -61,20 +86,35 @@ def text_traceback():
 # exceptions, rather them being caught.
 debug_exception_mode = bool(os.getenv('DEBUG'))
 
+# Validation results of the documents seen recently by this process, keyed
+# by content digest (see SpatialHarvester._validate)
+_validation_results = {}
+VALIDATION_RESULTS_CACHE_SIZE = 1000
+
 class SpatialHarvester(object):
     # Q: Why does this not inherit from HarvesterBase in ckanext-harvest?
 
-    def _is_wms(self,url):
-        try:
-            capabilities_url = wms.WMSCapabilitiesReader().capabilities_url(url)
-            res = urllib2.urlopen(capabilities_url,None,10)
-            xml = res.read()
+    # Packages imported in the current batch, when importing in batches
+    # (see GeminiHarvester.import_stage_batch)
+    _batch = None
+    # Takes the lock of a GUID until the current batch is committed
+    _lock_guid = None
 
-            s = wms.WebMapService(url,xml=xml)
-            return isinstance(s.contents, dict) and s.contents != {}
-        except Exception, e:
-            log.error('WMS check for %s failed with exception: %s' % (url, str(e)))
-        return False
+    def _is_wms(self,url):
+        '''
+        Returns whether the URL is a WMS endpoint, according to the
+        ckan.spatial.harvest.wms_check option: checking it now (unless
+        there is a recent result cached), only looking at the cache and
+        leaving the check for the "spatial verify-wms" command, or not at
+        all.
+        '''
+        mode = config.get('ckan.spatial.harvest.wms_check', 'inline')
+        if mode == 'off':
+            return False
+        with stats.timer('wms_check'):
+            if mode == 'deferred':
+                return bool(defer_check(url))
+            return is_wms(url)
 
     def _get_validator(self):
         if not hasattr(self, '_validator'):
@@ -88,7 +128,71 @@ class SpatialHarvester(object):
             self._validator = Validators(profiles=profiles)
         return self._validator
 
+    def _validate(self, xml, content):
+        '''
+        Validates the parsed document xml, whose serialization is content.
+
+        Documents are only validated once: the results are kept in memory
+        and in the spatial_validation_result table, keyed by the digest of
+        the content and the validation profiles.
+
+        Returns the same as Validators.is_valid.
+        '''
+        digest = self._validation_digest(content)
+
+        result = _validation_results.get(digest)
+        if result is None:
+            result = self._get_stored_validation_result(digest)
+            if result is not None:
+                stats.count('validation_cached')
+                self._cache_validation_result(digest, result)
+            else:
+                with stats.timer('validate'):
+                    result = self._get_validator().is_valid(xml)
+                self._save_validation_result(digest, result)
+        else:
+            log.debug('Reusing validation result for document %s' % digest)
+            stats.count('validation_cached')
+        return result
+
+    def _validation_digest(self, content):
+        '''Returns the key of the validation result of a document'''
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        profiles = ','.join(self._get_validator().profiles)
+        return unicode(hashlib.sha1('%s\n%s' % (profiles, content)).hexdigest())
+
+    def _cache_validation_result(self, digest, result):
+        if len(_validation_results) >= VALIDATION_RESULTS_CACHE_SIZE:
+            _validation_results.clear()
+        _validation_results[digest] = result
+
+    def _get_stored_validation_result(self, digest):
+        '''
+        Returns the validation result of a document stored in the
+        spatial_validation_result table, if any (see _validate).
+        '''
+        stored = ValidationResult.get(digest)
+        if stored:
+            return stored.valid, json.loads(stored.messages)
+        return None
+
+    def _save_validation_result(self, digest, result):
+        '''
+        Keeps the validation result of a document in memory and in the
+        spatial_validation_result table (see _validate).
+        '''
+        Session.begin_nested()
+        try:
+            Session.add(ValidationResult(digest, result[0], json.dumps(result[1])))
+            Session.commit()
+        except IntegrityError:
+            # Validated by another process in the meantime
+            Session.rollback()
+        self._cache_validation_result(digest, result)
+
     def _save_gather_error(self,message,job):
+        stats.count('errors')
         err = HarvestGatherError(message=message,job=job)
         try:
             err.save()
@@ -99,19 +203,64 @@ class SpatialHarvester(object):
             log.error(message)
 
     def _save_object_error(self,message,obj,stage=u'Fetch'):
+        stats.count('errors')
         err = HarvestObjectError(message=message,object=obj,stage=stage)
         try:
-            err.save()
+            if self._batch is not None:
+                # Saved with the rest of the batch
+                Session.add(err)
+                Session.flush()
+            else:
+                err.save()
         except InvalidRequestError,e:
             Session.rollback()
             err.save()
         finally:
             log.error(message)
 
+    def _get_fetch_limits(self):
+        '''Returns the timeout and maximum size of the remote requests'''
+        timeout = int(config.get('ckan.spatial.harvest.fetch_timeout', DEFAULT_TIMEOUT))
+        max_size = int(config.get('ckan.spatial.harvest.max_response_size', DEFAULT_MAX_SIZE))
+        return timeout, max_size
+
     def _get_content(self, url):
         url = url.replace(' ','%20')
-        http_response = urllib2.urlopen(url)
-        return http_response.read()
+        with stats.timer('fetch'):
+            return read_url(url, *self._get_fetch_limits())
+
+    def _get_validators(self, url_state):
+        '''Returns the (ETag, Last-Modified) validators of the previous
+        response stored in url_state, as plain values that can be used from
+        other threads (see _get_content_conditional).'''
+        if url_state is None:
+            return None, None
+        return url_state.etag, url_state.last_modified
+
+    def _get_content_conditional(self, url, validators=None):
+        '''Gets the content of a URL, sending the (ETag, Last-Modified)
+        validators of the previous response, if any (see _get_validators).
+
+        Returns a tuple with the content (None if the document was not
+        modified), and the ETag and Last-Modified headers of the response.
+        '''
+        etag, last_modified = validators or (None, None)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        timeout, max_size = self._get_fetch_limits()
+        with stats.timer('fetch'):
+            try:
+                content, headers = fetch_url(url.replace(' ','%20'), timeout, max_size,
+                                             headers=headers)
+            except fetch.HTTPError, e:
+                if e.code == 304:
+                    stats.count('not_modified')
+                    return None, etag, last_modified
+                raise
+            return content, headers.get('ETag'), headers.get('Last-Modified')
 
 class GeminiHarvester(SpatialHarvester):
     '''Base class for spatial harvesting GEMINI2 documents for the UK Location
@@ -122,10 +271,26 @@ class GeminiHarvester(SpatialHarvester):
 
     force_import = False
 
+    def configure(self, config):
+        if not config.get('ckan.spatial.testing',False):
+            setup_harvest_state_model()
+        fetch.configure(
+            retries=int(config.get('ckan.spatial.harvest.fetch_retries',
+                                   fetch.DEFAULT_RETRIES)),
+            backoff=float(config.get('ckan.spatial.harvest.fetch_backoff',
+                                     fetch.DEFAULT_BACKOFF)),
+            host_concurrency=int(config.get('ckan.spatial.harvest.fetch_host_concurrency',
+                                            fetch.DEFAULT_HOST_CONCURRENCY)),
+            breaker_threshold=int(config.get('ckan.spatial.harvest.fetch_breaker_threshold',
+                                             fetch.DEFAULT_BREAKER_THRESHOLD)),
+            breaker_reset=int(config.get('ckan.spatial.harvest.fetch_breaker_reset',
+                                         fetch.DEFAULT_BREAKER_RESET)))
+
     extent_template = Template('''
     {"type":"Polygon","coordinates":[[[$minx, $miny],[$minx, $maxy], [$maxx, $maxy], [$maxx, $miny], [$minx, $miny]]]}
     ''')
 
+    @stats.job_stage('import')
     def import_stage(self, harvest_object):
         log = logging.getLogger(__name__ + '.import')
         log.debug('Import stage for harvest object: %r', harvest_object)
@@ -144,38 +309,185 @@ class GeminiHarvester(SpatialHarvester):
             self.import_gemini_object(harvest_object.content)
             return True
         except Exception, e:
-            log.error('Exception during import: %s' % text_traceback())
-            if not str(e).strip():
-                self._save_object_error('Error importing Gemini document.', harvest_object, 'Import')
-            else:
-                self._save_object_error('Error importing Gemini document: %s' % str(e), harvest_object, 'Import')
+            self._save_import_error(e, harvest_object)
 
-            if debug_exception_mode:
-                raise
+    def _save_import_error(self, e, harvest_object):
+        log.error('Exception during import: %s' % text_traceback())
+        if not str(e).strip():
+            self._save_object_error('Error importing Gemini document.', harvest_object, 'Import')
+        else:
+            self._save_object_error('Error importing Gemini document: %s' % str(e), harvest_object, 'Import')
+
+        if debug_exception_mode:
+            raise
+
+    @stats.job_stage('import')
+    def import_stage_batch(self, harvest_objects):
+        '''
+        Imports several harvest objects in a single transaction, rather than
+        committing several times for each of them as import_stage does.
+
+        Each object is imported in a savepoint, so an error only discards
+        the changes made for that object. The current flags of the objects
+        are updated at the end of the batch, with a single UPDATE.
+
+        The locks of the GUIDs of the objects (see _guid_lock) are taken up
+        front, and kept until the batch is committed. Documents whose GUID
+        differs from the one of their object, and is locked by another
+        import, are imported on their own after the batch, as waiting for
+        their lock could deadlock.
+
+        Returns the number of objects imported without errors.
+        '''
+        log = logging.getLogger(__name__ + '.import')
+        imported = 0
+        deferred = []
+        self._batch = {}
+        try:
+            with advisory_locks([harvest_object.guid for harvest_object in harvest_objects]) \
+                    as self._lock_guid:
+                for harvest_object in harvest_objects:
+                    log.debug('Batch import stage for harvest object: %r', harvest_object)
+                    self.obj = harvest_object
+                    if harvest_object.content is None:
+                        self._save_object_error('Empty content for object %s' % harvest_object.id,harvest_object,'Import')
+                        continue
+                    if harvest_object.guid in [guid for object_id, guid in self._batch.values()]:
+                        # A previous version of the document was imported in this
+                        # batch, make it current before looking for it
+                        self._flag_current_objects()
+                    Session.begin_nested()
+                    try:
+                        self.import_gemini_object(harvest_object.content)
+                        Session.commit()
+                        imported += 1
+                    except LockNotAvailable:
+                        Session.rollback()
+                        deferred.append(harvest_object)
+                    except Exception, e:
+                        Session.rollback()
+                        self._save_import_error(e, harvest_object)
+
+                with stats.timer('commit'):
+                    self._flag_current_objects()
+                    Session.commit()
+        finally:
+            self._batch = None
+            self._lock_guid = None
+
+        for harvest_object in deferred:
+            log.debug('Import stage for deferred harvest object: %r', harvest_object)
+            self.obj = harvest_object
+            try:
+                self.import_gemini_object(harvest_object.content)
+                imported += 1
+            except Exception, e:
+                self._save_import_error(e, harvest_object)
+        return imported
+
+    def _flag_current_objects(self):
+        '''
+        Flags the objects imported in the current batch as the current ones
+        for their packages, and the other objects of those packages as not
+        current anymore.
+        '''
+        if not self._batch:
+            return
+        Session.flush()
+        from ckanext.harvest.model import harvest_object_table
+        current_ids = [object_id for object_id, guid in self._batch.values()]
+        u = update(harvest_object_table) \
+                .where(harvest_object_table.c.package_id.in_(self._batch.keys())) \
+                .values(current=harvest_object_table.c.id.in_(current_ids))
+        Session.execute(u)
+        Session.expire_all()
+        self._batch.clear()
 
     def import_gemini_object(self, gemini_string):
         log = logging.getLogger(__name__ + '.import')
-        xml = etree.fromstring(gemini_string)
+        with stats.timer('parse'):
+            if isinstance(gemini_string, unicode):
+                xml = etree.fromstring(gemini_string.encode('utf8'))
+            else:
+                xml = etree.fromstring(gemini_string)
 
-        valid, messages = self._get_validator().is_valid(xml)
-        if not valid:
-            log.error('Errors found for object with GUID %s:' % self.obj.guid)
-            out = messages[0] + ':\n' + '\n'.join(messages[1:])
-            self._save_object_error(out,self.obj,'Import')
+        with stats.timer('digest'):
+            digest = self._content_digest(xml)
+        if not self.force_import and self._is_unchanged(digest):
+            log.info('Document with GUID %s unchanged, skipping...' % self.obj.guid)
+            stats.count('unchanged')
+            return None
+        self._save_digest(digest)
+
+        # The parsed document is used from now on, rather than parsing it again.
+        # Concurrent imports of the same document are serialized, so only
+        # one of them creates its package and becomes the current object.
+        # The lock is taken before saving any error, as a batch import may
+        # have to defer the object until it is available (see
+        # import_stage_batch)
+        gemini_guid = GeminiDocument(xml_tree=xml).read_value('guid')
+        with self._guid_lock(gemini_guid):
+            valid, messages = self._validate(xml, gemini_string)
+            if not valid:
+                log.error('Errors found for object with GUID %s:' % self.obj.guid)
+                out = messages[0] + ':\n' + '\n'.join(messages[1:])
+                self._save_object_error(out,self.obj,'Import')
+
+            package = self.write_package_from_gemini_string(None, xml_tree=xml)
+
+    @contextmanager
+    def _guid_lock(self, guid):
+        if self._batch is not None:
+            # The current flags are only updated when the batch is
+            # committed, so keep the lock until then (it is usually
+            # taken already, unless the GUID of the document differs from
+            # the one of the harvest object)
+            self._lock_guid(guid)
+            yield
+        else:
+            with advisory_lock(guid):
+                yield
 
-        unicode_gemini_string = etree.tostring(xml, encoding=unicode, pretty_print=True)
 
-        package = self.write_package_from_gemini_string(unicode_gemini_string)
+    def _content_digest(self, xml):
+        '''
+        Returns a digest of the canonical form (C14N) of the document, with
+        the whitespace between elements removed, so formatting changes are
+        not taken as changes of the document.
+        '''
+        canonical = etree.tostring(xml, method='c14n')
+        return unicode(hashlib.sha1(re.sub(r'>\s+<', '><', canonical.strip())).hexdigest())
 
+    def _save_digest(self, digest):
+        '''Saves the content digest of the object being imported'''
+        Session.merge(HarvestObjectDigest(self.obj.id, digest))
 
-    def write_package_from_gemini_string(self, content):
+    def _is_unchanged(self, digest):
+        '''
+        Returns whether the current harvest object with the same GUID as the
+        one being imported has the same content digest, and comes from an
+        active source (otherwise the document is being moved to a new
+        source and the package needs updating).
+        '''
+        previous = Session.query(HarvestObject) \
+                   .join((HarvestObjectDigest,
+                          HarvestObjectDigest.harvest_object_id==HarvestObject.id)) \
+                   .filter(HarvestObject.guid==self.obj.guid) \
+                   .filter(HarvestObject.current==True) \
+                   .filter(HarvestObject.id!=self.obj.id) \
+                   .filter(HarvestObjectDigest.digest==digest) \
+                   .first()
+        return previous is not None and previous.source.active is not False
+
+    def write_package_from_gemini_string(self, content, xml_tree=None):
         '''Create or update a Package based on some content that has
-        come from a URL.
+        come from a URL (or its already parsed tree).
         '''
         log = logging.getLogger(__name__ + '.import')
         package = None
-        gemini_document = GeminiDocument(content)
-        gemini_values = gemini_document.read_values()
+        with stats.timer('extract'):
+            gemini_document = GeminiDocument(content, xml_tree)
+            gemini_values = gemini_document.read_values()
         gemini_guid = gemini_values['guid']
 
         # Save the metadata reference date in the Harvest Object
@@ -189,7 +501,8 @@ class GeminiHarvester(SpatialHarvester):
                         % (gemini_guid,gemini_values['metadata-date']))
 
         self.obj.metadata_modified_date = metadata_modified_date
-        self.obj.save()
+        if self._batch is None:
+            self.obj.save()
 
         last_harvested_object = Session.query(HarvestObject) \
                             .filter(HarvestObject.guid==gemini_guid) \
@@ -233,10 +546,7 @@ class GeminiHarvester(SpatialHarvester):
             else:
                 if last_harvested_object.content != self.obj.content and \
                  last_harvested_object.metadata_modified_date == self.obj.metadata_modified_date:
-                    diff_generator = difflib.HtmlDiff().make_table(
-                        last_harvested_object.content.split('\n'),
-                        self.obj.content.split('\n'))
-                    diff = '\n'.join([line for line in diff_generator])
+                    diff = self._get_diff(last_harvested_object.content, self.obj.content)
                     raise Exception('The contents of document with GUID %s changed, but the metadata date has not been updated.\nDiff:\n%s' % (gemini_guid, diff))
                 else:
                     # The content hasn't changed, no need to update the package
@@ -245,9 +555,80 @@ class GeminiHarvester(SpatialHarvester):
         else:
             log.info('No package with GEMINI guid %s found, let''s create one' % gemini_guid)
 
+        with stats.timer('package_dict'):
+            package_dict = self.get_package_dict(gemini_values, self.obj.id,
+                                                 self.obj.source.publisher_id)
+
+        if reactivate_package:
+            package_dict['state'] = u'active'
+
+        if package is None or package.title != gemini_values['title']:
+            name = self.gen_new_name(gemini_values['title'])
+            if not name:
+                name = self.gen_new_name(str(gemini_guid))
+            if not name:
+                raise Exception('Could not generate a unique name from the title or the GUID. Please choose a more unique title.')
+            package_dict['name'] = name
+        else:
+            package_dict['name'] = package.name
+
+        if package == None:
+            # Create new package from data.
+            with stats.timer('package_write'):
+                package = self._create_package_from_data(package_dict)
+            log.info('Created new package ID %s with GEMINI guid %s', package['id'], gemini_guid)
+            stats.count('created')
+        else:
+            with stats.timer('package_write'):
+                package = self._create_package_from_data(package_dict, package = package)
+            log.info('Updated existing package ID %s with existing GEMINI guid %s', package['id'], gemini_guid)
+            stats.count('updated')
+
+        if self._batch is not None:
+            # The current flags are updated at the end of the batch
+            if not self.obj.package_id:
+                self.obj.package_id = package['id']
+            self._batch[package['id']] = (self.obj.id, gemini_guid)
+            return package
+
+        # Flag the other objects of this source as not current anymore
+        from ckanext.harvest.model import harvest_object_table
+        u = update(harvest_object_table) \
+                .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
+                .values(current=False)
+        with stats.timer('commit'):
+            Session.execute(u, params={'b_package_id':package['id']})
+            Session.commit()
+
+            # Refresh current object from session, otherwise the
+            # import paster command fails
+            Session.remove()
+            Session.add(self.obj)
+            Session.refresh(self.obj)
+
+            # Set reference to package in the HarvestObject and flag it as
+            # the current one
+            if not self.obj.package_id:
+                self.obj.package_id = package['id']
+
+            self.obj.current = True
+            self.obj.save()
+
+
+        assert gemini_guid == [e['value'] for e in package['extras'] if e['key'] == 'guid'][0]
+        assert self.obj.id == [e['value'] for e in package['extras'] if e['key'] ==  'harvest_object_id'][0]
+
+        return package
+
+    def get_package_dict(self, gemini_values, harvest_object_id, publisher_id=None):
+        '''
+        Returns the dict of the package for the values extracted from a
+        GEMINI document (see GeminiDocument.read_values), as passed to
+        package_create or package_update, except for its name and state.
+        '''
         extras = {
             'UKLP': 'True',
-            'harvest_object_id': self.obj.id
+            'harvest_object_id': harvest_object_id
         }
 
         # Just add some of the metadata as extras, not the whole lot
@@ -344,22 +725,8 @@ class GeminiHarvester(SpatialHarvester):
             'resources':[]
         }
 
-        if self.obj.source.publisher_id:
-            package_dict['groups'] = [{'id':self.obj.source.publisher_id}]
-
-
-        if reactivate_package:
-            package_dict['state'] = u'active'
-
-        if package is None or package.title != gemini_values['title']:
-            name = self.gen_new_name(gemini_values['title'])
-            if not name:
-                name = self.gen_new_name(str(gemini_guid))
-            if not name:
-                raise Exception('Could not generate a unique name from the title or the GUID. Please choose a more unique title.')
-            package_dict['name'] = name
-        else:
-            package_dict['name'] = package.name
+        if publisher_id:
+            package_dict['groups'] = [{'id':publisher_id}]
 
         resource_locators = gemini_values.get('resource-locator', [])
 
@@ -389,13 +756,7 @@ class GeminiHarvester(SpatialHarvester):
                     package_dict['resources'].append(resource)
 
             # Guess the best view service to use in WMS preview
-            verified_view_resources = [r for r in package_dict['resources'] if 'verified' in r and r['format'] == 'WMS']
-            if len(verified_view_resources):
-                verified_view_resources[0]['ckan_recommended_wms_preview'] = True
-            else:
-                view_resources = [r for r in package_dict['resources'] if r['format'] == 'WMS']
-                if len(view_resources):
-                    view_resources[0]['ckan_recommended_wms_preview'] = True
+            set_recommended_wms_preview(package_dict['resources'])
 
         extras_as_dict = []
         for key,value in extras.iteritems():
@@ -406,58 +767,53 @@ class GeminiHarvester(SpatialHarvester):
 
         package_dict['extras'] = extras_as_dict
 
-        if package == None:
-            # Create new package from data.
-            package = self._create_package_from_data(package_dict)
-            log.info('Created new package ID %s with GEMINI guid %s', package['id'], gemini_guid)
-        else:
-            package = self._create_package_from_data(package_dict, package = package)
-            log.info('Updated existing package ID %s with existing GEMINI guid %s', package['id'], gemini_guid)
-
-        # Flag the other objects of this source as not current anymore
-        from ckanext.harvest.model import harvest_object_table
-        u = update(harvest_object_table) \
-                .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
-                .values(current=False)
-        Session.execute(u, params={'b_package_id':package['id']})
-        Session.commit()
-
-        # Refresh current object from session, otherwise the
-        # import paster command fails
-        Session.remove()
-        Session.add(self.obj)
-        Session.refresh(self.obj)
-
-        # Set reference to package in the HarvestObject and flag it as
-        # the current one
-        if not self.obj.package_id:
-            self.obj.package_id = package['id']
-
-        self.obj.current = True
-        self.obj.save()
-
-
-        assert gemini_guid == [e['value'] for e in package['extras'] if e['key'] == 'guid'][0]
-        assert self.obj.id == [e['value'] for e in package['extras'] if e['key'] ==  'harvest_object_id'][0]
+        return package_dict
 
-        return package
+    def _get_diff(self, old_content, new_content):
+        '''
+        Returns a (bounded) unified diff between two versions of a document,
+        reusing the one computed for the same versions in previous runs.
+        '''
+        digests = []
+        for content in (old_content, new_content):
+            if isinstance(content, unicode):
+                content = content.encode('utf8')
+            digests.append(hashlib.sha1(content).hexdigest())
+        digests = u':'.join(digests)
+
+        harvest_diff = HarvestDiff.get(digests)
+        if harvest_diff is not None:
+            return harvest_diff.diff
+
+        max_hunks = int(config.get('ckan.spatial.harvest.diff_max_hunks', DEFAULT_MAX_HUNKS))
+        max_lines = int(config.get('ckan.spatial.harvest.diff_max_lines', DEFAULT_MAX_LINES))
+        max_bytes = int(config.get('ckan.spatial.harvest.diff_max_bytes', DEFAULT_MAX_BYTES))
+        diff = bounded_unified_diff(old_content, new_content, max_hunks, max_lines,
+                                    max_bytes=max_bytes)
+        self._save_diff(digests, diff)
+        return diff
+
+    def _save_diff(self, digests, diff):
+        '''
+        Saves a diff on a connection of its own, as the import fails right
+        after computing it, which rolls back its savepoint in batch mode
+        (see import_stage_batch).
+        '''
+        conn = model.meta.engine.connect()
+        try:
+            conn.execute(harvest_state.harvest_diff_table.insert(),
+                         digests=digests, diff=diff)
+        except IntegrityError:
+            # Saved by another process in the meantime
+            pass
+        finally:
+            conn.close()
 
     def gen_new_name(self, title):
         name = munge_title_to_name(title).replace('_', '-')
         while '--' in name:
             name = name.replace('--', '-')
-        like_q = u'%s%%' % name
-        pkg_query = Session.query(Package).filter(Package.name.ilike(like_q)).limit(100)
-        taken = [pkg.name for pkg in pkg_query]
-        if name not in taken:
-            return name
-        else:
-            counter = 1
-            while counter < 101:
-                if name+str(counter) not in taken:
-                    return name+str(counter)
-                counter = counter + 1
-            return None
+        return allocate_package_name(name)
 
     def _extract_first_licence_url(self, licences):
         '''Given a list of pieces of licence info, hunt for the first one
@@ -503,7 +859,8 @@ class GeminiHarvester(SpatialHarvester):
                    'user':'harvest',
                    'schema':package_schema,
                    'extras_as_string':True,
-                   'api_version': '2'}
+                   'api_version': '2',
+                   'defer_commit': self._batch is not None}
         if not package:
             # We need to explicitly provide a package ID, otherwise ckanext-spatial
             # won't be be able to link the extent to the package.
@@ -524,8 +881,92 @@ class GeminiHarvester(SpatialHarvester):
 
         return package_dict
 
+    def _get_url_states(self, harvest_job):
+        '''Returns the stored HarvestUrlStates of the job source, keyed by URL'''
+        return dict((url_state.url, url_state) for url_state in
+                    Session.query(HarvestUrlState) \
+                    .filter(HarvestUrlState.source_id==harvest_job.source.id))
+
+    def _get_current_urls(self, harvest_job):
+        '''Returns the URLs of the job source whose last harvest object
+        belongs to a dataset that is up to date (ie there is a current
+        object with the same GUID)'''
+        previous_object = aliased(HarvestObject)
+        return set(url for (url,) in
+                   Session.query(HarvestUrlState.url) \
+                   .join((previous_object,
+                          previous_object.id==HarvestUrlState.harvest_object_id)) \
+                   .join((HarvestObject,
+                          and_(HarvestObject.guid==previous_object.guid,
+                               HarvestObject.current==True))) \
+                   .filter(HarvestUrlState.source_id==harvest_job.source.id))
+
+    def _create_object_from_response(self, url, response, url_state, harvest_job,
+                                     listing_entry=None):
+        '''
+        Creates a HarvestObject for the document returned by a conditional
+        request (see _get_content_conditional).
+
+        If the document was not modified since the previous harvest, it is
+        not parsed or validated again. No object is created if a package
+        was already imported from it, otherwise the content of the previous
+        object is reused.
+
+        listing_entry is the (modified, size) tuple shown for the document
+        in a WAF index, stored to avoid requesting it again while it
+        does not change.
+
+        Returns the HarvestObject or None.
+        '''
+        content, etag, last_modified = response
+        if url_state is None:
+            url_state = HarvestUrlState(source_id=harvest_job.source.id, url=url)
+        if listing_entry:
+            url_state.listing_modified, url_state.listing_size = listing_entry
+
+        if content is None:
+            previous_object = HarvestObject.get(url_state.harvest_object_id) \
+                              if url_state.harvest_object_id else None
+            if previous_object is None:
+                # We don't know what we got last time
+                content, etag, last_modified = self._get_content_conditional(url)
+            elif Session.query(HarvestObject) \
+                    .filter(HarvestObject.guid==previous_object.guid) \
+                    .filter(HarvestObject.current==True).count():
+                log.debug('Document %s not modified, skipping' % url)
+                if listing_entry:
+                    url_state.save()
+                return None
+            else:
+                log.debug('Document %s not modified, reusing previous content' % url)
+                gemini_string, gemini_guid = previous_object.content, previous_object.guid
+
+        if content is not None:
+            # We need to extract the guid to pass it to the next stage
+            gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
+            if not gemini_guid:
+                return None
+            log.debug('Got GUID %s' % gemini_guid)
+
+        # Create a new HarvestObject for this identifier
+        # Generally the content will be set in the fetch stage, but as we alredy
+        # have it, we might as well save a request
+        obj = HarvestObject(guid=gemini_guid,
+                            job=harvest_job,
+                            content=gemini_string)
+        obj.save()
+        stats.count('objects')
+
+        url_state.etag = etag
+        url_state.last_modified = last_modified
+        url_state.harvest_object_id = obj.id
+        url_state.save()
+
+        return obj
+
     def get_gemini_string_and_guid(self,content,url=None):
-        xml = etree.fromstring(content)
+        with stats.timer('parse'):
+            xml = etree.fromstring(content)
 
         # The validator and GeminiDocument don't like the container
         metadata_tag = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
@@ -537,7 +978,9 @@ class GeminiHarvester(SpatialHarvester):
         if gemini_xml is None:
             self._save_gather_error('Content is not a valid Gemini document',self.harvest_job)
 
-        valid, messages = self._get_validator().is_valid(gemini_xml)
+        gemini_string = etree.tostring(gemini_xml)
+
+        valid, messages = self._validate(gemini_xml, gemini_string)
         if not valid:
             out = messages[0] + ':\n' + '\n'.join(messages[1:])
             if url:
@@ -545,10 +988,8 @@ class GeminiHarvester(SpatialHarvester):
             else:
                 self._save_gather_error('Validation error - %s'%out,self.harvest_job)
 
-        gemini_string = etree.tostring(gemini_xml)
-        gemini_document = GeminiDocument(gemini_string)
-        gemini_values = gemini_document.read_values()
-        gemini_guid = gemini_values['guid']
+        gemini_document = GeminiDocument(xml_tree=gemini_xml)
+        gemini_guid = gemini_document.read_value('guid')
 
         return gemini_string, gemini_guid
 
@@ -557,6 +998,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
     A Harvester for CSW servers
     '''
     implements(IHarvester)
+    implements(IConfigurable)
 
     csw=None
 
@@ -567,6 +1009,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A server that implements OGC\'s Catalog Service for the Web (CSW) standard'
             }
 
+    @stats.job_stage('gather')
     def gather_stage(self, harvest_job):
         log = logging.getLogger(__name__ + '.CSW.gather')
         log.debug('GeminiCswHarvester gather_stage for job: %r', harvest_job)
@@ -574,7 +1017,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         url = harvest_job.source.url
 
         try:
-            self._setup_csw_client(url)
+            csw = self._setup_csw_client(url)
         except Exception, e:
             self._save_gather_error('Error contacting the CSW server: %s' % e, harvest_job)
             return None
@@ -583,8 +1026,46 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         log.debug('Starting gathering for %s' % url)
         used_identifiers = []
         ids = []
+
+        # In incremental mode, only the records modified since the last
+        # harvest are listed, except for a periodic full listing that
+        # detects the deleted ones
+        gather_started = datetime.utcnow()
+        source_state = HarvestSourceState.get(harvest_job.source.id) or \
+                       HarvestSourceState(source_id=harvest_job.source.id)
+        constraint = None
+        incremental = asbool(config.get('ckan.spatial.harvest.csw_incremental', False))
+        if incremental:
+            full_gather_interval = timedelta(days=float(
+                config.get('ckan.spatial.harvest.csw_full_gather_interval', 7)))
+            if source_state.last_gathered and source_state.last_full_gather and \
+               gather_started - source_state.last_full_gather < full_gather_interval:
+                queryable = config.get('ckan.spatial.harvest.csw_modified_queryable',
+                                       'apiso:Modified')
+                constraint = modified_since_filter(source_state.last_gathered, queryable)
+                log.info('Gathering the records modified since %s' % source_state.last_gathered)
+            else:
+                log.info('Gathering all records')
+
+        timeout, max_size = self._get_fetch_limits()
         try:
-            for identifier in self.csw.getidentifiers(page=10):
+            if asbool(config.get('ckan.spatial.harvest.csw_full_records', False)):
+                # Get the whole records at once, so there is nothing left to
+                # do in the fetch stage
+                page = int(config.get('ckan.spatial.harvest.csw_full_records_page',
+                                      DEFAULT_FULL_RECORDS_PAGE))
+                records = csw.getrecords_xml(page=page, timeout=timeout,
+                                             max_size=max_size, constraint=constraint)
+            elif constraint is not None:
+                records = ((identifier, None) for identifier, brief_record in
+                           csw.getrecords_xml(esn='brief', timeout=timeout,
+                                              max_size=max_size, constraint=constraint))
+            else:
+                max_page = int(config.get('ckan.spatial.harvest.csw_max_page', DEFAULT_MAX_PAGE))
+                records = ((identifier, None) for identifier in
+                           csw.getidentifiers(page=10, max_page=max_page))
+
+            for identifier, content in records:
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier in used_identifiers:
@@ -596,8 +1077,10 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                         continue
 
                     # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=identifier, job=harvest_job)
+                    obj = HarvestObject(guid=identifier, job=harvest_job,
+                                        content=content)
                     obj.save()
+                    stats.count('objects')
 
                     ids.append(obj.id)
                     used_identifiers.append(identifier)
@@ -610,19 +1093,127 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
+        if constraint is None:
+            if incremental:
+                self._report_deleted(used_identifiers, harvest_job)
+            source_state.last_full_gather = gather_started
+        # The records gathered now are only left out of the following
+        # incremental listings once they are all imported without errors
+        # (see _promote_gathered)
+        if harvest_job.gather_errors:
+            source_state.pending_gathered = None
+            source_state.pending_job_id = None
+            source_state.pending_objects = None
+        elif ids:
+            source_state.pending_gathered = gather_started
+            source_state.pending_job_id = harvest_job.id
+            source_state.pending_objects = len(ids)
+        else:
+            source_state.last_gathered = gather_started
+        source_state.save()
+
         if len(ids) == 0:
+            if constraint is not None:
+                log.info('No records modified since the last harvest')
+                return []
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
 
         return ids
 
+    def _report_deleted(self, identifiers, harvest_job):
+        '''
+        Reports the datasets harvested from the source whose records were not
+        listed by the CSW server. Each of them is only reported once (unless
+        its record is listed again later), and not as a gather error, as
+        the job would then be considered failed (see _promote_gathered).
+        '''
+        if not identifiers:
+            return
+        identifiers = set(identifiers)
+        source_id = harvest_job.source.id
+        reported = dict((record.harvest_object_id, record) for record in
+                        Session.query(HarvestRemovedRecord) \
+                        .filter(HarvestRemovedRecord.source_id==source_id))
+        current_objects = Session.query(HarvestObject.id, HarvestObject.guid, HarvestObject.package_id) \
+                          .join(HarvestObject.job) \
+                          .filter(HarvestObject.current==True) \
+                          .filter(HarvestJob.source_id==source_id)
+        for object_id, guid, package_id in current_objects:
+            if guid in identifiers:
+                if object_id in reported:
+                    log.info('Record %s is listed by the CSW server again' % guid)
+                    reported[object_id].delete()
+            elif not object_id in reported:
+                log.warning('Record %s was removed from the CSW server, dataset %s '
+                            'should be deleted' % (guid, package_id))
+                stats.count('removed')
+                Session.add(HarvestRemovedRecord(object_id, source_id, harvest_job.id))
+        Session.commit()
+
+    @stats.job_stage('import')
+    def import_stage(self, harvest_object):
+        result = super(GeminiCswHarvester, self).import_stage(harvest_object)
+        if harvest_object:
+            self._promote_gathered([harvest_object])
+        return result
+
+    @stats.job_stage('import')
+    def import_stage_batch(self, harvest_objects):
+        imported = super(GeminiCswHarvester, self).import_stage_batch(harvest_objects)
+        if harvest_objects:
+            self._promote_gathered(harvest_objects)
+        return imported
+
+    def _promote_gathered(self, harvest_objects):
+        '''
+        Counts the given objects (of the same job) as imported. Once all the
+        objects gathered by the job have been imported without errors, the
+        time since which the records are listed in incremental mode is moved
+        to the start of the gather stage of the job. If any of them failed,
+        it is left where it was, otherwise the records of the objects that
+        failed would not be listed again until the next full gather.
+        '''
+        harvest_job = harvest_objects[0].job
+        # Locked until committed, as the objects may be imported concurrently
+        source_state = Session.query(HarvestSourceState).with_lockmode('update') \
+                       .populate_existing().get(harvest_job.source.id)
+        if source_state is None or source_state.pending_job_id != harvest_job.id:
+            Session.commit()
+            return
+        failed = Session.query(HarvestObjectError) \
+                 .filter(HarvestObjectError.harvest_object_id.in_(
+                         [harvest_object.id for harvest_object in harvest_objects])) \
+                 .count()
+        if failed:
+            log.debug('Objects of job %s failed, records will still be listed '
+                      'from %s' % (harvest_job.id, source_state.last_gathered))
+            source_state.pending_gathered = None
+            source_state.pending_job_id = None
+            source_state.pending_objects = None
+        else:
+            source_state.pending_objects -= len(harvest_objects)
+            if source_state.pending_objects <= 0:
+                log.debug('All the objects of job %s were imported, records will be listed '
+                          'from %s' % (harvest_job.id, source_state.pending_gathered))
+                source_state.last_gathered = source_state.pending_gathered
+                source_state.pending_gathered = None
+                source_state.pending_job_id = None
+                source_state.pending_objects = None
+        source_state.save()
+
+    @stats.job_stage('fetch')
     def fetch_stage(self,harvest_object):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('GeminiCswHarvester fetch_stage for object: %r', harvest_object)
 
+        if harvest_object.content:
+            # The record was already got in the gather stage
+            return True
+
         url = harvest_object.source.url
         try:
-            self._setup_csw_client(url)
+            csw = self._setup_csw_client(url)
         except Exception, e:
             self._save_object_error('Error contacting the CSW server: %s' % e,
                                     harvest_object)
@@ -630,9 +1221,13 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
 
         identifier = harvest_object.guid
         try:
-            record = self.csw.getrecordbyid([identifier])
+            with stats.timer('fetch'):
+                record = csw.getrecordbyid_xml(identifier, *self._get_fetch_limits())
         except Exception, e:
-            self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
+            # The server may have changed, get its capabilities again next time
+            CswService.forget(url)
+            self._save_object_error('Error getting the CSW record with GUID %s [%r]' % \
+                                    (identifier, e), harvest_object)
             return False
 
         if record is None:
@@ -642,18 +1237,25 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
 
         try:
             # Save the fetch contents in the HarvestObject
-            harvest_object.content = record['xml']
+            harvest_object.content = record
             harvest_object.save()
         except Exception,e:
             self._save_object_error('Error saving the harvest object for GUID %s [%r]' % \
                                     (identifier, e), harvest_object)
             return False
 
-        log.debug('XML content saved (len %s)', len(record['xml']))
+        log.debug('XML content saved (len %s)', len(record))
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        '''
+        Returns a CSW client for the URL. The capabilities of the server are
+        requested once and shared by the gather and fetch stages of this
+        process for ckan.spatial.harvest.csw_client_ttl seconds.
+        '''
+        ttl = int(config.get('ckan.spatial.harvest.csw_client_ttl', DEFAULT_CLIENT_TTL))
+        self.csw = CswService.cached(url, ttl)
+        return self.csw
 
 
 class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
@@ -662,6 +1264,7 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
     '''
 
     implements(IHarvester)
+    implements(IConfigurable)
 
     def info(self):
         return {
@@ -670,6 +1273,7 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A single GEMINI 2.1 document'
             }
 
+    @stats.job_stage('gather')
     def gather_stage(self,harvest_job):
         log = logging.getLogger(__name__ + '.individual.gather')
         log.debug('GeminiDocHarvester gather_stage for job: %r', harvest_job)
@@ -679,28 +1283,24 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
         # Get source URL
         url = harvest_job.source.url
 
+        url_state = self._get_url_states(harvest_job).get(url)
+
         # Get contents
         try:
-            content = self._get_content(url)
+            response = self._get_content_conditional(url, self._get_validators(url_state))
         except Exception,e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
         try:
-            # We need to extract the guid to pass it to the next stage
-            gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
-
-            if gemini_guid:
-                # Create a new HarvestObject for this identifier
-                # Generally the content will be set in the fetch stage, but as we alredy
-                # have it, we might as well save a request
-                obj = HarvestObject(guid=gemini_guid,
-                                    job=harvest_job,
-                                    content=gemini_string)
-                obj.save()
+            obj = self._create_object_from_response(url, response, url_state, harvest_job)
 
-                log.info('Got GUID %s' % gemini_guid)
+            if obj:
+                log.info('Got GUID %s' % obj.guid)
                 return [obj.id]
+            elif response[0] is None:
+                log.info('Document %s not modified since the last harvest' % url)
+                return []
             else:
                 self._save_gather_error('Could not get the GUID for source %s' % url, harvest_job)
                 return None
@@ -723,6 +1323,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
     '''
 
     implements(IHarvester)
+    implements(IConfigurable)
 
     def info(self):
         return {
@@ -731,6 +1332,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A Web Accessible Folder (WAF) displaying a list of GEMINI 2.1 documents'
             }
 
+    @stats.job_stage('gather')
     def gather_stage(self,harvest_job):
         log = logging.getLogger(__name__ + '.WAF.gather')
         log.debug('GeminiWafHarvester gather_stage for job: %r', harvest_job)
@@ -749,33 +1351,69 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             return None
 
         ids = []
+        unmodified = 0
+        deleted = 0
         try:
-            for url in self._extract_urls(content,url):
-                try:
-                    content = self._get_content(url)
-                except Exception, e:
-                    msg = 'Couldn\'t harvest WAF link: %s: %s' % (url, e)
+            entries = self._extract_entries(content,url)
+            url_states = self._get_url_states(harvest_job)
+            current_urls = self._get_current_urls(harvest_job)
+            # The url states are bound to the session, which is committed
+            # while the documents are downloaded, so the threads only get
+            # a copy of their validators
+            validators = dict((state_url, self._get_validators(url_state))
+                              for state_url, url_state in url_states.iteritems())
+
+            # Only fetch the documents that are new or whose modification
+            # date or size changed in the listing
+            urls = []
+            listing = {}
+            for entry_url, modified, size in entries:
+                listing[entry_url] = (modified, size)
+                url_state = url_states.get(entry_url)
+                if modified and url_state \
+                   and url_state.listing_modified == modified \
+                   and url_state.listing_size == size \
+                   and entry_url in current_urls:
+                    unmodified += 1
+                else:
+                    urls.append(entry_url)
+            log.debug('%i of %i documents listed in the WAF have changed' % \
+                      (len(urls), len(entries)))
+            stats.count('unmodified_in_listing', len(entries) - len(urls))
+
+            # Documents that are no longer listed
+            if entries:
+                for url_state in url_states.values():
+                    if not url_state.url in listing:
+                        self._report_deleted(url_state, harvest_job)
+                        deleted += 1
+
+            # Documents are downloaded concurrently, but parsed, validated
+            # and saved in the same order as they are listed
+            workers = int(config.get('ckan.spatial.harvest.fetch_workers', DEFAULT_WORKERS))
+            workers_per_host = int(config.get('ckan.spatial.harvest.fetch_workers_per_host',
+                                              DEFAULT_WORKERS_PER_HOST))
+            get_document = lambda document_url: \
+                    self._get_content_conditional(document_url, validators.get(document_url))
+            for document_url, response, error in fetch_all(urls, get_document,
+                                                           workers, workers_per_host):
+                if error:
+                    msg = 'Couldn\'t harvest WAF link: %s: %s' % (document_url, error)
                     self._save_gather_error(msg,harvest_job)
                     continue
                 else:
-                    # We need to extract the guid to pass it to the next stage
                     try:
-                        gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
-                        if gemini_guid:
-                            log.debug('Got GUID %s' % gemini_guid)
-                            # Create a new HarvestObject for this identifier
-                            # Generally the content will be set in the fetch stage, but as we alredy
-                            # have it, we might as well save a request
-                            obj = HarvestObject(guid=gemini_guid,
-                                                job=harvest_job,
-                                                content=gemini_string)
-                            obj.save()
-
+                        obj = self._create_object_from_response(document_url, response,
+                                                                url_states.get(document_url),
+                                                                harvest_job,
+                                                                listing[document_url])
+                        if obj:
                             ids.append(obj.id)
-
+                        else:
+                            unmodified += 1
 
                     except Exception,e:
-                        msg = 'Could not get GUID for source %s: %r' % (url,e)
+                        msg = 'Could not get GUID for source %s: %r' % (document_url,e)
                         self._save_gather_error(msg,harvest_job)
                         continue
         except Exception,e:
@@ -786,6 +1424,9 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
 
         if len(ids) > 0:
             return ids
+        elif unmodified or deleted:
+            log.info('No documents modified since the last harvest')
+            return []
         else:
             self._save_gather_error('Couldn\'t find any links to metadata files',
                                      harvest_job)
@@ -796,20 +1437,51 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
         return True
 
 
+    def _report_deleted(self, url_state, harvest_job):
+        '''
+        Reports a document that was harvested from the WAF before but is
+        no longer listed, and forgets about it.
+        '''
+        previous_object = HarvestObject.get(url_state.harvest_object_id) \
+                          if url_state.harvest_object_id else None
+        if previous_object and previous_object.package_id:
+            msg = 'Document %s was removed from the WAF, dataset %s (GUID %s) ' \
+                  'should be deleted' % (url_state.url, previous_object.package_id,
+                                         previous_object.guid)
+            log.info(msg)
+            self._save_gather_error(msg, harvest_job)
+        else:
+            log.info('Document %s was removed from the WAF' % url_state.url)
+
+        url_state.delete()
+        url_state.commit()
+
     def _extract_urls(self, content, base_url):
         '''
         Get the URLs out of a WAF index page
         '''
+        return [url for url, modified, size in
+                self._extract_entries(content, base_url)]
+
+    def _extract_entries(self, content, base_url):
+        '''
+        Get the entries out of a WAF index page.
+
+        Returns a list of (url, modified, size) tuples. If the index is an
+        Apache-style listing, modified and size are the strings shown in its
+        "Last modified" and "Size" columns, otherwise they are None.
+        '''
         try:
             parser = etree.HTMLParser()
-            tree = etree.fromstring(content, parser=parser)
+            with stats.timer('parse'):
+                tree = etree.fromstring(content, parser=parser)
         except Exception, inst:
             msg = 'Couldn''t parse content into a tree: %s: %s' \
                   % (inst, content)
             raise Exception(msg)
-        urls = []
-        for url in tree.xpath('//a/@href'):
-            url = url.strip()
+        entries = []
+        for anchor in tree.xpath('//a[@href]'):
+            url = anchor.get('href').strip()
             if not url:
                 continue
             if '?' in url:
@@ -825,13 +1497,146 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
                 log.debug('Ignoring link in WAF because it has "mailto:": %s', url)
                 continue
             log.debug('WAF contains file: %s', url)
-            urls.append(url)
+            modified, size = self._extract_listing_columns(anchor)
+            entries.append((url, modified, size))
         base_url = base_url.rstrip('/').split('/')
         if 'index' in base_url[-1]:
             base_url.pop()
         base_url = '/'.join(base_url)
         base_url += '/'
         log.debug('WAF base URL: %s', base_url)
-        return [base_url + i for i in urls]
+        return [(base_url + entry_url, modified, size)
+                for entry_url, modified, size in entries]
+
+    def _extract_listing_columns(self, anchor):
+        '''
+        Get the modification date and size shown next to a link in an
+        Apache-style index, either in the following cells of a table row
+        or in the text following the link in a preformatted listing.
+        '''
+        cell = anchor.getparent()
+        if cell.tag == 'td':
+            text = ' '.join(' '.join(td.itertext()) for td in cell.itersiblings('td'))
+        else:
+            text = anchor.tail or ''
+        match = LISTING_COLUMNS_RE.match(text)
+        if not match:
+            return None, None
+        return match.group('modified'), match.group('size')
+
+
+class GeminiLocalHarvester(GeminiHarvester, SingletonPlugin):
+    '''
+    A Harvester for GEMINI documents in a local directory, or in a zip or
+    tar archive, e.g. for the initial load of a large number of documents.
+
+    The source URL is the path of the directory or archive (optionally
+    prefixed with file://), which must be inside the directory set in
+    ckan.spatial.harvest.local_root.
+    '''
+
+    implements(IHarvester)
+    implements(IConfigurable)
+
+    def info(self):
+        return {
+            'name': 'gemini-local',
+            'title': 'Local directory or archive - GEMINI',
+            'description': 'A directory, or a zip or tar archive, on the CKAN server containing GEMINI 2.1 documents'
+            }
+
+    def _get_local_path(self, url):
+        '''
+        Returns the absolute path of a source URL, checking that it is
+        inside the local root directory.
+        '''
+        root = config.get('ckan.spatial.harvest.local_root')
+        if not root:
+            raise Exception('Local harvesting is disabled, set ckan.spatial.harvest.local_root to enable it')
+        root = os.path.realpath(root)
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        path = os.path.realpath(os.path.join(root, url.strip()))
+        if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+            raise Exception('%s is not inside the local harvesting directory' % url)
+        if not os.path.exists(path):
+            raise Exception('%s does not exist' % url)
+        return path
+
+    @stats.job_stage('gather')
+    def gather_stage(self,harvest_job):
+        log = logging.getLogger(__name__ + '.local.gather')
+        log.debug('GeminiLocalHarvester gather_stage for job: %r', harvest_job)
+
+        self.harvest_job = harvest_job
+
+        try:
+            path = self._get_local_path(harvest_job.source.url)
+        except Exception, e:
+            self._save_gather_error('Unable to read %s: %s' % (harvest_job.source.url, e),
+                                    harvest_job)
+            return None
 
+        from ckanext.harvest.model import harvest_object_table
+        workers = int(config.get('ckan.spatial.harvest.local_workers', DEFAULT_LOCAL_WORKERS))
+        chunk_size = int(config.get('ckan.spatial.harvest.local_chunk_size',
+                                    DEFAULT_LOCAL_CHUNK_SIZE))
+        timeout, max_size = self._get_fetch_limits()
+        profiles = self._get_validator().profiles
 
+        ids = []
+        used_guids = set()
+        try:
+            # Documents are parsed and validated in a pool of processes,
+            # and their objects created in bulk, a chunk at a time
+            documents = iter_documents(path, max_size)
+            for results in parse_documents(documents, profiles, workers, chunk_size):
+                rows = []
+                for name, gemini_string, guid, validation, error in results:
+                    if error:
+                        self._save_gather_error('Error reading %s: %s' % (name, error),
+                                                harvest_job)
+                        continue
+                    # Keep the validation result for the import stage
+                    self._save_validation_result(self._validation_digest(gemini_string),
+                                                 validation)
+                    valid, messages = validation
+                    if not valid:
+                        out = messages[0] + ':\n' + '\n'.join(messages[1:])
+                        self._save_gather_error('Validation error for %s - %s' % (name, out),
+                                                harvest_job)
+                    if not guid:
+                        self._save_gather_error('Could not get the GUID of %s' % name,
+                                                harvest_job)
+                        continue
+                    if guid in used_guids:
+                        self._save_gather_error('GUID %s of %s already used, skipping...' % \
+                                                (guid, name), harvest_job)
+                        continue
+                    used_guids.add(guid)
+                    rows.append({'id': unicode(uuid.uuid4()),
+                                 'guid': guid,
+                                 'harvest_job_id': harvest_job.id,
+                                 'content': gemini_string})
+                if rows:
+                    with stats.timer('bulk_insert'):
+                        Session.execute(harvest_object_table.insert(), rows)
+                        Session.commit()
+                    stats.count('objects', len(rows))
+                    ids.extend(row['id'] for row in rows)
+                log.debug('Created %i harvest objects from %s' % (len(ids), path))
+        except Exception, e:
+            log.error('Exception: %s' % text_traceback())
+            self._save_gather_error('Error reading the documents in %s: %s' % \
+                                    (harvest_job.source.url, e), harvest_job)
+            return None
+
+        if not ids:
+            self._save_gather_error('No GEMINI documents found in %s' % harvest_job.source.url,
+                                    harvest_job)
+            return None
+        return ids
+
+    def fetch_stage(self,harvest_object):
+        # The documents were already read in the previous stage
+        return True
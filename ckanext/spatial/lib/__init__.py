@@ -1,10 +1,15 @@
+import time
 import logging
 from string import Template
 
-from ckan.model import Session, Package
+from ckan.model import Session, Member
 from ckan.lib.base import config
 
-from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model import PackageExtent, ActivePackageExtent, PackageExtentGeometry, \
+                                  PackageExtentPiece, PackageExtentHotRegion, PackageExtentHotRegionGeometry
+from ckanext.spatial.model.package_extent import get_geometry_id, intern_geometry, release_geometry, \
+                                                 rank_hot_regions, update_active_package_extent, \
+                                                 subdivide_enabled
 from shapely.geometry import asShape
 
 from geoalchemy import WKTSpatialElement
@@ -52,29 +57,45 @@ def save_package_extent(package_id, geometry = None, srid = None):
         if not srid:
             srid = db_srid
 
-        package_extent = PackageExtent(package_id=package_id,the_geom=WKTSpatialElement(shape.wkt, srid))
+        # Identical extents share the same geometry (and pieces), so the
+        # spatial predicates are only evaluated once for all of them
+        geometry_id = get_geometry_id(shape.wkt, srid)
+        package_extent = PackageExtent(package_id=package_id,geometry_id=geometry_id)
+
+    released_geometry_id = None
 
     # Check if extent exists
     if existing_package_extent:
 
         # If extent exists but we received no geometry, we'll delete the existing one
         if not geometry:
+            released_geometry_id = existing_package_extent.geometry_id
             existing_package_extent.delete()
             log.debug('Deleted extent for package %s' % package_id)
         else:
             # Check if extent changed
-            if Session.scalar(package_extent.the_geom.wkt) <> Session.scalar(existing_package_extent.the_geom.wkt):
+            if geometry_id != existing_package_extent.geometry_id:
                 # Update extent
-                existing_package_extent.the_geom = package_extent.the_geom
+                released_geometry_id = existing_package_extent.geometry_id
+                intern_geometry(geometry_id, shape.wkt, srid)
+                existing_package_extent.geometry_id = geometry_id
                 existing_package_extent.save()
                 log.debug('Updated extent for package %s' % package_id)
             else:
                 log.debug('Extent for package %s unchanged' % package_id)
     elif geometry:
         # Insert extent
+        intern_geometry(geometry_id, shape.wkt, srid)
         Session.add(package_extent)
         log.debug('Created new extent for package %s' % package_id)
 
+    Session.flush()
+    if released_geometry_id:
+        release_geometry(released_geometry_id)
+
+    # The package state may have changed as well
+    update_active_package_extent(package_id)
+
 def validate_bbox(bbox_values):
     '''
     Ensures a bbox is expressed in a standard dict.
@@ -138,16 +159,35 @@ def bbox_query(bbox,srid=None):
 
     bbox - bounding box dict
 
-    Returns a query object of PackageExtents, which each reference a package
-    by ID.
+    Returns a query object of ActivePackageExtents, which each reference a
+    package by ID.
     '''
 
+    hot_region = get_hot_region(bbox, srid)
+    if hot_region:
+        # Serve the precomputed results
+        matching_geometry_ids = Session.query(PackageExtentHotRegionGeometry.geometry_id) \
+                  .filter(PackageExtentHotRegionGeometry.region_name==hot_region.name) \
+                  .subquery()
+        return Session.query(ActivePackageExtent) \
+                  .filter(ActivePackageExtent.geometry_id.in_(matching_geometry_ids))
+
     input_geometry = _bbox_2_wkt(bbox, srid)
 
-    extents = Session.query(PackageExtent) \
-              .filter(PackageExtent.package_id==Package.id) \
-              .filter(PackageExtent.the_geom.intersects(input_geometry)) \
-              .filter(Package.state==u'active')
+    # The intersects test is run once per distinct geometry, against its
+    # subdivided pieces if enabled, which are much cheaper to check than
+    # complex geometries
+    if subdivide_enabled():
+        matching_geometry_ids = Session.query(PackageExtentPiece.geometry_id) \
+                  .filter(PackageExtentPiece.the_geom.intersects(input_geometry)) \
+                  .distinct().subquery()
+    else:
+        matching_geometry_ids = Session.query(PackageExtentGeometry.id) \
+                  .filter(PackageExtentGeometry.the_geom.intersects(input_geometry)) \
+                  .subquery()
+
+    extents = Session.query(ActivePackageExtent) \
+              .filter(ActivePackageExtent.geometry_id.in_(matching_geometry_ids))
     return extents
 
 def bbox_query_ordered(bbox, srid=None):
@@ -161,6 +201,20 @@ def bbox_query_ordered(bbox, srid=None):
     by ID.
     '''
 
+    hot_region = get_hot_region(bbox, srid)
+    if hot_region:
+        # Serve the precomputed results
+        sql = """SELECT ST_AsBinary(package_extent_geometry.the_geom) AS package_extent_the_geom,
+                        hot_region.spatial_ranking AS spatial_ranking,
+                        active_package_extent.package_id AS package_id
+                 FROM package_extent_hot_region_geometry AS hot_region,
+                      package_extent_geometry, active_package_extent
+                 WHERE hot_region.region_name = :region_name
+                    AND package_extent_geometry.id = hot_region.geometry_id
+                    AND active_package_extent.geometry_id = hot_region.geometry_id
+                 ORDER BY spatial_ranking desc"""
+        return Session.execute(sql, {'region_name': hot_region.name}).fetchall()
+
     input_geometry = _bbox_2_wkt(bbox, srid)
 
     params = {'query_bbox': str(input_geometry),
@@ -171,15 +225,291 @@ def bbox_query_ordered(bbox, srid=None):
     params['search_area'] = Session.execute(sql, params).fetchone()[0]
 
     # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear)
-    sql = """SELECT ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
-                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(package_extent.the_geom)/:search_area as spatial_ranking,
-                    package_extent.package_id AS package_id
-             FROM package_extent, package
-             WHERE package_extent.package_id = package.id
-                AND ST_Intersects(package_extent.the_geom, GeomFromText(:query_bbox, :query_srid))
-                AND package.state = 'active'
-             ORDER BY spatial_ranking desc"""
+    # The intersects test is run against the subdivided pieces if enabled,
+    # the exact geometry is only used for the ranking. Both are computed
+    # once per distinct geometry and then applied to all the packages
+    # sharing it.
+    if subdivide_enabled():
+        intersects = """id IN (
+                       SELECT DISTINCT geometry_id FROM package_extent_subdivided
+                       WHERE ST_Intersects(the_geom, GeomFromText(:query_bbox, :query_srid)))"""
+    else:
+        intersects = "ST_Intersects(the_geom, GeomFromText(:query_bbox, :query_srid))"
+    sql = """SELECT ST_AsBinary(geometries.the_geom) AS package_extent_the_geom,
+                    geometries.spatial_ranking AS spatial_ranking,
+                    active_package_extent.package_id AS package_id
+             FROM (SELECT id, the_geom,
+                          POWER(ST_Area(ST_Intersection(the_geom, GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(the_geom)/:search_area as spatial_ranking
+                   FROM package_extent_geometry
+                   WHERE %s
+                  ) AS geometries, active_package_extent
+             WHERE active_package_extent.geometry_id = geometries.id
+             ORDER BY spatial_ranking desc""" % intersects
     extents = Session.execute(sql, params).fetchall()
     log.debug('Spatial results: %r',
               [('%.2f' % extent.spatial_ranking, extent.package_id) for extent in extents[:20]])
     return extents
+
+DEFAULT_HOT_REGIONS_PRECISION = 2
+
+def get_hot_regions_config():
+    '''
+    Returns the hot regions defined in the config, as a dict of bounding box
+    dicts keyed by region name.
+
+    Hot regions are defined in ckan.spatial.hot_regions as a whitespace
+    separated list of <name>:<minx>,<miny>,<maxx>,<maxy> values. The
+    default map extent (ckan.spatial.default_map_extent), if defined, is
+    always included as the "default" region.
+    '''
+    regions = {}
+    default_extent = config.get('ckan.spatial.default_map_extent')
+    if default_extent:
+        regions['default'] = validate_bbox(default_extent)
+    for region in config.get('ckan.spatial.hot_regions', '').split():
+        name, sep, bbox_values = region.partition(':')
+        bbox = validate_bbox(bbox_values)
+        if not name or not bbox:
+            log.error('Wrong hot region definition: %s' % region)
+            continue
+        regions[name] = bbox
+    return dict((name, bbox) for name, bbox in regions.iteritems() if bbox)
+
+def update_hot_regions():
+    '''
+    Stores the hot regions defined in the config (see
+    get_hot_regions_config) and precomputes the results of the spatial
+    queries of their bounding boxes, which will be served by bbox_query
+    and bbox_query_ordered from then on.
+
+    Results are kept up to date when package extents change.
+
+    Returns the number of regions stored.
+    '''
+    regions = get_hot_regions_config()
+
+    Session.execute('DELETE FROM package_extent_hot_region')
+    for name, bbox in regions.iteritems():
+        hot_region = PackageExtentHotRegion()
+        hot_region.name = unicode(name)
+        hot_region.minx = bbox['minx']
+        hot_region.miny = bbox['miny']
+        hot_region.maxx = bbox['maxx']
+        hot_region.maxy = bbox['maxy']
+        Session.add(hot_region)
+    Session.flush()
+    rank_hot_regions()
+    Session.commit()
+
+    log.info('Precomputed results for hot regions: %s' % ', '.join(regions.keys()))
+    return len(regions)
+
+def _quantize_bbox(bbox):
+    precision = int(config.get('ckan.spatial.hot_regions.precision',
+                               DEFAULT_HOT_REGIONS_PRECISION))
+    return tuple(round(bbox[key], precision) for key in ('minx', 'miny', 'maxx', 'maxy'))
+
+def get_hot_region(bbox, srid=None):
+    '''
+    Returns the hot region with precomputed results that matches the
+    provided bounding box (after rounding the coordinates to
+    ckan.spatial.hot_regions.precision decimals), or None.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    if srid and srid != db_srid:
+        return None
+
+    quantized_bbox = _quantize_bbox(bbox)
+    for hot_region in Session.query(PackageExtentHotRegion):
+        hot_region_bbox = {'minx': hot_region.minx, 'miny': hot_region.miny,
+                           'maxx': hot_region.maxx, 'maxy': hot_region.maxy}
+        if _quantize_bbox(hot_region_bbox) == quantized_bbox:
+            log.debug('Serving spatial query for %r from hot region %s', bbox, hot_region.name)
+            return hot_region
+    return None
+
+DEFAULT_HISTOGRAM_SIZE = 32
+
+def update_extent_histogram(size=None):
+    '''
+    Recomputes the extent histogram used to estimate the selectivity of
+    spatial queries (see estimate_bbox_query).
+
+    The area covered by the extents of all active packages is divided in a
+    grid of size x size cells, and for each cell the number of extents whose
+    bounding box centre falls in it is stored, along with the average and
+    maximum width and height of these bounding boxes.
+
+    Returns the number of extents counted.
+    '''
+    size = int(size or config.get('ckan.spatial.histogram.size', DEFAULT_HISTOGRAM_SIZE))
+
+    active_extents = """SELECT ST_XMin(the_geom) AS minx,
+                               ST_YMin(the_geom) AS miny,
+                               ST_XMax(the_geom) AS maxx,
+                               ST_YMax(the_geom) AS maxy
+                        FROM active_package_extent, package_extent_geometry
+                        WHERE active_package_extent.geometry_id = package_extent_geometry.id"""
+
+    Session.execute('DELETE FROM package_extent_histogram')
+
+    bounds = Session.execute("""SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy)
+                                FROM (%s) AS extents""" % active_extents).fetchone()
+    if bounds[0] is None:
+        Session.commit()
+        return 0
+    minx, miny, maxx, maxy = bounds
+    cell_width = (maxx - minx) / size
+    cell_height = (maxy - miny) / size
+
+    params = {'minx': minx, 'miny': miny,
+              'cell_width': cell_width or 1, 'cell_height': cell_height or 1,
+              'last_cell': size - 1}
+    cells = Session.execute("""SELECT LEAST(FLOOR(((minx + maxx) / 2 - :minx) / :cell_width), :last_cell) AS x,
+                                      LEAST(FLOOR(((miny + maxy) / 2 - :miny) / :cell_height), :last_cell) AS y,
+                                      COUNT(*) AS count,
+                                      AVG(maxx - minx) AS avg_width,
+                                      AVG(maxy - miny) AS avg_height,
+                                      MAX(maxx - minx) AS max_width,
+                                      MAX(maxy - miny) AS max_height
+                               FROM (%s) AS extents
+                               GROUP BY 1, 2""" % active_extents, params).fetchall()
+    total = 0
+    for cell in cells:
+        Session.execute("""INSERT INTO package_extent_histogram
+                              (minx, miny, maxx, maxy, count, avg_width, avg_height, max_width, max_height)
+                           VALUES (:minx, :miny, :maxx, :maxy, :count, :avg_width, :avg_height, :max_width, :max_height)""",
+                        {'minx': minx + cell.x * cell_width,
+                         'miny': miny + cell.y * cell_height,
+                         'maxx': minx + (cell.x + 1) * cell_width,
+                         'maxy': miny + (cell.y + 1) * cell_height,
+                         'count': cell.count,
+                         'avg_width': cell.avg_width,
+                         'avg_height': cell.avg_height,
+                         'max_width': cell.max_width,
+                         'max_height': cell.max_height})
+        total += cell.count
+    Session.commit()
+
+    global _histogram
+    _histogram = None
+
+    log.info('Extent histogram updated with %i extents in %i cells' % (total, len(cells)))
+    return total
+
+_histogram = None
+_histogram_loaded = 0
+
+def _get_extent_histogram():
+    global _histogram, _histogram_loaded
+    ttl = int(config.get('ckan.spatial.histogram.ttl', 300))
+    if _histogram is None or time.time() - _histogram_loaded > ttl:
+        _histogram = Session.execute('''SELECT minx, miny, maxx, maxy, count,
+                                               avg_width, avg_height, max_width, max_height
+                                        FROM package_extent_histogram''').fetchall()
+        _histogram_loaded = time.time()
+    return _histogram
+
+def _overlap(cell_min, cell_max, query_min, query_max):
+    '''Fraction of the [cell_min, cell_max] interval inside the query one'''
+    if cell_max == cell_min:
+        return 1.0 if query_min <= cell_min <= query_max else 0.0
+    overlap = min(cell_max, query_max) - max(cell_min, query_min)
+    return max(overlap, 0.0) / (cell_max - cell_min)
+
+def estimate_bbox_query(bbox):
+    '''
+    Estimates how many extents a spatial query of the bounding box would
+    match, using the extent histogram (see update_extent_histogram).
+
+    bbox - bounding box dict, in the DB srid
+
+    Returns a tuple with the estimated number of matches, the total
+    number of extents (which is 0 if the histogram has not been computed)
+    and whether the bounding box is known to contain all the extents.
+    '''
+    estimate = 0.0
+    total = 0
+    covers_all = True
+    for cell in _get_extent_histogram():
+        total += cell.count
+        covers_all = covers_all and \
+            bbox['minx'] <= cell.minx - cell.max_width / 2 and \
+            bbox['miny'] <= cell.miny - cell.max_height / 2 and \
+            bbox['maxx'] >= cell.maxx + cell.max_width / 2 and \
+            bbox['maxy'] >= cell.maxy + cell.max_height / 2
+        # An extent intersects the query box if its centre is inside the
+        # query box grown by half the extent size
+        fraction = _overlap(cell.minx, cell.maxx,
+                            bbox['minx'] - cell.avg_width / 2,
+                            bbox['maxx'] + cell.avg_width / 2) * \
+                   _overlap(cell.miny, cell.maxy,
+                            bbox['miny'] - cell.avg_height / 2,
+                            bbox['maxy'] + cell.avg_height / 2)
+        estimate += cell.count * fraction
+    return int(round(estimate)), total, covers_all and total > 0
+
+def _all_extents_within(bbox):
+    '''Returns whether the bounding boxes of all the stored geometries are
+    within the provided bounding box (in the DB srid)'''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    input_geometry = _bbox_2_wkt(bbox, db_srid)
+    return Session.execute('''SELECT 1 FROM package_extent_geometry
+                              WHERE NOT (the_geom @ GeomFromText(:query_bbox, :query_srid))
+                              LIMIT 1''',
+                           {'query_bbox': str(input_geometry),
+                            'query_srid': db_srid}).first() is None
+
+def bbox_query_has_private(extents):
+    '''
+    Returns whether any of the packages matched by a spatial query (see
+    bbox_query) is in a group with private capacity, which excludes it from
+    the searches unless they filter by capacity explicitly.
+    '''
+    package_ids = Session.query(extents.subquery().c.package_id).subquery()
+    return Session.query(Member) \
+                  .filter(Member.table_name=='package') \
+                  .filter(Member.capacity=='private') \
+                  .filter(Member.state=='active') \
+                  .filter(Member.table_id.in_(package_ids)) \
+                  .first() is not None
+
+def plan_bbox_query(bbox, search_params):
+    '''
+    Decides how to apply a bounding box filter to a dataset search.
+
+    Returns one of:
+        'world' - The bounding box contains all extents (or is estimated to
+                  match more than ckan.spatial.query_plan.world_selectivity
+                  of them, if set), so it is enough to filter the datasets
+                  that have a spatial extent, without running the spatial
+                  query.
+        'count' - Only the number of results is needed and the search has
+                  no other filters, so it can be obtained straight from the
+                  spatial query (unless some of the matching datasets are
+                  private, see bbox_query_has_private).
+        'index' - Run the spatial query and filter the search by the ids
+                  of the matching datasets.
+    '''
+    estimate, total, covers_all = estimate_bbox_query(bbox)
+    world_selectivity = config.get('ckan.spatial.query_plan.world_selectivity')
+
+    # Other extras may be used by other plugins to filter the search
+    other_extras = [key for key, value in search_params.get('extras', {}).iteritems()
+                    if value and key != 'ext_bbox']
+
+    # Extents may have been added outside the bounding box since the
+    # histogram was updated
+    if (covers_all and _all_extents_within(bbox)) or \
+        (total and world_selectivity and float(estimate) / total >= float(world_selectivity)):
+        plan = 'world'
+    elif 'rows' in search_params and int(search_params['rows']) == 0 \
+        and not search_params.get('q') and not search_params.get('fq') \
+        and not search_params.get('facet.field') and not other_extras:
+        plan = 'count'
+    else:
+        plan = 'index'
+
+    log.debug('Spatial query plan for %r: %s (estimated %i out of %i extents)',
+              bbox, plan, estimate, total)
+    return plan
@@ -0,0 +1,159 @@
+'''
+Benchmark of the GEMINI harvesting pipeline over a local corpus, without
+any requests to remote servers or writes to the database.
+'''
+import cProfile
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from lxml import etree
+
+from ckanext.spatial import harvesters
+from ckanext.spatial.harvesters import GeminiHarvester
+from ckanext.spatial.model import GeminiDocument
+from ckanext.spatial.lib import stats
+
+log = logging.getLogger(__name__)
+
+METADATA_TAG = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
+
+class BenchHarvestObject(object):
+    '''Stands for the harvest object of a document of the corpus'''
+
+    source = None
+
+    def __init__(self, content):
+        self.id = u'bench'
+        self.guid = None
+        self.content = content
+
+class BenchHarvester(GeminiHarvester):
+    '''
+    A GEMINI harvester that runs import_gemini_object without the database
+    or the resources of services: the documents are never taken as
+    unchanged, the validation results are not reused (the copies of the
+    corpus would only be validated once) and the package dict is built
+    but not written.
+    '''
+
+    def _is_wms(self, url):
+        return False
+
+    def _is_unchanged(self, digest):
+        return False
+
+    def _save_digest(self, digest):
+        pass
+
+    def _get_stored_validation_result(self, digest):
+        return None
+
+    def _save_validation_result(self, digest, result):
+        pass
+
+    def _save_object_error(self, message, obj, stage=u'Fetch'):
+        log.debug('%s error: %s' % (stage, message))
+        self.obj.invalid = True
+
+    @contextmanager
+    def _guid_lock(self, guid):
+        yield
+
+    def write_package_from_gemini_string(self, content, xml_tree=None):
+        with stats.timer('extract'):
+            gemini_values = GeminiDocument(content, xml_tree).read_values()
+        with stats.timer('package_dict'):
+            return self.get_package_dict(gemini_values, self.obj.id)
+
+def find_documents(path):
+    '''Returns the paths of the XML files in a directory and its subdirectories'''
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.xml'):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+def read_document(path):
+    '''
+    Returns the GEMINI document of an XML file as the content of a harvest
+    object, i.e. without the CSW response wrapping it, if any.
+    '''
+    with open(path, 'rb') as f:
+        content = f.read()
+    xml = etree.fromstring(content)
+    if xml.tag == METADATA_TAG:
+        return content
+    xml = xml.find('.//' + METADATA_TAG)
+    if xml is None:
+        raise ValueError('Not a GEMINI document: %s' % path)
+    return etree.tostring(xml)
+
+def process_document(harvester, content):
+    '''
+    Runs a document through GeminiHarvester.import_gemini_object with a
+    stub harvest object (see BenchHarvester): parse, digest, validate,
+    extract and package_dict.
+
+    Returns whether the document was valid.
+    '''
+    harvester.obj = BenchHarvestObject(content)
+    harvester.obj.invalid = False
+    harvester.import_gemini_object(content)
+    return not harvester.obj.invalid
+
+def run_benchmark(path, copies=1, profile=None):
+    '''
+    Runs the XML files found in path (replicated the given number of times)
+    through the harvesting pipeline, see process_document.
+
+    If profile is a file name, the run is profiled with cProfile and the
+    profile is saved to it.
+
+    Returns a dict with the number of documents, the invalid ones and the
+    errors, the elapsed seconds, the documents per second and the summary
+    of the timings of each step (see stats.summarize).
+    '''
+    paths = find_documents(path)
+    contents = [(document_path, read_document(document_path))
+                for document_path in paths]
+    log.info('Benchmarking %i documents, %i times' % (len(contents), copies))
+
+    # Documents validated before in this process would not be validated again
+    harvesters._validation_results.clear()
+    harvester = BenchHarvester()
+    profiler = cProfile.Profile() if profile else None
+    invalid = errors = 0
+    started = time.time()
+    with stats.collect(None, u'bench') as bench_stats:
+        if profiler:
+            profiler.enable()
+        try:
+            for i in range(copies):
+                for document_path, content in contents:
+                    try:
+                        if not process_document(harvester, content):
+                            invalid += 1
+                    except Exception, e:
+                        log.debug('Error processing %s: %r' % (document_path, e))
+                        errors += 1
+        finally:
+            if profiler:
+                profiler.disable()
+    elapsed = time.time() - started
+
+    if profiler:
+        profiler.dump_stats(profile)
+
+    documents = len(contents) * copies
+    return {
+        'documents': documents,
+        'invalid': invalid,
+        'errors': errors,
+        'seconds': elapsed,
+        'documents_per_second': documents / elapsed if elapsed else 0,
+        'steps': stats.summarize(bench_stats.samples),
+    }
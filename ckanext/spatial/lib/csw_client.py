@@ -3,19 +3,117 @@ Some very thin wrapper classes around those in OWSLib
 for convenience.
 """
 
+import copy
 import logging
+import threading
+import time
+import urllib
 
+from lxml import etree as lxml_etree
 from owslib.etree import etree
 
+from ckanext.spatial.lib.fetch import call, open_url, DEFAULT_TIMEOUT, DEFAULT_MAX_SIZE
+
 log = logging.getLogger(__name__)
 
+DEFAULT_CLIENT_TTL = 3600
+DEFAULT_FULL_RECORDS_PAGE = 100
+DEFAULT_MAX_PAGE = 500
+# Response time (in seconds) aimed for when adapting the page size
+DEFAULT_PAGE_TARGET_TIME = 5.0
+
+CSW_NAMESPACE = 'http://www.opengis.net/cat/csw/2.0.2'
+GMD_NAMESPACE = 'http://www.isotc211.org/2005/gmd'
+OGC_NAMESPACE = 'http://www.opengis.net/ogc'
+APISO_NAMESPACE = 'http://www.opengis.net/cat/csw/apiso/1.0'
+GCO_NAMESPACE = 'http://www.isotc211.org/2005/gco'
+OWS_NAMESPACE = 'http://www.opengis.net/ows'
+
 class CswError(Exception):
     pass
 
+def modified_since_filter(date, queryable='apiso:Modified'):
+    """
+    Returns an OGC Filter (as an lxml element) matching the records whose
+    queryable is equal to or later than the given datetime.
+    """
+    nsmap = {'ogc': OGC_NAMESPACE, 'apiso': APISO_NAMESPACE}
+    ogc_filter = lxml_etree.Element('{%s}Filter' % OGC_NAMESPACE, nsmap=nsmap)
+    comparison = lxml_etree.SubElement(ogc_filter,
+                    '{%s}PropertyIsGreaterThanOrEqualTo' % OGC_NAMESPACE)
+    lxml_etree.SubElement(comparison, '{%s}PropertyName' % OGC_NAMESPACE).text = queryable
+    lxml_etree.SubElement(comparison, '{%s}Literal' % OGC_NAMESPACE).text = \
+            date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return ogc_filter
+
+class _Prefetch(object):
+    """
+    Calls a function in a background thread, keeping its result (or the
+    exception it raised) until it is asked for.
+    """
+    def __init__(self, function, *args):
+        self._function = function
+        self._args = args
+        self._result = self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._function(*self._args)
+        except Exception, e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error:
+            raise self._error
+        return self._result
+
 class OwsService(object):
+
+    # Clients cached per (class, endpoint), with the time they were created
+    _clients = {}
+    _clients_lock = threading.Lock()
+    _endpoint_locks = {}
+
     def __init__(self, endpoint=None):
         if endpoint is not None:
             self._ows(endpoint)
+
+    @classmethod
+    def cached(cls, endpoint, ttl=DEFAULT_CLIENT_TTL):
+        """
+        Returns a service for the endpoint, reusing the capabilities
+        requested by a previous call in this process during the last ttl
+        seconds.
+
+        Each call gets its own copy of the cached client, so services
+        returned to different threads can be used concurrently.
+        """
+        key = (cls, endpoint)
+        with cls._clients_lock:
+            endpoint_lock = cls._endpoint_locks.setdefault(key, threading.Lock())
+        # Only one thread requests the capabilities of an endpoint
+        with endpoint_lock:
+            cached = cls._clients.get(key)
+            if cached is None or time.time() - cached[1] > ttl:
+                log.debug('Requesting the capabilities of %s', endpoint)
+                cached = (call(endpoint, cls._Implementation, endpoint), time.time())
+                cls._clients[key] = cached
+        service = cls()
+        service.__ows_obj__ = copy.copy(cached[0])
+        return service
+
+    @classmethod
+    def forget(cls, endpoint):
+        """
+        Removes the cached client for the endpoint, eg if its capabilities
+        may have changed.
+        """
+        with cls._clients_lock:
+            cls._clients.pop((cls, endpoint), None)
             
     def __call__(self, args):
         return getattr(self, args.operation)(**self._xmd(args))
@@ -80,7 +178,7 @@ class CswService(OwsService):
             "outputschema": namespaces[outputschema],
             }
         log.info('Making CSW request: getrecords %r', kwa)
-        csw.getrecords(**kwa)
+        call(csw.url, csw.getrecords, **kwa)
         if csw.exceptionreport:
             err = 'Error getting records: %r' % \
                   csw.exceptionreport.exceptions
@@ -90,7 +188,17 @@ class CswService(OwsService):
 
     def getidentifiers(self, qtype=None, typenames="csw:Record", esn="brief",
                        keywords=[], limit=None, page=10, outputschema="gmd",
+                       max_page=DEFAULT_MAX_PAGE, target_time=DEFAULT_PAGE_TARGET_TIME,
                        **kw):
+        """
+        Yields the identifiers of the records in the catalogue.
+
+        The first page requested has the given size, and following ones are
+        made larger (up to max_page, and to the maximum the server allows)
+        while the server responds faster than target_time seconds, and
+        smaller if it gets slower. Each page is requested in the background
+        while the previous one is being consumed.
+        """
         from owslib.csw import namespaces
         csw = self._ows(**kw)
         kwa = {
@@ -98,31 +206,200 @@ class CswService(OwsService):
             "keywords": keywords,
             "typenames": typenames,
             "esn": esn,
-            "startposition": 0,
-            "maxrecords": page,
             "outputschema": namespaces[outputschema],
             }
-        i = 0
-        while True:
-            log.info('Making CSW request: getrecords %r', kwa)
-            csw.getrecords(**kwa)
-            if csw.exceptionreport:
+        server_max = self._max_records(csw)
+        if server_max:
+            max_page = min(max_page, server_max)
+        min_page = min(page, max_page)
+
+        def request_page(startposition, maxrecords):
+            # Each request uses its own copy of the client, as owslib keeps
+            # the last response in it
+            client = copy.copy(csw)
+            request = dict(kwa, startposition=startposition, maxrecords=maxrecords)
+            log.info('Making CSW request: getrecords %r', request)
+            started = time.time()
+            call(client.url, client.getrecords, **request)
+            elapsed = time.time() - started
+            if client.exceptionreport:
                 err = 'Error getting identifiers: %r' % \
-                      csw.exceptionreport.exceptions
-                #log.error(err)
+                      client.exceptionreport.exceptions
                 raise CswError(err)
-            identifiers = csw.records.keys()
+            results = getattr(client, 'results', None) or {}
+            return client.records.keys(), results, elapsed
+
+        i = 0
+        startposition = 1
+        page = min_page
+        prefetch = _Prefetch(request_page, startposition, page)
+        while True:
+            identifiers, results, elapsed = prefetch.result()
+
+            # Work out the next page while the consumer gets this one
+            matches = results.get('matches')
+            nextrecord = results.get('nextrecord') or startposition + len(identifiers)
+            if elapsed < target_time:
+                page = min(page * 2, max_page)
+            elif elapsed > target_time * 2:
+                page = max(page / 2, min_page)
+            if matches:
+                page = max(min(page, matches - nextrecord + 1), 1)
+            finished = not identifiers or \
+                       (matches is not None and nextrecord > matches) or \
+                       results.get('nextrecord') == 0 or \
+                       (limit is not None and i + len(identifiers) >= limit)
+            if not finished:
+                prefetch = _Prefetch(request_page, nextrecord, page)
+
             if limit is not None:
-                identifiers = identifiers[:(limit-startposition)]
+                identifiers = identifiers[:(limit - i)]
             for ident in identifiers:
                 yield ident
-            if len(identifiers) < page:
-                break
             i += len(identifiers)
-            if limit is not None and i > limit:
+            if finished:
                 break
-            kwa["startposition"] += page
-            
+            startposition = nextrecord
+
+    def _max_records(self, csw):
+        """
+        Returns the maximum number of records per GetRecords response
+        advertised in the server capabilities, if any.
+        """
+        constraints = []
+        for operation in getattr(csw, 'operations', []) or []:
+            if getattr(operation, 'name', None) == 'GetRecords':
+                constraints = getattr(operation, 'constraints', []) or []
+        if isinstance(constraints, dict):
+            constraints = [{'name': name, 'values': value.get('values', [])}
+                           for name, value in constraints.items()]
+        for constraint in constraints:
+            if constraint.get('name', '').lower() in ('maxrecords', 'maxrecorddefault'):
+                try:
+                    return int(constraint['values'][0])
+                except (IndexError, KeyError, TypeError, ValueError):
+                    pass
+        return None
+
+    def getrecords_xml(self, typenames="csw:Record", page=DEFAULT_FULL_RECORDS_PAGE,
+                       timeout=DEFAULT_TIMEOUT, esn="full", constraint=None,
+                       max_size=DEFAULT_MAX_SIZE, **kw):
+        """
+        Gets the GMD documents of all the records in the catalogue (or the
+        ones matching the constraint, an ogc:Filter element, see
+        modified_since_filter), requesting them in pages of the given size.
+
+        Rather than loading each page in memory as owslib does, the
+        response is parsed as it is downloaded, so records can be processed
+        while the rest of the page is being read, and the records already
+        processed are freed. Reading a page fails (with ResponseTooLarge)
+        after max_size bytes.
+
+        Yields (identifier, xml) tuples.
+        """
+        csw = self._ows(**kw)
+        search_results_tag = '{%s}SearchResults' % CSW_NAMESPACE
+        metadata_tag = '{%s}MD_Metadata' % GMD_NAMESPACE
+        exception_tag = '{%s}ExceptionText' % OWS_NAMESPACE
+        identifier_path = '{%s}fileIdentifier/{%s}CharacterString' % \
+                          (GMD_NAMESPACE, GCO_NAMESPACE)
+
+        start_position = 1
+        while True:
+            request = self._getrecords_xml_request(typenames, start_position, page,
+                                                   esn, constraint)
+            log.info('Making CSW request: getrecords (%s) startposition=%i maxrecords=%i',
+                     esn, start_position, page)
+            response = open_url(csw.url, timeout, max_size, data=request,
+                                headers={'Content-Type': 'application/xml'})
+
+            next_record = matched = None
+            returned = 0
+            try:
+                for event, elem in lxml_etree.iterparse(response, events=('start', 'end')):
+                    if event == 'start':
+                        if elem.tag == search_results_tag:
+                            matched = int(elem.get('numberOfRecordsMatched', 0))
+                            next_record = int(elem.get('nextRecord', 0))
+                        continue
+                    if elem.tag == exception_tag:
+                        raise CswError('Error getting records: %r' % elem.text)
+                    if elem.tag == metadata_tag and \
+                       elem.getparent() is not None and \
+                       elem.getparent().tag == search_results_tag:
+                        returned += 1
+                        identifier = elem.findtext(identifier_path)
+                        if identifier:
+                            identifier = identifier.strip()
+                        yield identifier, lxml_etree.tostring(elem, xml_declaration=True)
+                        # Free the records already processed
+                        elem.clear()
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
+            finally:
+                response.close()
+
+            if not returned or not next_record or \
+               (matched is not None and next_record > matched):
+                break
+            start_position = next_record
+
+    def _getrecords_xml_request(self, typenames, start_position, max_records,
+                                esn="full", constraint=None):
+        """
+        Builds the body of a GetRecords POST request for GMD records.
+        """
+        nsmap = {'csw': CSW_NAMESPACE, 'gmd': GMD_NAMESPACE}
+        root = lxml_etree.Element('{%s}GetRecords' % CSW_NAMESPACE, nsmap=nsmap)
+        root.set('service', 'CSW')
+        root.set('version', '2.0.2')
+        root.set('resultType', 'results')
+        root.set('startPosition', str(start_position))
+        root.set('maxRecords', str(max_records))
+        root.set('outputFormat', 'application/xml')
+        root.set('outputSchema', GMD_NAMESPACE)
+        query = lxml_etree.SubElement(root, '{%s}Query' % CSW_NAMESPACE)
+        query.set('typeNames', typenames)
+        lxml_etree.SubElement(query, '{%s}ElementSetName' % CSW_NAMESPACE).text = esn
+        if constraint is not None:
+            constraint_element = lxml_etree.SubElement(query, '{%s}Constraint' % CSW_NAMESPACE)
+            constraint_element.set('version', '1.1.0')
+            constraint_element.append(copy.deepcopy(constraint))
+        return lxml_etree.tostring(root)
+
+    def getrecordbyid_xml(self, identifier, timeout=DEFAULT_TIMEOUT,
+                          max_size=DEFAULT_MAX_SIZE, esn="full", **kw):
+        """
+        Gets the GMD document of a record, or None if the server doesn't
+        return it.
+
+        Unlike getrecordbyid, the response is parsed as it is downloaded,
+        and neither it nor its parsed tree are kept afterwards.
+        """
+        csw = self._ows(**kw)
+        metadata_tag = '{%s}MD_Metadata' % GMD_NAMESPACE
+        exception_tag = '{%s}ExceptionText' % OWS_NAMESPACE
+        params = urllib.urlencode({
+            'service': 'CSW',
+            'version': '2.0.2',
+            'request': 'GetRecordById',
+            'id': identifier.encode('utf8') if isinstance(identifier, unicode) else identifier,
+            'elementsetname': esn,
+            'outputschema': GMD_NAMESPACE,
+            })
+        url = csw.url + ('&' if '?' in csw.url else '?') + params
+        log.info('Making CSW request: getrecordbyid %r %r', identifier, esn)
+        response = open_url(url, timeout, max_size)
+        try:
+            for event, elem in lxml_etree.iterparse(response):
+                if elem.tag == exception_tag:
+                    raise CswError('Error getting record by id: %r' % elem.text)
+                if elem.tag == metadata_tag:
+                    return lxml_etree.tostring(elem, xml_declaration=True)
+        finally:
+            response.close()
+        return None
+
     def getrecordbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
         from owslib.csw import namespaces
         csw = self._ows(**kw)
@@ -132,7 +409,7 @@ class CswService(OwsService):
             }
         # Ordinary Python version's don't support the metadata argument
         log.info('Making CSW request: getrecordbyid %r %r', ids, kwa)
-        csw.getrecordbyid(ids, **kwa)
+        call(csw.url, csw.getrecordbyid, ids, **kwa)
         if csw.exceptionreport:
             err = 'Error getting record by id: %r' % \
                   csw.exceptionreport.exceptions
@@ -0,0 +1,81 @@
+'''
+Bounded diffs between versions of harvested documents
+'''
+import difflib
+
+DEFAULT_MAX_HUNKS = 10
+DEFAULT_MAX_LINES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024
+
+def bounded_unified_diff(a, b, max_hunks=DEFAULT_MAX_HUNKS,
+                         max_lines=DEFAULT_MAX_LINES, context=3,
+                         max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Returns a unified diff of the strings a and b, limited to its first
+    max_hunks hunks, and to max_bytes characters.
+
+    To keep the cost bounded on large documents, only their first
+    max_bytes characters are compared (which matters for documents with
+    very long lines, e.g. minified XML), lines are compared by their
+    hashes, the lines common to the start and end of both documents are
+    left out before matching, and only up to max_lines of the remaining
+    lines of each document are compared.
+    '''
+    bytes_truncated = len(a) > max_bytes or len(b) > max_bytes
+    a_lines = a[:max_bytes].splitlines()
+    b_lines = b[:max_bytes].splitlines()
+
+    # Lines common to the start and end of both documents
+    start = 0
+    end = min(len(a_lines), len(b_lines))
+    while start < end and a_lines[start] == b_lines[start]:
+        start += 1
+    suffix = 0
+    while suffix < end - start and a_lines[-1 - suffix] == b_lines[-1 - suffix]:
+        suffix += 1
+
+    a_middle = a_lines[start:len(a_lines) - suffix]
+    b_middle = b_lines[start:len(b_lines) - suffix]
+    truncated = len(a_middle) > max_lines or len(b_middle) > max_lines or bytes_truncated
+    a_middle = a_middle[:max_lines]
+    b_middle = b_middle[:max_lines]
+
+    # Keep some context around the changes
+    context_start = max(start - context, 0)
+    a_middle = a_lines[context_start:start] + a_middle
+    b_middle = b_lines[context_start:start] + b_middle
+    if not truncated and suffix:
+        a_middle += a_lines[len(a_lines) - suffix:][:context]
+        b_middle += b_lines[len(b_lines) - suffix:][:context]
+
+    matcher = difflib.SequenceMatcher(None,
+                                      [hash(line) for line in a_middle],
+                                      [hash(line) for line in b_middle],
+                                      autojunk=False)
+    out = []
+    hunks = 0
+    for group in matcher.get_grouped_opcodes(context):
+        if hunks == max_hunks:
+            out.append('... (diff truncated after %i hunks)' % max_hunks)
+            break
+        hunks += 1
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        out.append('@@ -%i,%i +%i,%i @@' % (context_start + i1 + 1, i2 - i1,
+                                            context_start + j1 + 1, j2 - j1))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                out.extend(' ' + line for line in a_middle[i1:i2])
+                continue
+            if tag in ('replace', 'delete'):
+                out.extend('-' + line for line in a_middle[i1:i2])
+            if tag in ('replace', 'insert'):
+                out.extend('+' + line for line in b_middle[j1:j2])
+    else:
+        if bytes_truncated:
+            out.append('... (diff truncated, only the first %i characters were compared)' % max_bytes)
+        elif truncated:
+            out.append('... (diff truncated, only %i changed lines were compared)' % max_lines)
+    diff = '\n'.join(out)
+    if len(diff) > max_bytes:
+        diff = diff[:max_bytes] + '\n... (diff truncated after %i characters)' % max_bytes
+    return diff
@@ -0,0 +1,436 @@
+'''
+Helpers for fetching remote documents
+
+Documents are requested with a session shared by all the threads of the
+process (see get_session), which reuses connections and asks for compressed
+responses.
+
+All the requests made to remote servers go through call, which applies
+the same policy to every host: failed requests are retried with an
+exponential backoff, the number of concurrent requests to a host is
+limited, and once a host fails too many times in a row, requests to it
+fail straight away for a while (circuit breaker). The policy is shared
+by all the threads of a process, and set with configure.
+'''
+import httplib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import urllib2
+from Queue import Queue
+from urlparse import urlparse
+
+import requests
+
+from ckanext.spatial.lib import stats
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_WORKERS_PER_HOST = 4
+# Seconds to wait for the server, and maximum size (in bytes) of the
+# responses read
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Retries of failed requests, and seconds to wait before the first one
+# (doubled for each of the following ones)
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 1.0
+# Maximum concurrent requests to the same host, from all the threads
+DEFAULT_HOST_CONCURRENCY = 4
+# Consecutive failures after which requests to a host fail straight away,
+# and seconds until it is tried again
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 60
+# Hosts whose connections are kept open at a time
+DEFAULT_POOL_HOSTS = 50
+
+# HTTP errors worth retrying
+RETRY_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
+_settings = {
+    'retries': DEFAULT_RETRIES,
+    'backoff': DEFAULT_BACKOFF,
+    'host_concurrency': DEFAULT_HOST_CONCURRENCY,
+    'breaker_threshold': DEFAULT_BREAKER_THRESHOLD,
+    'breaker_reset': DEFAULT_BREAKER_RESET,
+}
+
+class ResponseTooLarge(Exception):
+    pass
+
+class HTTPError(Exception):
+    '''Raised for responses with an error status (or 304 Not Modified)'''
+    def __init__(self, url, code, reason=None):
+        Exception.__init__(self, 'HTTP Error %s: %s (%s)' % (code, reason, url))
+        self.url = url
+        self.code = code
+
+class HostUnavailable(Exception):
+    '''Raised for requests to hosts that failed too many times recently'''
+    pass
+
+def configure(**settings):
+    '''
+    Sets the policy of the remote requests: retries, backoff,
+    host_concurrency, breaker_threshold and breaker_reset (see the
+    DEFAULT_* values). Forgets the state of the hosts, and the open
+    connections.
+    '''
+    global _session
+    for name, value in settings.iteritems():
+        if not name in _settings:
+            raise ValueError('Unknown fetch setting: %s' % name)
+        _settings[name] = value
+    with _hosts_lock:
+        _hosts.clear()
+    with _session_lock:
+        _session = None
+
+class _Host(object):
+    '''The concurrency slots and failures of a host'''
+
+    def __init__(self, name):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(_settings['host_concurrency'])
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.time() - self.opened < _settings['breaker_reset']:
+                raise HostUnavailable('Too many failed requests to %s, not trying again until %s' % \
+                    (self.name, time.ctime(self.opened + _settings['breaker_reset'])))
+            # Try again, a single failure opens the circuit again
+            log.info('Trying requests to %s again' % self.name)
+            self.opened = None
+            self.failures = _settings['breaker_threshold'] - 1
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened is None and self.failures >= _settings['breaker_threshold']:
+                log.warning('%i consecutive failed requests to %s, not trying again for %i seconds' % \
+                            (self.failures, self.name, _settings['breaker_reset']))
+                self.opened = time.time()
+                stats.count('fetch_circuit_opened')
+            return self.opened is not None
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+def _get_host(url):
+    name = urlparse(url).netloc.lower()
+    with _hosts_lock:
+        if not name in _hosts:
+            _hosts[name] = _Host(name)
+        return _hosts[name]
+
+def _is_retryable(error):
+    # owslib requests are made with urllib2
+    if isinstance(error, (HTTPError, urllib2.HTTPError)):
+        return error.code in RETRY_HTTP_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError,
+                              urllib2.URLError, socket.error, socket.timeout,
+                              httplib.HTTPException))
+
+def call(url, function, *args, **kwargs):
+    '''
+    Calls function (which makes a request to url) with the given arguments,
+    following the policy of the remote requests: waiting for a free slot of
+    the host, retrying the request if it fails with a network error or a
+    temporary HTTP error, and raising HostUnavailable straight away if the
+    host failed too many times recently.
+
+    The retries and failures are counted in the stats of the current
+    harvest stage (fetch_retries, fetch_failures, fetch_circuit_opened and
+    fetch_rejected).
+    '''
+    host = _get_host(url)
+    attempt = 0
+    while True:
+        try:
+            host.check()
+        except HostUnavailable:
+            stats.count('fetch_rejected')
+            raise
+        with host.slots:
+            try:
+                result = function(*args, **kwargs)
+            except Exception, e:
+                if not _is_retryable(e):
+                    # The server responded
+                    host.succeeded()
+                    raise
+                stats.count('fetch_failures')
+                opened = host.failed()
+                if opened or attempt >= _settings['retries']:
+                    raise
+            else:
+                host.succeeded()
+                return result
+        delay = _settings['backoff'] * 2 ** attempt
+        delay += random.uniform(0, delay / 2)
+        log.debug('Request to %s failed (%r), retrying in %.1f seconds' % (url, e, delay))
+        time.sleep(delay)
+        attempt += 1
+        stats.count('fetch_retries')
+
+class BoundedResponse(object):
+    '''
+    A response read in chunks, raising ResponseTooLarge as soon as more
+    than max_size bytes are read from it.
+
+    It is file-like, so it can be passed to parsers that read files (e.g.
+    lxml's iterparse), and large documents don't need to be held in memory
+    as a whole.
+    '''
+    def __init__(self, chunks, max_size=None, url=None, headers=None, on_close=None):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._on_close = on_close
+        self.max_size = max_size
+        self.url = url
+        self.headers = headers if headers is not None else {}
+        self.size = 0
+        if max_size:
+            # Fail before reading anything if the server tells the size
+            length = self.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > max_size:
+                self.close()
+                raise ResponseTooLarge('Response from %s is too large (%s bytes, maximum is %i)' % \
+                                       (url, length, max_size))
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            if self.max_size and self.size > self.max_size:
+                self.close()
+                raise ResponseTooLarge('Response from %s is too large (maximum is %i bytes)' % \
+                                       (self.url, self.max_size))
+            return chunk
+        return None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = ''
+            chunk = self._next_chunk()
+            while chunk is not None:
+                chunks.append(chunk)
+                chunk = self._next_chunk()
+            return ''.join(chunks)
+        while len(self._buffer) < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''
+    Returns the HTTP session shared by all the threads of the process. It
+    keeps the connections to each host open (up to host_concurrency of them)
+    to reuse them for the following requests, and asks for compressed
+    responses, which are decompressed as they are read.
+    '''
+    global _session, _session_pid
+    with _session_lock:
+        # Connections can't be shared with forked processes
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=DEFAULT_POOL_HOSTS,
+                                                    pool_maxsize=_settings['host_concurrency'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+def connection_stats():
+    '''
+    Returns the number of requests made and of connections opened to each
+    host by the session of this process, as a dict of (requests,
+    connections) tuples keyed by host.
+    '''
+    result = {}
+    session = _session
+    if session is None or _session_pid != os.getpid():
+        return result
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                result['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = \
+                        (pool.num_requests, pool.num_connections)
+    return result
+
+def _log_connection_stats(url):
+    try:
+        pool = get_session().get_adapter(url).poolmanager.connection_from_url(url)
+        log.debug('%s://%s: %i requests over %i connections' % \
+                  (pool.scheme, pool.host, pool.num_requests, pool.num_connections))
+    except Exception, e:
+        log.debug('Could not get the connection stats of %s: %r' % (url, e))
+
+def _open(url, timeout, max_size, data=None, headers=None):
+    response = get_session().request('POST' if data is not None else 'GET', url,
+                                     data=data, headers=headers,
+                                     timeout=timeout or None, stream=True)
+    if log.isEnabledFor(logging.DEBUG):
+        _log_connection_stats(url)
+    if response.status_code >= 300:
+        response.close()
+        raise HTTPError(url, response.status_code, response.reason)
+    return BoundedResponse(response.iter_content(CHUNK_SIZE), max_size, url,
+                           response.headers, response.close)
+
+def _read(url, timeout, max_size, data=None, headers=None):
+    response = _open(url, timeout, max_size, data, headers)
+    try:
+        return response.read(), response.headers
+    finally:
+        response.close()
+
+def open_url(url, timeout=DEFAULT_TIMEOUT, max_size=DEFAULT_MAX_SIZE, data=None,
+             headers=None):
+    '''
+    Opens a URL (POSTing data to it, if given), waiting at most timeout
+    seconds for the server, and returns a BoundedResponse that can only be
+    read up to max_size bytes. Responses with an error status (or 304 Not
+    Modified) are raised as HTTPError.
+
+    Only opening the URL is retried (see call), not reading the response.
+    '''
+    return call(url, _open, url, timeout, max_size, data, headers)
+
+def fetch_url(url, timeout=DEFAULT_TIMEOUT, max_size=DEFAULT_MAX_SIZE, data=None,
+              headers=None):
+    '''
+    Returns the content of a URL, read in chunks and bounded as open_url,
+    and the headers of the response. The whole request is retried if it
+    fails (see call).
+    '''
+    return call(url, _read, url, timeout, max_size, data, headers)
+
+def read_url(url, timeout=DEFAULT_TIMEOUT, max_size=DEFAULT_MAX_SIZE, data=None,
+             headers=None):
+    '''Returns the content of a URL, as fetch_url'''
+    return fetch_url(url, timeout, max_size, data, headers)[0]
+
+def fetch_all(urls, fetch, workers=DEFAULT_WORKERS,
+              workers_per_host=DEFAULT_WORKERS_PER_HOST):
+    '''
+    Fetches a list of URLs concurrently, using a pool of threads.
+
+    urls - list of URLs to fetch
+    fetch - function that gets a URL and returns its content
+    workers - maximum number of concurrent requests
+    workers_per_host - maximum number of concurrent requests to the same
+                       host
+
+    Yields (url, content, error) tuples in the same order as the provided
+    URLs, as soon as each one is available, so the caller can process them
+    while the following ones are being fetched. error is the exception
+    raised by fetch (and content None) if the URL could not be fetched.
+
+    To keep memory bounded, URLs are only fetched a limited number of
+    positions ahead of the last one yielded.
+    '''
+    urls = list(urls)
+    workers = max(1, min(workers, len(urls)))
+    if not urls:
+        return
+
+    results = {}
+    results_available = threading.Condition()
+    # Limits how far ahead of the consumer the workers can get
+    window = threading.BoundedSemaphore(workers * 4)
+    host_slots = {}
+    host_slots_lock = threading.Lock()
+    tasks = Queue()
+    stopped = threading.Event()
+
+    def get_host_slot(url):
+        host = urlparse(url).netloc
+        with host_slots_lock:
+            if not host in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(workers_per_host)
+            return host_slots[host]
+
+    def feed():
+        for index, url in enumerate(urls):
+            window.acquire()
+            if stopped.is_set():
+                break
+            tasks.put((index, url))
+        for i in range(workers):
+            tasks.put(None)
+
+    # The stats of the workers go to the stage that started them
+    job_stats = stats.current_stats()
+
+    def work():
+        with stats.use(job_stats):
+            while True:
+                task = tasks.get()
+                if task is None or stopped.is_set():
+                    return
+                index, url = task
+                host_slot = get_host_slot(url)
+                with host_slot:
+                    try:
+                        result = (url, fetch(url), None)
+                    except Exception, e:
+                        result = (url, None, e)
+                with results_available:
+                    results[index] = result
+                    results_available.notify_all()
+
+    threads = [threading.Thread(target=feed)] + \
+              [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for index in range(len(urls)):
+            with results_available:
+                while not index in results:
+                    results_available.wait(1)
+                result = results.pop(index)
+            window.release()
+            yield result
+    finally:
+        # Let the threads finish if the caller stops consuming
+        stopped.set()
+        for i in range(workers * 4):
+            try:
+                window.release()
+            except ValueError:
+                break
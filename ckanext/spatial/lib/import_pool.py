@@ -0,0 +1,77 @@
+'''
+Parallel import of the objects of a harvest job, using a pool of processes
+'''
+import logging
+from multiprocessing import Pool
+
+from ckan import model
+from ckan.model import Session
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+log = logging.getLogger(__name__)
+
+DEFAULT_IMPORT_WORKERS = 4
+DEFAULT_IMPORT_BATCH_SIZE = 50
+
+def _get_harvester(source_type):
+    from ckanext.spatial.harvesters import (GeminiCswHarvester, GeminiDocHarvester,
+                                            GeminiWafHarvester, GeminiLocalHarvester)
+    for harvester in (GeminiCswHarvester(), GeminiDocHarvester(), GeminiWafHarvester(),
+                      GeminiLocalHarvester()):
+        if harvester.info()['name'] == source_type:
+            return harvester
+    raise ValueError('No spatial harvester for source type %s' % source_type)
+
+def _init_worker():
+    # Each worker opens its own connections
+    Session.remove()
+    model.meta.engine.dispose()
+
+def _import_batch(args):
+    '''Imports a batch of harvest objects, in a worker process'''
+    source_type, object_ids = args
+    try:
+        harvester = _get_harvester(source_type)
+        harvest_objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        return harvester.import_stage_batch(harvest_objects)
+    except Exception, e:
+        log.error('Error importing batch of objects %s: %r' % (object_ids, e))
+        return 0
+    finally:
+        Session.remove()
+
+def import_job_objects(job_id, workers=DEFAULT_IMPORT_WORKERS,
+                       batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    '''
+    Imports the objects gathered (and fetched) by a harvest job, in batches
+    spread over a pool of worker processes. Imports of the same document
+    are serialized with advisory locks (see GeminiHarvester._guid_lock).
+
+    Returns the number of objects in the job and the number imported
+    without errors.
+    '''
+    job = HarvestJob.get(job_id)
+    if job is None:
+        raise ValueError('Harvest job %s not found' % job_id)
+    source_type = job.source.type
+
+    object_ids = [object_id for (object_id,) in
+                  Session.query(HarvestObject.id) \
+                  .filter(HarvestObject.job==job) \
+                  .order_by(HarvestObject.gathered)]
+    batches = [(source_type, object_ids[i:i + batch_size])
+               for i in range(0, len(object_ids), batch_size)]
+    # Don't let the workers inherit open connections
+    Session.remove()
+    model.meta.engine.dispose()
+    log.info('Importing %i objects of job %s in %i batches with %i workers' % \
+             (len(object_ids), job_id, len(batches), workers))
+
+    pool = Pool(workers, initializer=_init_worker)
+    try:
+        imported = sum(pool.map(_import_batch, batches))
+    finally:
+        pool.close()
+        pool.join()
+
+    return len(object_ids), imported
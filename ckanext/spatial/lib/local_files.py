@@ -0,0 +1,146 @@
+'''
+Reading of GEMINI documents from local directories and archives, and their
+parsing and validation in a pool of processes.
+'''
+import logging
+import os
+import tarfile
+import zipfile
+from multiprocessing import Pool
+
+from lxml import etree
+
+from ckanext.spatial.model import GeminiDocument
+from ckanext.spatial.validation import Validators
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_WORKERS = 4
+DEFAULT_LOCAL_CHUNK_SIZE = 500
+
+METADATA_TAG = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
+
+def _is_document(name):
+    basename = os.path.basename(name)
+    return basename.lower().endswith('.xml') and not basename.startswith('.')
+
+def iter_documents(path, max_size=None):
+    '''
+    Yields (name, content) tuples for the XML files in a directory (and its
+    subdirectories), or in a zip or tar archive (optionally compressed).
+
+    Archive members are read one at a time, without extracting them to disk,
+    and tar archives are read sequentially, so compressed ones don't need to
+    be decompressed as a whole. Files larger than max_size bytes are not
+    read, and their content is None.
+    '''
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not _is_document(filename):
+                    continue
+                file_path = os.path.join(dirpath, filename)
+                name = os.path.relpath(file_path, path)
+                if max_size and os.path.getsize(file_path) > max_size:
+                    yield name, None
+                    continue
+                with open(file_path, 'rb') as f:
+                    yield name, f.read()
+    elif zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                if info.filename.endswith('/') or not _is_document(info.filename):
+                    continue
+                if max_size and info.file_size > max_size:
+                    yield info.filename, None
+                    continue
+                yield info.filename, archive.read(info)
+        finally:
+            archive.close()
+    elif tarfile.is_tarfile(path):
+        archive = tarfile.open(path, 'r|*')
+        try:
+            for member in archive:
+                if not member.isfile() or not _is_document(member.name):
+                    continue
+                if max_size and member.size > max_size:
+                    yield member.name, None
+                    continue
+                yield member.name, archive.extractfile(member).read()
+        finally:
+            archive.close()
+    else:
+        raise ValueError('%s is not a directory or a zip or tar archive' % path)
+
+_validators = None
+
+def _init_worker(profiles):
+    global _validators
+    _validators = Validators(profiles=profiles)
+
+def parse_document(document):
+    '''
+    Parses and validates a (name, content) document.
+
+    Returns a (name, gemini_string, guid, validation, error) tuple, where
+    validation is the result of Validators.is_valid and error a message if
+    the document could not be parsed.
+    '''
+    name, content = document
+    if content is None:
+        return name, None, None, None, 'File is too large'
+    try:
+        xml = etree.fromstring(content)
+        if xml.tag != METADATA_TAG:
+            xml = xml.find(METADATA_TAG)
+        if xml is None:
+            return name, None, None, None, 'Content is not a valid Gemini document'
+        gemini_string = etree.tostring(xml, encoding=unicode)
+        validation = _validators.is_valid(xml)
+        guid = GeminiDocument(xml_tree=xml).read_value('guid')
+        return name, gemini_string, guid, validation, None
+    except Exception, e:
+        return name, None, None, None, str(e) or repr(e)
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_documents(documents, profiles, workers=DEFAULT_LOCAL_WORKERS,
+                    chunk_size=DEFAULT_LOCAL_CHUNK_SIZE):
+    '''
+    Parses and validates (name, content) documents with parse_document, in
+    a pool of processes.
+
+    Documents are sent to the pool in chunks, and the results of each chunk
+    are yielded as a list, in order, while the next one is being parsed. So
+    only two chunks of documents are held in memory at a time.
+    '''
+    if workers <= 1:
+        _init_worker(profiles)
+        for chunk in _chunks(documents, chunk_size):
+            yield [parse_document(document) for document in chunk]
+        return
+
+    pool = Pool(workers, initializer=_init_worker, initargs=(profiles,))
+    try:
+        pending = None
+        for chunk in _chunks(documents, chunk_size):
+            result = pool.map_async(parse_document, chunk)
+            if pending is not None:
+                yield pending.get()
+            pending = result
+        if pending is not None:
+            yield pending.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
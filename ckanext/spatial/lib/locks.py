@@ -0,0 +1,81 @@
+'''
+PostgreSQL advisory locks, used to serialize the imports of the same
+document by concurrent processes.
+'''
+import hashlib
+import logging
+from contextlib import contextmanager
+
+from ckan.model import meta
+
+log = logging.getLogger(__name__)
+
+def lock_key(name):
+    '''Returns the (signed 64 bit) key of the advisory lock for a name'''
+    if name is None:
+        name = ''
+    elif isinstance(name, unicode):
+        name = name.encode('utf8')
+    return int(hashlib.sha1(name).hexdigest()[:15], 16)
+
+class LockNotAvailable(Exception):
+    '''Raised when a lock can't be taken without risking a deadlock'''
+    pass
+
+@contextmanager
+def advisory_lock(name):
+    '''
+    Holds the advisory lock for the name while the block runs.
+
+    The lock is taken on a dedicated connection, so it is kept across the
+    commits (and Session.remove calls) made in the block.
+    '''
+    key = lock_key(name)
+    conn = meta.engine.connect()
+    try:
+        conn.execute('SELECT pg_advisory_lock(%s)' % key)
+        try:
+            yield
+        finally:
+            conn.execute('SELECT pg_advisory_unlock(%s)' % key)
+    finally:
+        conn.close()
+
+@contextmanager
+def advisory_locks(names):
+    '''
+    Holds the advisory locks for several names while the block runs, on a
+    dedicated connection (see advisory_lock).
+
+    The locks are taken in the order of their keys, so blocks locking some
+    of the same names concurrently can't deadlock. Yields a function that
+    takes the lock for another name, until the end of the block. To keep
+    that order, if its key is lower than the highest one held and the lock
+    is taken by someone else, it raises LockNotAvailable rather than
+    waiting for it.
+    '''
+    held = set()
+    conn = meta.engine.connect()
+
+    def lock(name):
+        key = lock_key(name)
+        if key in held:
+            return
+        if held and key < max(held):
+            if not conn.execute('SELECT pg_try_advisory_lock(%s)' % key).scalar():
+                raise LockNotAvailable('The lock for %s is taken' % name)
+        else:
+            conn.execute('SELECT pg_advisory_lock(%s)' % key)
+        held.add(key)
+
+    try:
+        try:
+            for key in sorted(set(lock_key(name) for name in names)):
+                conn.execute('SELECT pg_advisory_lock(%s)' % key)
+                held.add(key)
+            yield lock
+        finally:
+            if held:
+                conn.execute('SELECT pg_advisory_unlock_all()')
+    finally:
+        conn.close()
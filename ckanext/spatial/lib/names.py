@@ -0,0 +1,95 @@
+'''
+Allocation of unique names for harvested packages
+'''
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta, Session, Package
+
+log = logging.getLogger(__name__)
+
+def _highest_suffix(conn, stem):
+    '''
+    Returns the highest numeric suffix of the existing package names made of
+    the stem followed by a number (0 if only the stem itself is taken, and
+    None if none is).
+    '''
+    names = conn.execute(text('''SELECT name FROM package
+                                 WHERE name = :stem OR name ~ :pattern'''),
+                         stem=stem, pattern='^%s[0-9]+$' % re.escape(stem))
+    suffixes = [int(name[len(stem):] or 0) for (name,) in names]
+    return max(suffixes) if suffixes else None
+
+def _next_counter(conn, stem):
+    '''
+    Increments the counter of the stem and returns its new value, or None
+    if the stem has no counter yet.
+    '''
+    row = conn.execute(text('''UPDATE spatial_package_name_counter
+                               SET counter = counter + 1 WHERE stem = :stem
+                               RETURNING counter'''), stem=stem).first()
+    return row[0] if row else None
+
+def _init_counter(conn, stem):
+    '''
+    Creates the counter of the stem from the names already taken, and
+    returns the name to use. Raises IntegrityError if another import
+    created the counter in the meantime.
+    '''
+    highest = _highest_suffix(conn, stem)
+    conn.execute(text('''INSERT INTO spatial_package_name_counter (stem, counter)
+                         VALUES (:stem, :counter)'''),
+                 stem=stem, counter=0 if highest is None else highest + 1)
+    if highest is None:
+        return stem
+    return stem + str(highest + 1)
+
+def _allocate_candidate(stem):
+    '''
+    Returns the next name of the counter of the stem, in a transaction of
+    its own, so the counter row is only locked for the time it takes to
+    increment it, rather than until the import is committed.
+    '''
+    conn = meta.engine.connect()
+    try:
+        while True:
+            trans = conn.begin()
+            try:
+                counter = _next_counter(conn, stem)
+                if counter is None:
+                    name = _init_counter(conn, stem)
+                else:
+                    name = stem + str(counter)
+                trans.commit()
+                return name
+            except IntegrityError:
+                # The counter was created by another import in the meantime
+                trans.rollback()
+            except:
+                trans.rollback()
+                raise
+    finally:
+        conn.close()
+
+def allocate_package_name(stem):
+    '''
+    Returns a package name not taken yet, made of the stem, or of the stem
+    followed by the lowest number after the ones already given to it (eg
+    'land-cover', 'land-cover1', 'land-cover2' ...).
+
+    The names already taken are only looked up once per stem, afterwards
+    the highest suffix given is kept in the spatial_package_name_counter
+    table. Returns None if the stem is empty.
+    '''
+    if not stem:
+        return None
+    while True:
+        name = _allocate_candidate(stem)
+        # The name may have been taken by a package not created by the
+        # harvesters (or not committed yet)
+        if not Session.query(Package.id).filter(Package.name==name).first():
+            return name
+        log.debug('Package name %s already taken' % name)
@@ -0,0 +1,279 @@
+'''
+Timings and counters of the stages of harvest jobs.
+
+The harvesters record how long each step of the gather, fetch and import
+stages takes (fetch, parse, digest, validate, extract, package_dict,
+wms_check, package_write, extent_save, commit) and count what happened to the documents. They are
+aggregated per job by each process, saved periodically (see add) and
+summarized by get_job_stats.
+
+Steps can be nested (eg extent_save happens during package_write), and
+each stage also records its total time.
+'''
+import atexit
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from pylons import config
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta
+
+from ckanext.spatial.model import harvest_state
+
+log = logging.getLogger(__name__)
+
+_current = threading.local()
+
+# Seconds between the saves of the stats aggregated by the process
+DEFAULT_FLUSH_INTERVAL = 60
+
+# Stats of the stages run by this process that are not saved yet, keyed
+# by job id and stage (see add)
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+
+class JobStats(object):
+    '''The timings and counters recorded during a stage of a harvest job'''
+
+    def __init__(self, job_id, stage):
+        self.job_id = job_id
+        self.stage = stage
+        self.samples = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, step):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.samples.append((step, time.time() - start))
+
+    def count(self, name, n=1):
+        # Counters can be incremented from several threads (see use)
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        '''Adds the timings and counters of another JobStats'''
+        with self._lock:
+            self.samples.extend(other.samples)
+            for name, n in other.counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def save(self):
+        '''
+        Saves the timings and counters, on a connection of their own, so
+        they are kept even if the stage transaction is rolled back.
+        '''
+        if not self.job_id or not (self.samples or self.counters):
+            return
+        if harvest_state.harvest_job_stat_table is None:
+            harvest_state.define_harvest_state_tables()
+        stat_table = harvest_state.harvest_job_stat_table
+        counter_table = harvest_state.harvest_job_counter_table
+
+        conn = meta.engine.connect()
+        try:
+            if self.samples:
+                conn.execute(stat_table.insert(),
+                             [{'job_id': self.job_id, 'stage': self.stage,
+                               'step': step, 'seconds': seconds}
+                              for step, seconds in self.samples])
+            for name, n in self.counters.iteritems():
+                where = (counter_table.c.job_id==self.job_id) & \
+                        (counter_table.c.stage==self.stage) & \
+                        (counter_table.c.name==name)
+                while True:
+                    result = conn.execute(counter_table.update().where(where) \
+                                          .values(value=counter_table.c.value + n))
+                    if result.rowcount:
+                        break
+                    try:
+                        conn.execute(counter_table.insert(),
+                                     job_id=self.job_id, stage=self.stage,
+                                     name=name, value=n)
+                        break
+                    except IntegrityError:
+                        # Inserted by another process in the meantime
+                        continue
+        finally:
+            conn.close()
+        self.samples = []
+        self.counters = {}
+
+def add(stats, flush_now=False):
+    '''
+    Adds the timings and counters of a stage run to the ones of its job
+    aggregated by this process. They are saved (see flush) if flush_now is
+    set, if the process has also run stages of other jobs, or every
+    ckan.spatial.harvest.stats_flush_interval seconds, rather than after
+    each document.
+    '''
+    if not stats.job_id:
+        return
+    key = (stats.job_id, stats.stage)
+    with _pending_lock:
+        other_jobs = [job_id for job_id, stage in _pending if job_id != stats.job_id]
+        if not key in _pending:
+            _pending[key] = JobStats(*key)
+        _pending[key].merge(stats)
+        interval = float(config.get('ckan.spatial.harvest.stats_flush_interval',
+                                    DEFAULT_FLUSH_INTERVAL))
+        due = flush_now or other_jobs or time.time() - _last_flush >= interval
+    if due:
+        flush()
+
+def flush():
+    '''Saves the stats aggregated by this process (see add)'''
+    global _last_flush
+    with _pending_lock:
+        pending = _pending.values()
+        _pending.clear()
+        _last_flush = time.time()
+    for stats in pending:
+        try:
+            stats.save()
+        except Exception, e:
+            log.error('Could not save the stats of job %s: %r' % (stats.job_id, e))
+
+# Save what is left when the process exits
+atexit.register(flush)
+
+def current_stats():
+    '''Returns the JobStats of the stage running in this thread, if any'''
+    return getattr(_current, 'stats', None)
+
+@contextmanager
+def timer(step):
+    '''Records the time taken by the block in the current stage, if any'''
+    stats = current_stats()
+    if stats is None:
+        yield
+    else:
+        with stats.timer(step):
+            yield
+
+def count(name, n=1):
+    '''Increments a counter of the current stage, if any'''
+    stats = current_stats()
+    if stats is not None:
+        stats.count(name, n)
+
+@contextmanager
+def use(stats):
+    '''
+    Records the timings and counters of the block in the given JobStats
+    (e.g. the one of the stage that started the thread running the block).
+    '''
+    previous = current_stats()
+    _current.stats = stats
+    try:
+        yield stats
+    finally:
+        _current.stats = previous
+
+@contextmanager
+def collect(job_id, stage):
+    '''
+    Records the timings and counters of the block (and its total time) in
+    a new JobStats, which is returned. They are not saved.
+    '''
+    stats = JobStats(job_id, stage)
+    with use(stats):
+        with stats.timer('total'):
+            yield stats
+
+def _get_job_id(arg):
+    # Harvest jobs, harvest objects or lists of harvest objects
+    if isinstance(arg, (list, tuple)):
+        if not arg:
+            return None
+        arg = arg[0]
+    job = getattr(arg, 'job', arg)
+    return getattr(job, 'id', None)
+
+def job_stage(stage):
+    '''
+    Decorator for the stage methods of the harvesters, which get a harvest
+    job, a harvest object or a list of them. The timings and counters
+    recorded while the stage runs are added to the ones of its job (see
+    add), and saved straight away for gather stages and batches of objects.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, arg, *args, **kwargs):
+            if current_stats() is not None:
+                # Called from another stage (eg import_stage_batch)
+                return f(self, arg, *args, **kwargs)
+            stats = None
+            try:
+                with collect(_get_job_id(arg), stage) as stats:
+                    return f(self, arg, *args, **kwargs)
+            finally:
+                if stats is not None:
+                    add(stats, flush_now=stage == 'gather' or isinstance(arg, (list, tuple)))
+        return wrapper
+    return decorator
+
+def _percentile(values, percent):
+    # Nearest rank, values must be sorted
+    index = max(int(math.ceil(percent * len(values) / 100.0)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+def summarize(samples):
+    '''
+    Returns the count, total, p50, p95 and max seconds of each step of a
+    list of (step, seconds) samples, keyed by step.
+    '''
+    steps = {}
+    for step, seconds in samples:
+        steps.setdefault(step, []).append(seconds)
+    summary = {}
+    for step, values in steps.iteritems():
+        values.sort()
+        summary[step] = {
+            'count': len(values),
+            'total': sum(values),
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'max': values[-1],
+        }
+    return summary
+
+def get_job_stats(job_id):
+    '''
+    Returns the timings and counters recorded for a harvest job, as a dict
+    keyed by stage, with a 'steps' dict (count, total, p50, p95 and max
+    seconds of each step) and a 'counters' dict.
+    '''
+    if harvest_state.harvest_job_stat_table is None:
+        harvest_state.define_harvest_state_tables()
+    stat_table = harvest_state.harvest_job_stat_table
+    counter_table = harvest_state.harvest_job_counter_table
+
+    samples = {}
+    for stage, step, seconds in meta.engine.execute(
+            stat_table.select().with_only_columns([stat_table.c.stage,
+                                                   stat_table.c.step,
+                                                   stat_table.c.seconds]) \
+            .where(stat_table.c.job_id==job_id)):
+        samples.setdefault(stage, []).append((step, seconds))
+
+    stats = {}
+    for stage, stage_samples in samples.iteritems():
+        stats[stage] = {'steps': summarize(stage_samples), 'counters': {}}
+    for stage, name, value in meta.engine.execute(
+            counter_table.select().with_only_columns([counter_table.c.stage,
+                                                      counter_table.c.name,
+                                                      counter_table.c.value]) \
+            .where(counter_table.c.job_id==job_id)):
+        stats.setdefault(stage, {'steps': {}, 'counters': {}})['counters'][name] = value
+    return stats
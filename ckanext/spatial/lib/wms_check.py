@@ -0,0 +1,199 @@
+'''
+Checks of whether the resources of service records are WMS endpoints,
+cached in the database so each endpoint is only checked once in a while.
+'''
+import logging
+from datetime import datetime, timedelta
+from urlparse import urlparse, urlunparse
+
+from pylons import config
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from owslib import wms
+
+from ckan import model
+from ckan.model import Session
+
+from ckanext.spatial.model import WmsCheck
+from ckanext.spatial.lib.fetch import fetch_all, read_url, DEFAULT_WORKERS, DEFAULT_MAX_SIZE
+
+log = logging.getLogger(__name__)
+
+# How long (in seconds) the results of the checks are reused, for URLs that
+# are WMS endpoints and for the ones that are not
+DEFAULT_WMS_CHECK_TTL = 7 * 24 * 3600
+DEFAULT_WMS_CHECK_NEGATIVE_TTL = 24 * 3600
+
+def normalize_wms_url(url):
+    '''
+    Returns the URL used as key of the checks: the query is removed (as
+    the GetCapabilities parameters are added to the base URL), and the
+    scheme and host are lower cased.
+    '''
+    parts = urlparse(url.strip())
+    return urlunparse((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path, parts.params, '', ''))
+
+def check_wms(url):
+    '''
+    Requests the capabilities of the URL and returns whether it is a WMS
+    endpoint offering any layer.
+
+    Errors requesting the capabilities are raised, as they don't tell
+    whether the URL is a WMS endpoint.
+    '''
+    capabilities_url = wms.WMSCapabilitiesReader().capabilities_url(url)
+    max_size = int(config.get('ckan.spatial.harvest.max_response_size', DEFAULT_MAX_SIZE))
+    xml = read_url(capabilities_url, 10, max_size)
+
+    try:
+        s = wms.WebMapService(url,xml=xml)
+        return isinstance(s.contents, dict) and s.contents != {}
+    except Exception, e:
+        log.debug('%s is not a WMS endpoint: %s' % (url, str(e)))
+    return False
+
+def _is_fresh(wms_check):
+    if wms_check is None or wms_check.checked is None:
+        return False
+    if wms_check.is_wms:
+        ttl = int(config.get('ckan.spatial.harvest.wms_check_ttl', DEFAULT_WMS_CHECK_TTL))
+    else:
+        ttl = int(config.get('ckan.spatial.harvest.wms_check_negative_ttl',
+                             DEFAULT_WMS_CHECK_NEGATIVE_TTL))
+    return datetime.now() - wms_check.checked < timedelta(seconds=ttl)
+
+def _save_check(url, is_wms):
+    '''
+    Saves the result of checking the (normalized) URL, or marks it as
+    pending if is_wms is None, unless there is a check of it already.
+    '''
+    checked = datetime.now() if is_wms is not None else None
+    wms_check = WmsCheck.get(url)
+    if wms_check is None:
+        Session.begin_nested()
+        try:
+            Session.add(WmsCheck(url, is_wms, checked))
+            Session.commit()
+            return
+        except IntegrityError:
+            # Saved by another process in the meantime
+            Session.rollback()
+            wms_check = WmsCheck.get(url)
+    if is_wms is not None:
+        wms_check.is_wms = is_wms
+        wms_check.checked = checked
+
+def get_cached_check(url):
+    '''
+    Returns the result of the last check of the URL (True or False), or
+    None if it was never checked or the result expired.
+    '''
+    wms_check = WmsCheck.get(normalize_wms_url(url))
+    return wms_check.is_wms if _is_fresh(wms_check) else None
+
+def is_wms(url):
+    '''
+    Returns whether the URL is a WMS endpoint, checking it if there is
+    no recent result cached. URLs that could not be checked are taken as
+    not being WMS endpoints, but the result is not cached.
+    '''
+    result = get_cached_check(url)
+    if result is None:
+        try:
+            result = check_wms(url)
+        except Exception, e:
+            log.error('WMS check for %s failed with exception: %s' % (url, str(e)))
+            return False
+        _save_check(normalize_wms_url(url), result)
+    return result
+
+def defer_check(url):
+    '''
+    Marks the URL to be checked by verify_pending_checks, unless there is a
+    recent result cached, which is returned (otherwise None).
+    '''
+    result = get_cached_check(url)
+    if result is None:
+        _save_check(normalize_wms_url(url), None)
+    return result
+
+def set_recommended_wms_preview(resources):
+    '''
+    Guesses the best view service to use in WMS preview among the given
+    resources (dicts), preferring verified ones, and flags it with
+    ckan_recommended_wms_preview.
+    '''
+    for resource in resources:
+        resource.pop('ckan_recommended_wms_preview', None)
+    verified_view_resources = [r for r in resources if r.get('verified') and r['format'] == 'WMS']
+    if len(verified_view_resources):
+        verified_view_resources[0]['ckan_recommended_wms_preview'] = True
+    else:
+        view_resources = [r for r in resources if r['format'] == 'WMS']
+        if len(view_resources):
+            view_resources[0]['ckan_recommended_wms_preview'] = True
+
+def verify_pending_checks(workers=DEFAULT_WORKERS):
+    '''
+    Checks concurrently the URLs marked with defer_check (and the ones whose
+    result expired), and updates the resources of service records pointing
+    to the ones that are WMS endpoints. URLs that could not be checked are
+    left pending.
+
+    Returns the number of URLs checked and the number of resources
+    updated.
+    '''
+    urls = [wms_check.url for wms_check in Session.query(WmsCheck)
+            if not _is_fresh(wms_check)]
+
+    wms_urls = []
+    for url, result, error in fetch_all(urls, check_wms, workers):
+        if error:
+            log.error('WMS check for %s failed with exception: %s' % (url, error))
+            continue
+        _save_check(url, bool(result))
+        if result:
+            wms_urls.append(url)
+    Session.commit()
+
+    packages = set()
+    updated = 0
+    if wms_urls:
+        model.repo.new_revision()
+        wms_urls = set(wms_urls)
+        for resource in Session.query(model.Resource) \
+                        .filter(model.Resource.state==u'active') \
+                        .filter(or_(model.Resource.format==None,
+                                    model.Resource.format!=u'WMS')):
+            if not resource.url or not normalize_wms_url(resource.url) in wms_urls:
+                continue
+            # Only the resources of services are checked by the harvesters
+            package = resource.resource_group.package
+            if package.extras.get('resource-type') != 'service':
+                continue
+            # Extras need to be replaced for the change to be saved
+            extras = dict(resource.extras)
+            extras['verified'] = True
+            extras['verified_date'] = datetime.now().isoformat()
+            resource.extras = extras
+            resource.format = u'WMS'
+            packages.add(package)
+            updated += 1
+
+        for package in packages:
+            resources = [dict(resource.extras, format=resource.format)
+                         for resource in package.resources]
+            set_recommended_wms_preview(resources)
+            for resource, resource_dict in zip(package.resources, resources):
+                extras = dict(resource.extras)
+                if resource_dict.get('ckan_recommended_wms_preview'):
+                    extras['ckan_recommended_wms_preview'] = True
+                else:
+                    extras.pop('ckan_recommended_wms_preview', None)
+                if extras != resource.extras:
+                    resource.extras = extras
+        model.repo.commit_and_remove()
+
+    log.info('Checked %i URLs, updated %i resources' % (len(urls), updated))
+    return len(urls), updated
@@ -8,3 +8,5 @@ except ImportError:
 
 from package_extent import *
 from harvested_metadata import *
+from harvest_state import HarvestUrlState, HarvestSourceState, HarvestRemovedRecord, WmsCheck, \
+                          ValidationResult, HarvestObjectDigest, HarvestDiff
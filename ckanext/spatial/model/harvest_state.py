@@ -0,0 +1,238 @@
+from logging import getLogger
+
+from sqlalchemy import types, Column, Table
+
+from ckan import model
+from ckan.model import meta, Session
+from ckan.model.domain_object import DomainObject
+
+from ckanext.spatial.model.package_extent import _column_exists
+
+log = getLogger(__name__)
+
+harvest_url_state_table = None
+harvest_source_state_table = None
+harvest_removed_record_table = None
+wms_check_table = None
+package_name_counter_table = None
+validation_result_table = None
+harvest_object_digest_table = None
+harvest_diff_table = None
+harvest_job_stat_table = None
+harvest_job_counter_table = None
+
+def setup():
+
+    if harvest_url_state_table is None:
+        define_harvest_state_tables()
+        log.debug('Spatial harvest state tables defined in memory')
+
+    if model.package_table.exists():
+        if not harvest_url_state_table.exists():
+            harvest_url_state_table.create()
+            log.debug('Spatial harvest state tables created')
+        else:
+            log.debug('Spatial harvest state tables already exist')
+            # Future migrations go here
+            if not _column_exists('spatial_harvest_url_state', 'listing_modified'):
+                Session.execute('ALTER TABLE spatial_harvest_url_state ADD COLUMN listing_modified text')
+                Session.execute('ALTER TABLE spatial_harvest_url_state ADD COLUMN listing_size text')
+                Session.commit()
+                log.debug('Added listing columns to spatial_harvest_url_state')
+
+        if not harvest_source_state_table.exists():
+            harvest_source_state_table.create()
+            log.debug('Spatial harvest source state table created')
+        elif not _column_exists('spatial_harvest_source_state', 'pending_objects'):
+            Session.execute('ALTER TABLE spatial_harvest_source_state ADD COLUMN pending_objects integer')
+            Session.commit()
+            log.debug('Added pending_objects column to spatial_harvest_source_state')
+
+        if not harvest_removed_record_table.exists():
+            harvest_removed_record_table.create()
+            log.debug('Spatial harvest removed record table created')
+
+        if not wms_check_table.exists():
+            wms_check_table.create()
+            log.debug('Spatial WMS check table created')
+
+        if not package_name_counter_table.exists():
+            package_name_counter_table.create()
+            log.debug('Spatial package name counter table created')
+
+        if not validation_result_table.exists():
+            validation_result_table.create()
+            log.debug('Spatial validation result table created')
+
+        if not harvest_object_digest_table.exists():
+            harvest_object_digest_table.create()
+            log.debug('Spatial harvest object digest table created')
+
+        if not harvest_diff_table.exists():
+            harvest_diff_table.create()
+            log.debug('Spatial harvest diff table created')
+
+        if not harvest_job_stat_table.exists():
+            harvest_job_stat_table.create()
+            harvest_job_counter_table.create()
+            log.debug('Spatial harvest job stats tables created')
+    else:
+        log.debug('Spatial harvest state tables creation deferred')
+
+
+class HarvestUrlState(DomainObject):
+    '''What is known about a remote document harvested from a source:
+    the HTTP validators (ETag and Last-Modified headers) of its last
+    response, its modification date and size as shown in the WAF listing
+    and the last harvest object created from it.'''
+    def __init__(self, source_id=None, url=None):
+        self.source_id = source_id
+        self.url = url
+
+class HarvestSourceState(DomainObject):
+    '''When the records of a source were last gathered (and all of them
+    imported), and when they were last gathered completely (rather than
+    only the ones modified since the previous harvest).'''
+    def __init__(self, source_id=None):
+        self.source_id = source_id
+
+    @classmethod
+    def get(cls, source_id):
+        return Session.query(cls).get(source_id)
+
+class HarvestRemovedRecord(DomainObject):
+    '''A current harvest object whose record is no longer listed by the
+    source, which has already been reported.'''
+    def __init__(self, harvest_object_id=None, source_id=None, job_id=None):
+        self.harvest_object_id = harvest_object_id
+        self.source_id = source_id
+        self.job_id = job_id
+
+class WmsCheck(DomainObject):
+    '''The result of checking whether a (normalized) URL is a WMS
+    endpoint. is_wms is None while the check is pending.'''
+    def __init__(self, url=None, is_wms=None, checked=None):
+        self.url = url
+        self.is_wms = is_wms
+        self.checked = checked
+
+    @classmethod
+    def get(cls, url):
+        return Session.query(cls).get(url)
+
+class ValidationResult(DomainObject):
+    '''The result of validating a document, keyed by the digest of its
+    content and the validation profiles used.'''
+    def __init__(self, digest=None, valid=None, messages=None):
+        self.digest = digest
+        self.valid = valid
+        self.messages = messages
+
+    @classmethod
+    def get(cls, digest):
+        return Session.query(cls).get(digest)
+
+class HarvestObjectDigest(DomainObject):
+    '''The digest of the normalized content of a harvest object, used
+    to detect unchanged documents.'''
+    def __init__(self, harvest_object_id=None, digest=None):
+        self.harvest_object_id = harvest_object_id
+        self.digest = digest
+
+class HarvestDiff(DomainObject):
+    '''The diff between two versions of a document, keyed by the digests
+    of both versions.'''
+    def __init__(self, digests=None, diff=None):
+        self.digests = digests
+        self.diff = diff
+
+    @classmethod
+    def get(cls, digests):
+        return Session.query(cls).get(digests)
+
+def define_harvest_state_tables():
+
+    global harvest_url_state_table
+    global harvest_source_state_table
+    global harvest_removed_record_table
+    global wms_check_table
+    global package_name_counter_table
+    global validation_result_table
+    global harvest_object_digest_table
+    global harvest_diff_table
+    global harvest_job_stat_table
+    global harvest_job_counter_table
+
+    harvest_url_state_table = Table('spatial_harvest_url_state', meta.metadata,
+                    Column('source_id', types.UnicodeText, primary_key=True),
+                    Column('url', types.UnicodeText, primary_key=True),
+                    Column('etag', types.UnicodeText),
+                    Column('last_modified', types.UnicodeText),
+                    Column('listing_modified', types.UnicodeText),
+                    Column('listing_size', types.UnicodeText),
+                    Column('harvest_object_id', types.UnicodeText))
+
+    harvest_source_state_table = Table('spatial_harvest_source_state', meta.metadata,
+                    Column('source_id', types.UnicodeText, primary_key=True),
+                    Column('last_gathered', types.DateTime),
+                    Column('last_full_gather', types.DateTime),
+                    # Start of the last gather, until all its objects
+                    # are imported
+                    Column('pending_gathered', types.DateTime),
+                    Column('pending_job_id', types.UnicodeText),
+                    # Objects of the job left to import
+                    Column('pending_objects', types.Integer))
+
+    harvest_removed_record_table = Table('spatial_harvest_removed_record', meta.metadata,
+                    Column('harvest_object_id', types.UnicodeText, primary_key=True),
+                    Column('source_id', types.UnicodeText, nullable=False, index=True),
+                    # Job that found the record removed
+                    Column('job_id', types.UnicodeText))
+
+    wms_check_table = Table('spatial_wms_check', meta.metadata,
+                    Column('url', types.UnicodeText, primary_key=True),
+                    Column('is_wms', types.Boolean),
+                    Column('checked', types.DateTime))
+
+    # Highest numeric suffix given to the names of harvested packages
+    # generated from each stem (see ckanext.spatial.lib.names)
+    package_name_counter_table = Table('spatial_package_name_counter', meta.metadata,
+                    Column('stem', types.UnicodeText, primary_key=True),
+                    Column('counter', types.Integer, nullable=False))
+
+    validation_result_table = Table('spatial_validation_result', meta.metadata,
+                    Column('digest', types.UnicodeText, primary_key=True),
+                    Column('valid', types.Boolean, nullable=False),
+                    # JSON list of messages
+                    Column('messages', types.UnicodeText))
+
+    harvest_object_digest_table = Table('spatial_harvest_object_digest', meta.metadata,
+                    Column('harvest_object_id', types.UnicodeText, primary_key=True),
+                    Column('digest', types.UnicodeText, nullable=False))
+
+    harvest_diff_table = Table('spatial_harvest_diff', meta.metadata,
+                    Column('digests', types.UnicodeText, primary_key=True),
+                    Column('diff', types.UnicodeText))
+
+    # Time taken by the steps of the stages of harvest jobs, and counters
+    # of what happened to their documents (see ckanext.spatial.lib.stats)
+    harvest_job_stat_table = Table('spatial_harvest_job_stat', meta.metadata,
+                    Column('id', types.Integer, primary_key=True),
+                    Column('job_id', types.UnicodeText, nullable=False, index=True),
+                    Column('stage', types.UnicodeText, nullable=False),
+                    Column('step', types.UnicodeText, nullable=False),
+                    Column('seconds', types.Float, nullable=False))
+
+    harvest_job_counter_table = Table('spatial_harvest_job_counter', meta.metadata,
+                    Column('job_id', types.UnicodeText, primary_key=True),
+                    Column('stage', types.UnicodeText, primary_key=True),
+                    Column('name', types.UnicodeText, primary_key=True),
+                    Column('value', types.Integer, nullable=False))
+
+    meta.mapper(HarvestUrlState, harvest_url_state_table)
+    meta.mapper(HarvestSourceState, harvest_source_state_table)
+    meta.mapper(HarvestRemovedRecord, harvest_removed_record_table)
+    meta.mapper(WmsCheck, wms_check_table)
+    meta.mapper(ValidationResult, validation_result_table)
+    meta.mapper(HarvestObjectDigest, harvest_object_digest_table)
+    meta.mapper(HarvestDiff, harvest_diff_table)
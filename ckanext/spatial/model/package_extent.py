@@ -1,6 +1,7 @@
 from logging import getLogger
 
 from sqlalchemy import types, Column, Table
+from sqlalchemy.exc import IntegrityError
 
 from geoalchemy import Geometry, GeometryColumn, GeometryDDL, GeometryExtensionColumn
 from geoalchemy.postgis import PGComparator
@@ -15,9 +16,27 @@ from ckan.model.domain_object import DomainObject
 log = getLogger(__name__)
 
 package_extent_table = None
+active_package_extent_table = None
+package_extent_geometry_table = None
+package_extent_subdivided_table = None
+package_extent_histogram_table = None
+package_extent_hot_region_table = None
+package_extent_hot_region_geometry_table = None
 
 DEFAULT_SRID = 4326 #(WGS 84)
 
+# Maximum number of vertices of each of the pieces stored in the
+# package_extent_subdivided table (0 disables the subdivision)
+DEFAULT_SUBDIVIDE_MAX_VERTICES = 0
+
+# ST_Subdivide is only available from PostGIS 2.2
+SUBDIVIDE_MIN_POSTGIS_VERSION = (2, 2)
+
+_subdivide_supported = None
+
+# Digest used to identify geometries in the package_extent_geometry table
+GEOMETRY_DIGEST_SQL = 'md5(ST_AsEWKB(%s))'
+
 def setup(srid=None):
 
     if package_extent_table is None:
@@ -47,20 +66,280 @@ def setup(srid=None):
             log.debug('Spatial tables created')
         else:
             log.debug('Spatial tables already exist')
-            # Future migrations go here
+
+        if not package_extent_geometry_table.exists():
+            package_extent_geometry_table.create()
+            log.debug('Shared geometries table created')
+
+        # Future migrations go here
+        if _column_exists('package_extent', 'the_geom'):
+            _migrate_extent_geometries()
+
+        if not active_package_extent_table.exists():
+            active_package_extent_table.create()
+            update_active_package_extent()
+            Session.commit()
+            log.debug('Active package extents table created')
+        elif _column_exists('active_package_extent', 'the_geom'):
+            # The geometries are read from package_extent_geometry
+            Session.execute("SELECT DropGeometryColumn('active_package_extent', 'the_geom')")
+            Session.commit()
+            log.debug('Dropped the_geom column from active_package_extent')
+
+        if not package_extent_subdivided_table.exists():
+            package_extent_subdivided_table.create()
+            subdivide_geometry()
+            Session.commit()
+            log.debug('Subdivided geometries table created')
+
+        if not package_extent_histogram_table.exists():
+            package_extent_histogram_table.create()
+            log.debug('Extent histogram table created')
+
+        if not package_extent_hot_region_table.exists():
+            package_extent_hot_region_table.create()
+            package_extent_hot_region_geometry_table.create()
+            log.debug('Hot regions tables created')
 
     else:
         log.debug('Spatial tables creation deferred')
 
+def _migrate_extent_geometries():
+    '''Moves the geometries stored in the package_extent table by previous
+    versions to the package_extent_geometry table, so each distinct
+    geometry is only stored once'''
+    if not _column_exists('package_extent', 'geometry_id'):
+        Session.execute('ALTER TABLE package_extent ADD COLUMN geometry_id text')
+        Session.execute('CREATE INDEX ix_package_extent_geometry_id ON package_extent (geometry_id)')
+    Session.execute('UPDATE package_extent SET geometry_id = %s WHERE geometry_id IS NULL' % \
+                    (GEOMETRY_DIGEST_SQL % 'the_geom'))
+    Session.execute('''INSERT INTO package_extent_geometry (id, the_geom)
+                       SELECT DISTINCT ON (geometry_id) geometry_id, the_geom
+                       FROM package_extent
+                       WHERE geometry_id IS NOT NULL
+                          AND geometry_id NOT IN (SELECT id FROM package_extent_geometry)''')
+    Session.execute("SELECT DropGeometryColumn('package_extent', 'the_geom')")
+    Session.commit()
+    log.debug('Moved the package extent geometries to package_extent_geometry')
+
+def _column_exists(table_name, column_name):
+    return Session.execute('''SELECT 1 FROM information_schema.columns
+                              WHERE table_name = :table_name AND column_name = :column_name''',
+                           {'table_name': table_name,
+                            'column_name': column_name}).first() is not None
+
 
 class PackageExtent(DomainObject):
-    def __init__(self, package_id=None, the_geom=None):
+    '''The extent of a package, which references its geometry in the
+    package_extent_geometry table (see intern_geometry)'''
+    def __init__(self, package_id=None, geometry_id=None):
         self.package_id = package_id
-        self.the_geom = the_geom
+        self.geometry_id = geometry_id
+
+class ActivePackageExtent(DomainObject):
+    '''The extent of an active package (see update_active_package_extent)'''
+    pass
+
+class PackageExtentGeometry(DomainObject):
+    '''A geometry shared by all the package extents that are identical,
+    identified by a digest of its binary representation (see
+    get_geometry_id)'''
+    pass
+
+class PackageExtentHotRegion(DomainObject):
+    '''A frequently searched bounding box, for which the matching geometries
+    are precomputed (see rank_hot_regions)'''
+    pass
+
+class PackageExtentHotRegionGeometry(DomainObject):
+    '''A shared geometry matching a hot region, with its spatial ranking'''
+    pass
+
+class PackageExtentPiece(DomainObject):
+    '''A piece of a subdivided shared geometry (see subdivide_geometry)'''
+    pass
+
+def update_active_package_extent(package_id=None):
+    '''Synchronizes the active_package_extent table, which lists the
+    extents of active packages (the ones returned by spatial queries),
+    with the extent and state of the given package (or of all packages if
+    none provided).
+
+    Package and extent changes must have been flushed. The responsibility
+    for calling model.Session.commit() is left to the caller.
+    '''
+    params = {'package_id': package_id}
+    if package_id:
+        Session.execute('DELETE FROM active_package_extent WHERE package_id = :package_id', params)
+        where = 'AND package_extent.package_id = :package_id'
+    else:
+        Session.execute('DELETE FROM active_package_extent')
+        where = ''
+
+    Session.execute('''INSERT INTO active_package_extent (package_id, geometry_id)
+                       SELECT package_extent.package_id, package_extent.geometry_id
+                       FROM package_extent, package
+                       WHERE package_extent.package_id = package.id
+                          AND package.state = 'active' %s''' % where,
+                    params)
+
+def get_geometry_id(wkt, srid):
+    '''Returns the identifier that the geometry defined by the provided WKT
+    has (or would have) in the package_extent_geometry table.'''
+    return Session.execute('SELECT %s' % (GEOMETRY_DIGEST_SQL % 'GeomFromText(:wkt, :srid)'),
+                           {'wkt': wkt, 'srid': srid}).scalar()
+
+def intern_geometry(geometry_id, wkt, srid):
+    '''Makes sure that the geometry with the given identifier is stored
+    (along with its subdivided pieces) in the package_extent_geometry table,
+    so package extents can reference it.
+
+    The row of the geometry stays locked until the transaction ends, so it
+    can't be deleted by a concurrent release_geometry before the extent
+    referencing it is committed.
+
+    The responsibility for calling model.Session.commit() is left to the
+    caller.
+    '''
+    params = {'geometry_id': geometry_id, 'wkt': wkt, 'srid': srid}
+    while True:
+        if Session.execute('''SELECT 1 FROM package_extent_geometry
+                              WHERE id = :geometry_id FOR SHARE''', params).first():
+            return
+        Session.begin_nested()
+        try:
+            result = Session.execute('''INSERT INTO package_extent_geometry (id, the_geom)
+                                        SELECT :geometry_id, GeomFromText(:wkt, :srid)
+                                        WHERE NOT EXISTS (SELECT 1 FROM package_extent_geometry
+                                                          WHERE id = :geometry_id)''', params)
+            Session.commit()
+            if result.rowcount:
+                break
+        except IntegrityError:
+            # Created by another import in the meantime
+            Session.rollback()
+    subdivide_geometry(geometry_id)
+    rank_hot_regions(geometry_id)
+    log.debug('Created new shared geometry %s' % geometry_id)
+
+def release_geometry(geometry_id):
+    '''Deletes the shared geometry with the given identifier (and its pieces)
+    if no package extent references it any more.
+
+    Package extent changes must have been flushed. The responsibility for
+    calling model.Session.commit() is left to the caller.
+    '''
+    if not geometry_id:
+        return
+    params = {'geometry_id': geometry_id}
+    # Wait for the imports referencing the geometry (see intern_geometry)
+    if not Session.execute('''SELECT 1 FROM package_extent_geometry
+                              WHERE id = :geometry_id FOR UPDATE''', params).first():
+        return
+    if Session.query(PackageExtent).filter(PackageExtent.geometry_id==geometry_id).count():
+        return
+    Session.execute('DELETE FROM package_extent_hot_region_geometry WHERE geometry_id = :geometry_id', params)
+    Session.execute('DELETE FROM package_extent_subdivided WHERE geometry_id = :geometry_id', params)
+    Session.execute('DELETE FROM package_extent_geometry WHERE id = :geometry_id', params)
+    log.debug('Deleted shared geometry %s' % geometry_id)
+
+def _get_postgis_version():
+    version = Session.execute('SELECT PostGIS_Lib_Version()').scalar()
+    return tuple(int(part) for part in version.split('.')[:2])
+
+def subdivide_supported():
+    '''Returns whether the PostGIS version of the database supports
+    ST_Subdivide (checked only once)'''
+    global _subdivide_supported
+    if _subdivide_supported is None:
+        try:
+            _subdivide_supported = _get_postgis_version() >= SUBDIVIDE_MIN_POSTGIS_VERSION
+        except Exception, e:
+            log.error('Could not get the PostGIS version: %r' % e)
+            _subdivide_supported = False
+        if not _subdivide_supported:
+            log.warning('ST_Subdivide requires PostGIS %i.%i or later, '
+                        'extents will not be subdivided' % SUBDIVIDE_MIN_POSTGIS_VERSION)
+    return _subdivide_supported
+
+def _get_subdivide_max_vertices():
+    return int(config.get('ckan.spatial.subdivide_max_vertices',
+                          DEFAULT_SUBDIVIDE_MAX_VERTICES))
+
+def subdivide_enabled():
+    '''Returns whether the shared geometries are stored split into pieces
+    in the package_extent_subdivided table, which is then the one checked
+    by the spatial queries (see subdivide_geometry)'''
+    return bool(_get_subdivide_max_vertices()) and subdivide_supported()
+
+def subdivide_geometry(geometry_id=None):
+    '''Regenerates the pieces of the given shared geometry (or of all
+    of them if none provided) stored in the package_extent_subdivided
+    table.
+
+    Complex geometries are split with ST_Subdivide into pieces with at most
+    ckan.spatial.subdivide_max_vertices vertices, so the index hits of a
+    spatial query can be checked against small geometries. If the option
+    is 0 (the default) or ST_Subdivide is not supported, no pieces are
+    stored and the spatial queries check the package_extent_geometry
+    table directly.
+
+    The responsibility for calling model.Session.commit() is left to the
+    caller.
+    '''
+    params = {'geometry_id': geometry_id}
+    if geometry_id:
+        Session.execute('DELETE FROM package_extent_subdivided WHERE geometry_id = :geometry_id', params)
+        where = 'WHERE id = :geometry_id'
+    else:
+        Session.execute('DELETE FROM package_extent_subdivided')
+        where = ''
+
+    if not subdivide_enabled():
+        return
+
+    Session.execute('''INSERT INTO package_extent_subdivided (geometry_id, the_geom)
+                       SELECT id, ST_Subdivide(the_geom, %i) FROM package_extent_geometry %s''' % \
+                        (_get_subdivide_max_vertices(), where),
+                    params)
+
+def rank_hot_regions(geometry_id=None):
+    '''Regenerates the list of hot regions matched by the given shared
+    geometry (or by all of them if none provided), along with the spatial
+    ranking of the geometry for each region (see
+    ckanext.spatial.lib.bbox_query_ordered).
+
+    The responsibility for calling model.Session.commit() is left to the
+    caller.
+    '''
+    params = {'geometry_id': geometry_id,
+              'srid': int(config.get('ckan.spatial.srid', DEFAULT_SRID))}
+    if geometry_id:
+        Session.execute('DELETE FROM package_extent_hot_region_geometry WHERE geometry_id = :geometry_id', params)
+        where = 'AND geometries.id = :geometry_id'
+    else:
+        Session.execute('DELETE FROM package_extent_hot_region_geometry')
+        where = ''
+
+    Session.execute('''INSERT INTO package_extent_hot_region_geometry (region_name, geometry_id, spatial_ranking)
+                       SELECT regions.name, geometries.id,
+                              POWER(ST_Area(ST_Intersection(geometries.the_geom, regions.the_geom)),2)
+                                  / NULLIF(ST_Area(geometries.the_geom), 0) / NULLIF(ST_Area(regions.the_geom), 0)
+                       FROM (SELECT name, ST_MakeEnvelope(minx, miny, maxx, maxy, :srid) AS the_geom
+                             FROM package_extent_hot_region) AS regions,
+                            package_extent_geometry AS geometries
+                       WHERE ST_Intersects(geometries.the_geom, regions.the_geom) %s''' % where,
+                    params)
 
 def define_spatial_tables(db_srid=None):
 
     global package_extent_table
+    global active_package_extent_table
+    global package_extent_geometry_table
+    global package_extent_subdivided_table
+    global package_extent_histogram_table
+    global package_extent_hot_region_table
+    global package_extent_hot_region_geometry_table
 
     if not db_srid:
         db_srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
@@ -69,15 +348,70 @@ def define_spatial_tables(db_srid=None):
 
     package_extent_table = Table('package_extent', meta.metadata,
                     Column('package_id', types.UnicodeText, primary_key=True),
+                    Column('geometry_id', types.UnicodeText, index=True))
+
+
+    meta.mapper(PackageExtent, package_extent_table)
+
+    active_package_extent_table = Table('active_package_extent', meta.metadata,
+                    Column('package_id', types.UnicodeText, primary_key=True),
+                    Column('geometry_id', types.UnicodeText, index=True))
+
+    meta.mapper(ActivePackageExtent, active_package_extent_table)
+
+    package_extent_geometry_table = Table('package_extent_geometry', meta.metadata,
+                    Column('id', types.UnicodeText, primary_key=True),
                     GeometryExtensionColumn('the_geom', Geometry(2,srid=db_srid)))
 
+    meta.mapper(PackageExtentGeometry, package_extent_geometry_table, properties={
+            'the_geom': GeometryColumn(package_extent_geometry_table.c.the_geom,
+                                            comparator=PGComparator)})
 
-    meta.mapper(PackageExtent, package_extent_table, properties={
-            'the_geom': GeometryColumn(package_extent_table.c.the_geom,
+    package_extent_subdivided_table = Table('package_extent_subdivided', meta.metadata,
+                    Column('id', types.Integer, primary_key=True),
+                    Column('geometry_id', types.UnicodeText, index=True),
+                    GeometryExtensionColumn('the_geom', Geometry(2,srid=db_srid)))
+
+    meta.mapper(PackageExtentPiece, package_extent_subdivided_table, properties={
+            'the_geom': GeometryColumn(package_extent_subdivided_table.c.the_geom,
                                             comparator=PGComparator)})
 
+    # Grid of cells covering all extents, with the number of extents
+    # whose bounding box centre falls in each cell and their average and
+    # maximum size.
+    # Used to estimate the selectivity of spatial queries (see
+    # ckanext.spatial.lib.update_extent_histogram)
+    package_extent_histogram_table = Table('package_extent_histogram', meta.metadata,
+                    Column('id', types.Integer, primary_key=True),
+                    Column('minx', types.Float),
+                    Column('miny', types.Float),
+                    Column('maxx', types.Float),
+                    Column('maxy', types.Float),
+                    Column('count', types.Integer),
+                    Column('avg_width', types.Float),
+                    Column('avg_height', types.Float),
+                    Column('max_width', types.Float),
+                    Column('max_height', types.Float))
+
+    package_extent_hot_region_table = Table('package_extent_hot_region', meta.metadata,
+                    Column('name', types.UnicodeText, primary_key=True),
+                    Column('minx', types.Float),
+                    Column('miny', types.Float),
+                    Column('maxx', types.Float),
+                    Column('maxy', types.Float))
+
+    meta.mapper(PackageExtentHotRegion, package_extent_hot_region_table)
+
+    package_extent_hot_region_geometry_table = Table('package_extent_hot_region_geometry', meta.metadata,
+                    Column('region_name', types.UnicodeText, primary_key=True),
+                    Column('geometry_id', types.UnicodeText, primary_key=True, index=True),
+                    Column('spatial_ranking', types.Float))
+
+    meta.mapper(PackageExtentHotRegionGeometry, package_extent_hot_region_geometry_table)
+
     # enable the DDL extension
-    GeometryDDL(package_extent_table)
+    GeometryDDL(package_extent_geometry_table)
+    GeometryDDL(package_extent_subdivided_table)
 
 
 
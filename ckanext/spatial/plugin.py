@@ -18,13 +18,16 @@ from ckan.plugins import IRoutes
 from ckan.plugins import IConfigurable, IConfigurer
 from ckan.plugins import IGenshiStreamFilter
 from ckan.plugins import IPackageController
+from ckan.plugins import IDomainObjectModification
 
 from ckan.logic import ValidationError
 
 import html
 
-from ckanext.spatial.lib import save_package_extent,validate_bbox, bbox_query, bbox_query_ordered
-from ckanext.spatial.model.package_extent import setup as setup_model
+from ckanext.spatial.lib import save_package_extent,validate_bbox, bbox_query, bbox_query_ordered, plan_bbox_query, \
+                                bbox_query_has_private
+from ckanext.spatial.model.package_extent import setup as setup_model, update_active_package_extent
+from ckanext.spatial.lib import stats
 
 log = getLogger(__name__)
 
@@ -52,11 +55,19 @@ class SpatialMetadata(SingletonPlugin):
 
     implements(IPackageController, inherit=True)
     implements(IConfigurable, inherit=True)
+    implements(IDomainObjectModification, inherit=True)
 
     def configure(self, config):
         if not config.get('ckan.spatial.testing',False):
             setup_model()
 
+    def notify(self, entity, operation):
+        # Package state changes made straight on the model (e.g.
+        # Package.delete()) don't go through the IPackageController hooks.
+        # This is called before the changes are committed.
+        if isinstance(entity, model.Package):
+            update_active_package_extent(entity.id)
+
 
     def create(self, package):
         self.check_spatial_extra(package)
@@ -88,7 +99,8 @@ class SpatialMetadata(SingletonPlugin):
                         raise ValidationError(error_dict, error_summary=package_error_summary(error_dict))
 
                     try:
-                        save_package_extent(package.id,geometry)
+                        with stats.timer('extent_save'):
+                            save_package_extent(package.id,geometry)
 
                     except ValueError,e:
                         error_dict = {'spatial':[u'Error creating geometry: %s' % str(e)]}
@@ -152,7 +164,25 @@ class SpatialQuery(SingletonPlugin):
                     (extent.package_id, extent.spatial_ranking) \
                     for extent in extents[start:start+rows]]
             else:
+                plan = plan_bbox_query(bbox, search_params)
+                if plan == 'world':
+                    # All datasets with an extent match, no need to run
+                    # the spatial query
+                    q = search_params.get('q','').strip() or '""'
+                    new_q = '%s AND ' % q if q else ''
+                    new_q += 'extras_spatial:[* TO *]'
+                    search_params['q'] = new_q
+                    return search_params
+
                 extents = bbox_query(bbox)
+                if plan == 'count' and not bbox_query_has_private(extents):
+                    # Only the number of results was requested, which
+                    # after_search will provide. Private datasets would
+                    # not be counted by the search.
+                    search_params['extras']['ext_spatial_count'] = extents.count()
+                    search_params['abort_search'] = True
+                    return search_params
+
                 are_no_results = extents.count() == 0
 
             if are_no_results:
@@ -172,6 +202,8 @@ class SpatialQuery(SingletonPlugin):
         return search_params
 
     def after_search(self, search_results, search_params):
+        if 'ext_spatial_count' in search_params.get('extras', {}):
+            search_results['count'] = search_params['extras']['ext_spatial_count']
         if search_params.get('extras', {}).get('ext_spatial'):
             # Apply the spatial sort
             querier = PackageSearchQuery()
@@ -320,6 +352,8 @@ class HarvestMetadataApi(SingletonPlugin):
                           action="display_xml")
         route_map.connect("/api/2/rest/harvestobject/:id/html", controller=controller,
                           action="display_html")
+        route_map.connect("/api/2/rest/harvestjob/:id/stats", controller=controller,
+                          action="job_stats")
 
         return route_map
 
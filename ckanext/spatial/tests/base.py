@@ -6,6 +6,7 @@ from nose.plugins.skip import SkipTest
 
 from ckan.model import Session, repo, meta, engine_is_sqlite
 from ckanext.spatial.model.package_extent import setup as spatial_db_setup, define_spatial_tables
+from ckanext.spatial.model.harvest_state import setup as harvest_state_setup
 from ckanext.harvest.model import setup as harvest_model_setup
 
 def setup_postgis_tables():
@@ -50,6 +51,7 @@ class SpatialTestBase:
 
         # Setup the harvest tables
         harvest_model_setup()
+        harvest_state_setup()
 
     @classmethod
     def teardown_class(cls):
@@ -6,7 +6,7 @@ from ckan.lib.helpers import url_for,json
 
 from ckan.tests import CreateTestData
 from ckan.tests.functional.base import FunctionalTestCase
-from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model import PackageExtent, PackageExtentGeometry
 
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -50,9 +50,10 @@ class TestPackageController(FunctionalTestCase,SpatialTestBase):
 
         assert package_extent
         assert package_extent.package_id == package.id
-        assert Session.scalar(package_extent.the_geom.x) == geojson['coordinates'][0]
-        assert Session.scalar(package_extent.the_geom.y) == geojson['coordinates'][1]
-        assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+        geometry = Session.query(PackageExtentGeometry).get(package_extent.geometry_id)
+        assert Session.scalar(geometry.the_geom.x) == geojson['coordinates'][0]
+        assert Session.scalar(geometry.the_geom.y) == geojson['coordinates'][1]
+        assert Session.scalar(geometry.the_geom.srid) == self.db_srid
 
     def test_new_bad_json(self):
         name = 'test-spatial-dataset-2'
@@ -117,9 +118,10 @@ class TestPackageController(FunctionalTestCase,SpatialTestBase):
 
         assert package_extent
         assert package_extent.package_id == package.id
-        assert Session.scalar(package_extent.the_geom.x) == geojson['coordinates'][0]
-        assert Session.scalar(package_extent.the_geom.y) == geojson['coordinates'][1]
-        assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+        geometry = Session.query(PackageExtentGeometry).get(package_extent.geometry_id)
+        assert Session.scalar(geometry.the_geom.x) == geojson['coordinates'][0]
+        assert Session.scalar(geometry.the_geom.y) == geojson['coordinates'][1]
+        assert Session.scalar(geometry.the_geom.srid) == self.db_srid
 
         # Update the spatial extra
         offset = url_for(controller='package', action='edit',id=name)
@@ -136,6 +138,7 @@ class TestPackageController(FunctionalTestCase,SpatialTestBase):
         package_extent = Session.query(PackageExtent).filter(PackageExtent.package_id==package.id).first()
         assert package_extent
         assert package_extent.package_id == package.id
-        assert Session.scalar(package_extent.the_geom.geometry_type) == 'ST_Polygon'
-        assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+        geometry = Session.query(PackageExtentGeometry).get(package_extent.geometry_id)
+        assert Session.scalar(geometry.the_geom.geometry_type) == 'ST_Polygon'
+        assert Session.scalar(geometry.the_geom.srid) == self.db_srid
 
@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.bench import find_documents, run_benchmark
+
+XML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xml')
+
+class TestHarvestBench:
+
+    def test_find_documents(self):
+        paths = find_documents(os.path.join(XML_PATH, 'gemini2.1'))
+
+        assert os.path.join(XML_PATH, 'gemini2.1', 'dataset1.xml') in paths
+        assert os.path.join(XML_PATH, 'gemini2.1', 'source1', 'same_dataset.xml') in paths
+
+    def test_run(self):
+        profile = tempfile.mktemp()
+        try:
+            result = run_benchmark(os.path.join(XML_PATH, 'gemini2.1', 'source1'),
+                                   copies=3, profile=profile)
+            assert os.path.exists(profile)
+        finally:
+            if os.path.exists(profile):
+                os.remove(profile)
+
+        assert_equal(result['documents'], 3)
+        assert_equal(result['errors'], 0)
+        assert result['documents_per_second'] > 0
+        for step in ('parse', 'digest', 'validate', 'extract', 'package_dict'):
+            assert_equal(result['steps'][step]['count'], 3)
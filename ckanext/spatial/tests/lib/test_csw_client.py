@@ -0,0 +1,206 @@
+import time
+from datetime import datetime
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.spatial.lib import fetch
+from ckanext.spatial.lib.csw_client import CswService, CswError, modified_since_filter
+from ckanext.spatial.lib.fetch import ResponseTooLarge
+
+class FakeCatalogueServiceWeb(object):
+
+    created = 0
+
+    def __init__(self, endpoint):
+        FakeCatalogueServiceWeb.created += 1
+        self.url = endpoint
+        self.records = {}
+
+class FakeCswService(CswService):
+    _Implementation = FakeCatalogueServiceWeb
+
+class TestCachedCswService:
+
+    def setup(self):
+        FakeCatalogueServiceWeb.created = 0
+        FakeCswService._clients.clear()
+
+    def test_capabilities_requested_once(self):
+        first = FakeCswService.cached('http://csw1')
+        second = FakeCswService.cached('http://csw1')
+        other = FakeCswService.cached('http://csw2')
+
+        assert_equal(FakeCatalogueServiceWeb.created, 2)
+        assert_equal(other._ows().url, 'http://csw2')
+
+        # Each service gets its own client
+        assert first._ows() is not second._ows()
+        first._ows().records = {'a': 1}
+        assert_equal(second._ows().records, {})
+
+    def test_ttl(self):
+        FakeCswService.cached('http://csw1', ttl=0)
+        time.sleep(0.01)
+        FakeCswService.cached('http://csw1', ttl=0)
+
+        assert_equal(FakeCatalogueServiceWeb.created, 2)
+
+    def test_forget(self):
+        FakeCswService.cached('http://csw1')
+        FakeCswService.forget('http://csw1')
+        FakeCswService.cached('http://csw1')
+
+        assert_equal(FakeCatalogueServiceWeb.created, 2)
+
+
+GETRECORDS_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+    xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco">
+  <csw:SearchResults numberOfRecordsMatched="3" numberOfRecordsReturned="%(returned)s" nextRecord="%(next)s">
+    %(records)s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>'''
+
+RECORD = '''<gmd:MD_Metadata>
+      <gmd:fileIdentifier><gco:CharacterString> %s </gco:CharacterString></gmd:fileIdentifier>
+    </gmd:MD_Metadata>'''
+
+class FakeResponse(object):
+
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, body):
+        self.body = body
+        self.headers = {}
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), size):
+            yield self.body[i:i + size]
+
+    def close(self):
+        pass
+
+class FakeSession(object):
+
+    def __init__(self, respond):
+        self.respond = respond
+
+    def request(self, method, url, data=None, headers=None, timeout=None, stream=False):
+        return FakeResponse(self.respond(url, data))
+
+class TestGetRecordsXml:
+
+    def setup(self):
+        self.requests = []
+        self._get_session = fetch.get_session
+        fetch.get_session = lambda: FakeSession(self.respond)
+        self.service = FakeCswService.cached('http://csw1')
+        self.exception = False
+
+    def teardown(self):
+        fetch.get_session = self._get_session
+        FakeCswService._clients.clear()
+
+    def respond(self, url, data):
+        self.requests.append(data)
+        if self.exception:
+            return ('''<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows">
+                <ows:Exception><ows:ExceptionText>Bad request</ows:ExceptionText></ows:Exception>
+                </ows:ExceptionReport>''')
+        if len(self.requests) == 1:
+            return (GETRECORDS_RESPONSE % {'returned': 2, 'next': 3,
+                'records': RECORD % 'id-1' + RECORD % 'id-2'})
+        return (GETRECORDS_RESPONSE % {'returned': 1, 'next': 0,
+            'records': RECORD % 'id-3'})
+
+    def test_pages(self):
+        records = list(self.service.getrecords_xml(page=2))
+
+        assert_equal([identifier for identifier, xml in records],
+                     ['id-1', 'id-2', 'id-3'])
+        assert '<gco:CharacterString> id-2 </gco:CharacterString>' in records[1][1]
+        assert_equal(len(self.requests), 2)
+        assert 'startPosition="1"' in self.requests[0]
+        assert 'startPosition="3"' in self.requests[1]
+        assert 'maxRecords="2"' in self.requests[0]
+        assert '<csw:ElementSetName>full</csw:ElementSetName>' in self.requests[0]
+
+    def test_exception(self):
+        self.exception = True
+        assert_raises(CswError, list, self.service.getrecords_xml())
+
+    def test_constraint(self):
+        constraint = modified_since_filter(datetime(2012, 5, 1, 10, 30), 'apiso:RevisionDate')
+        list(self.service.getrecords_xml(esn='brief', constraint=constraint))
+
+        request = self.requests[0]
+        assert '<csw:ElementSetName>brief</csw:ElementSetName>' in request
+        assert '<ogc:PropertyName>apiso:RevisionDate</ogc:PropertyName>' in request
+        assert '<ogc:Literal>2012-05-01T10:30:00Z</ogc:Literal>' in request
+        assert request.index('ElementSetName') < request.index('Constraint')
+
+    def test_size_limit(self):
+        assert_raises(ResponseTooLarge, list, self.service.getrecords_xml(max_size=100))
+
+    def test_getrecordbyid_xml(self):
+        self.respond = lambda url, data: GETRECORDS_RESPONSE % {
+            'returned': 1, 'next': 0, 'records': RECORD % 'id-1'}
+
+        xml = self.service.getrecordbyid_xml(u'id-1')
+
+        assert xml.startswith('<?xml')
+        assert '<gco:CharacterString> id-1 </gco:CharacterString>' in xml
+        assert not 'SearchResults' in xml
+
+
+class PagedCatalogueServiceWeb(object):
+
+    requests = []
+    total = 25
+
+    def __init__(self, endpoint):
+        self.url = endpoint
+        self.operations = []
+
+    def getrecords(self, startposition=0, maxrecords=10, **kw):
+        PagedCatalogueServiceWeb.requests.append((startposition, maxrecords))
+        self.exceptionreport = None
+        last = min(startposition + maxrecords, self.total + 1)
+        self.records = dict(('id-%02i' % i, None) for i in range(startposition, last))
+        self.results = {'matches': self.total, 'returned': len(self.records),
+                        'nextrecord': last if last <= self.total else 0}
+
+class PagedCswService(CswService):
+    _Implementation = PagedCatalogueServiceWeb
+
+class TestGetIdentifiers:
+
+    def setup(self):
+        PagedCatalogueServiceWeb.requests = []
+        self.service = PagedCswService('http://csw1')
+
+    def test_adaptive_pages(self):
+        identifiers = list(self.service.getidentifiers(page=2, max_page=8))
+
+        assert_equal(sorted(identifiers), ['id-%02i' % i for i in range(1, 26)])
+        # Pages grow while the server is fast, and the last one only asks
+        # for the remaining records
+        assert_equal(PagedCatalogueServiceWeb.requests,
+                     [(1, 2), (3, 4), (7, 8), (15, 8), (23, 3)])
+
+    def test_server_max_records(self):
+        class Operation:
+            name = 'GetRecords'
+            constraints = [{'name': 'MaxRecordDefault', 'values': ['4']}]
+        self.service._ows().operations = [Operation()]
+
+        list(self.service.getidentifiers(page=2, max_page=8))
+
+        assert max(size for start, size in PagedCatalogueServiceWeb.requests) == 4
+
+    def test_limit(self):
+        identifiers = list(self.service.getidentifiers(page=2, limit=5))
+
+        assert_equal(len(identifiers), 5)
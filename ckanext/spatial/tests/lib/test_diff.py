@@ -0,0 +1,47 @@
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.diff import bounded_unified_diff
+
+class TestBoundedUnifiedDiff:
+
+    a = '\n'.join('line %i' % i for i in range(100))
+    b = a.replace('line 10\n', 'line ten\n').replace('line 50\n', '')
+
+    def test_diff(self):
+        diff = bounded_unified_diff(self.a, self.b)
+
+        assert_equal(diff.split('\n')[:8], [
+            '@@ -8,7 +8,7 @@',
+            ' line 7',
+            ' line 8',
+            ' line 9',
+            '-line 10',
+            '+line ten',
+            ' line 11',
+            ' line 12'])
+        assert '@@ -48,7 +48,6 @@\n line 47\n line 48\n line 49\n-line 50\n line 51' in diff
+
+    def test_max_hunks(self):
+        diff = bounded_unified_diff(self.a, self.b, max_hunks=1)
+
+        assert not '-line 50' in diff
+        assert diff.endswith('(diff truncated after 1 hunks)')
+
+    def test_max_lines(self):
+        diff = bounded_unified_diff(self.a, self.b, max_lines=20)
+
+        assert '+line ten' in diff
+        assert not '-line 50' in diff
+
+    def test_identical(self):
+        assert_equal(bounded_unified_diff(self.a, self.a), '')
+
+    def test_max_bytes(self):
+        # A single line document
+        a = '<a>' + 'x' * 1000 + '</a>'
+        b = '<a>' + 'y' * 1000 + '</a>'
+        diff = bounded_unified_diff(a, b, max_bytes=100)
+
+        assert len(diff) < 300, len(diff)
+        assert diff.startswith('@@ -1,1 +1,1 @@\n-<a>xxx')
+        assert diff.endswith('(diff truncated after 100 characters)')
@@ -0,0 +1,145 @@
+import time
+import random
+import threading
+import urllib2
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.spatial.lib import fetch
+from ckanext.spatial.lib.fetch import fetch_all, call, BoundedResponse, ResponseTooLarge, \
+                                     HostUnavailable
+
+class TestFetchAll:
+
+    def test_order(self):
+        def fetch(url):
+            time.sleep(random.uniform(0, 0.05))
+            return url.upper()
+
+        urls = ['http://host%i/doc%i.xml' % (i % 3, i) for i in range(30)]
+        results = list(fetch_all(urls, fetch, workers=5))
+
+        assert_equal([url for url, content, error in results], urls)
+        assert_equal([content for url, content, error in results],
+                     [url.upper() for url in urls])
+
+    def test_errors(self):
+        def fetch(url):
+            if url.endswith('2'):
+                raise IOError('Not found')
+            return url
+
+        results = list(fetch_all(['http://host/1', 'http://host/2', 'http://host/3'], fetch))
+
+        assert_equal(results[0], ('http://host/1', 'http://host/1', None))
+        assert_equal(results[1][1], None)
+        assert isinstance(results[1][2], IOError)
+        assert_equal(results[2], ('http://host/3', 'http://host/3', None))
+
+    def test_workers_per_host(self):
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+
+        def fetch(url):
+            host = url.split('/')[2]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+            return url
+
+        urls = ['http://host%i/doc%i.xml' % (i % 2, i) for i in range(40)]
+        list(fetch_all(urls, fetch, workers=8, workers_per_host=2))
+
+        assert max(max_running.values()) <= 2, max_running
+
+    def test_empty(self):
+        assert_equal(list(fetch_all([], lambda url: url)), [])
+
+class TestBoundedResponse:
+
+    def test_read(self):
+        response = BoundedResponse(['x' * 30, 'y' * 70], max_size=100)
+        assert_equal(response.read(20), 'x' * 20)
+        assert_equal(response.read(20), 'x' * 10 + 'y' * 10)
+        assert_equal(response.read(), 'y' * 60)
+        assert_equal(response.read(), '')
+
+    def test_too_large(self):
+        response = BoundedResponse(['x' * 60, 'x' * 41], max_size=100)
+        assert_raises(ResponseTooLarge, response.read)
+
+        response = BoundedResponse(['x' * 60, 'x' * 41], max_size=100)
+        assert_equal(response.read(60), 'x' * 60)
+        assert_raises(ResponseTooLarge, response.read, 60)
+
+    def test_content_length(self):
+        closed = []
+        assert_raises(ResponseTooLarge, BoundedResponse, ['x'], max_size=100,
+                      headers={'Content-Length': '101'}, on_close=lambda: closed.append(1))
+        assert_equal(closed, [1])
+
+class TestSession:
+
+    def teardown(self):
+        fetch.configure(host_concurrency=fetch.DEFAULT_HOST_CONCURRENCY)
+
+    def test_shared(self):
+        session = fetch.get_session()
+        assert fetch.get_session() is session
+        assert_equal(session.headers['Accept-Encoding'], 'gzip, deflate')
+
+        # Changing the policy resizes the pools of a new session
+        fetch.configure(host_concurrency=2)
+        assert fetch.get_session() is not session
+        assert_equal(fetch.get_session().get_adapter('http://host1/')._pool_maxsize, 2)
+
+class TestCall:
+
+    def setup(self):
+        fetch.configure(retries=2, backoff=0, breaker_threshold=5, breaker_reset=60)
+        self.calls = 0
+
+    def teardown(self):
+        fetch.configure(retries=fetch.DEFAULT_RETRIES, backoff=fetch.DEFAULT_BACKOFF,
+                        breaker_threshold=fetch.DEFAULT_BREAKER_THRESHOLD,
+                        breaker_reset=fetch.DEFAULT_BREAKER_RESET)
+
+    def _request(self, failures, error=None):
+        def request():
+            self.calls += 1
+            if self.calls <= failures:
+                raise error or urllib2.URLError('Connection refused')
+            return 'content'
+        return request
+
+    def test_retry(self):
+        assert_equal(call('http://host1/doc', self._request(2)), 'content')
+        assert_equal(self.calls, 3)
+
+    def test_retries_exhausted(self):
+        assert_raises(urllib2.URLError, call, 'http://host1/doc', self._request(3))
+        assert_equal(self.calls, 3)
+
+    def test_no_retry(self):
+        error = urllib2.HTTPError('http://host1/doc', 404, 'Not Found', {}, None)
+        assert_raises(urllib2.HTTPError, call, 'http://host1/doc', self._request(1, error))
+        assert_equal(self.calls, 1)
+
+    def test_circuit_breaker(self):
+        fetch.configure(retries=0)
+        for i in range(5):
+            assert_raises(urllib2.URLError, call, 'http://host1/doc', self._request(10))
+        assert_raises(HostUnavailable, call, 'http://host1/doc', self._request(10))
+        assert_equal(self.calls, 5)
+
+        # Other hosts are not affected
+        assert_equal(call('http://host2/doc', lambda: 'content'), 'content')
+
+        # The host is tried again after a while
+        fetch._settings['breaker_reset'] = 0
+        assert_equal(call('http://host1/doc', lambda: 'content'), 'content')
+
@@ -0,0 +1,62 @@
+import os
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckan.model import Session
+from ckanext.harvest.model import HarvestObject
+from ckanext.spatial.model import GeminiDocument
+from ckanext.spatial.lib import import_pool
+from ckanext.spatial.lib.import_pool import import_job_objects
+from ckanext.spatial.tests.test_harvest import HarvestFixtureBase
+
+class TestImportPool(HarvestFixtureBase):
+
+    def _create_job_objects(self):
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset1.xml',
+            'type': u'gemini-single'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        object_ids = []
+        for file_name in ('dataset1.xml', 'service1.xml'):
+            with open(os.path.join(os.path.dirname(__file__), '..', 'xml',
+                                   'gemini2.1', file_name)) as f:
+                content = f.read()
+            obj = HarvestObject(guid=GeminiDocument(content).read_value('guid'),
+                                job=job, content=content.decode('utf8'))
+            obj.save()
+            object_ids.append(obj.id)
+        return job, object_ids
+
+    def _assert_imported(self, object_ids):
+        Session.remove()
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert_equal(len(obj.errors), 0)
+            assert obj.current
+            assert obj.package_id
+
+    def test_init_worker(self):
+        # Workers don't use the connections inherited from the parent
+        disposed = []
+        model.meta.engine.dispose = lambda: disposed.append(True)
+        try:
+            import_pool._init_worker()
+        finally:
+            del model.meta.engine.dispose
+        assert_equal(disposed, [True])
+
+    def test_import_batch(self):
+        # What each worker runs, in this process
+        job, object_ids = self._create_job_objects()
+
+        assert_equal(import_pool._import_batch((u'gemini-single', object_ids)), 2)
+        self._assert_imported(object_ids)
+
+    def test_import_job_objects(self):
+        job, object_ids = self._create_job_objects()
+
+        assert_equal(import_job_objects(job.id, workers=2, batch_size=1), (2, 2))
+        self._assert_imported(object_ids)
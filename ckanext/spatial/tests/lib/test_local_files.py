@@ -0,0 +1,67 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.local_files import iter_documents, parse_documents
+
+XML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xml', 'gemini2.1')
+
+class TestLocalFiles:
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source')
+        os.makedirs(os.path.join(self.source, 'services'))
+        shutil.copy(os.path.join(XML_PATH, 'dataset1.xml'), self.source)
+        shutil.copy(os.path.join(XML_PATH, 'service1.xml'),
+                    os.path.join(self.source, 'services'))
+        open(os.path.join(self.source, 'readme.txt'), 'w').write('Not a document')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def _names(self, path, max_size=None):
+        return sorted(name for name, content in iter_documents(path, max_size))
+
+    def test_directory(self):
+        assert_equal(self._names(self.source),
+                     ['dataset1.xml', os.path.join('services', 'service1.xml')])
+
+    def test_zip(self):
+        path = os.path.join(self.tmp, 'source.zip')
+        archive = zipfile.ZipFile(path, 'w')
+        archive.write(os.path.join(self.source, 'dataset1.xml'), 'dataset1.xml')
+        archive.write(os.path.join(self.source, 'readme.txt'), 'readme.txt')
+        archive.close()
+
+        assert_equal(self._names(path), ['dataset1.xml'])
+
+    def test_tar(self):
+        path = os.path.join(self.tmp, 'source.tar.gz')
+        archive = tarfile.open(path, 'w:gz')
+        archive.add(self.source, 'source')
+        archive.close()
+
+        assert_equal(self._names(path),
+                     ['source/dataset1.xml', 'source/services/service1.xml'])
+
+    def test_max_size(self):
+        documents = dict(iter_documents(self.source, max_size=10))
+
+        assert_equal(documents['dataset1.xml'], None)
+
+    def test_parse_documents(self):
+        documents = list(iter_documents(self.source))
+        results = [result for chunk in parse_documents(documents, ['gemini2'], workers=2, chunk_size=1)
+                   for result in chunk]
+
+        assert_equal([name for name, gemini_string, guid, validation, error in results],
+                     [name for name, content in documents])
+        for name, gemini_string, guid, validation, error in results:
+            assert_equal(error, None)
+            assert guid
+            assert gemini_string.startswith('<gmd:MD_Metadata')
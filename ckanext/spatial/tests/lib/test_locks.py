@@ -0,0 +1,86 @@
+import threading
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckan.model import meta
+from ckanext.spatial.lib.locks import lock_key, advisory_lock, advisory_locks, LockNotAvailable
+from ckanext.spatial.tests.base import SpatialTestBase
+
+class TestLockKey:
+
+    def test_same_name(self):
+        assert_equal(lock_key(u'guid-1'), lock_key('guid-1'))
+
+    def test_different_names(self):
+        assert lock_key(u'guid-1') != lock_key(u'guid-2')
+
+    def test_key_range(self):
+        for name in (None, u'', u'guid-1', u'\xe9t\xe9'):
+            key = lock_key(name)
+            assert 0 <= key < 2 ** 63, key
+
+class TestAdvisoryLocks(SpatialTestBase):
+
+    def _is_locked(self, name):
+        # Tries to take the lock from another connection
+        conn = meta.engine.connect()
+        try:
+            key = lock_key(name)
+            if conn.execute('SELECT pg_try_advisory_lock(%s)' % key).scalar():
+                conn.execute('SELECT pg_advisory_unlock(%s)' % key)
+                return False
+            return True
+        finally:
+            conn.close()
+
+    def test_advisory_lock(self):
+        with advisory_lock(u'guid-1'):
+            assert self._is_locked(u'guid-1')
+            assert not self._is_locked(u'guid-2')
+        assert not self._is_locked(u'guid-1')
+
+    def test_advisory_locks(self):
+        with advisory_locks([u'guid-1', u'guid-2', u'guid-1']) as lock:
+            assert self._is_locked(u'guid-1')
+            assert self._is_locked(u'guid-2')
+            assert not self._is_locked(u'guid-3')
+            lock(u'guid-3')
+            assert self._is_locked(u'guid-3')
+        for name in (u'guid-1', u'guid-2', u'guid-3'):
+            assert not self._is_locked(name)
+
+    def test_lock_out_of_order(self):
+        # Waiting for a lock with a lower key than the ones held could
+        # deadlock, so it is only taken if it is free
+        low, high = sorted([u'guid-1', u'guid-2'], key=lock_key)
+        with advisory_lock(low):
+            with advisory_locks([high]) as lock:
+                assert_raises(LockNotAvailable, lock, low)
+        with advisory_locks([high]) as lock:
+            lock(low)
+            assert self._is_locked(low)
+        assert not self._is_locked(low)
+
+    def test_contention(self):
+        # Blocks locking the same names in a different order wait for each
+        # other rather than deadlocking
+        events = []
+        started = threading.Event()
+
+        def hold(names, label):
+            with advisory_locks(names):
+                events.append(label)
+                started.set()
+                time.sleep(0.2)
+                events.append(label)
+
+        first = threading.Thread(target=hold, args=([u'guid-1', u'guid-2'], 'first'))
+        first.start()
+        started.wait()
+        second = threading.Thread(target=hold, args=([u'guid-2', u'guid-1'], 'second'))
+        second.start()
+        first.join()
+        second.join()
+
+        assert_equal(events, ['first', 'first', 'second', 'second'])
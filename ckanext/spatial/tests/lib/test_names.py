@@ -0,0 +1,31 @@
+from nose.tools import assert_equal
+
+from ckan import model
+from ckan.model import Session, Package
+from ckanext.spatial.lib.names import allocate_package_name
+from ckanext.spatial.tests.base import SpatialTestBase
+
+class TestAllocatePackageName(SpatialTestBase):
+
+    def _create_packages(self, *names):
+        model.repo.new_revision()
+        for name in names:
+            Session.add(Package(name=name))
+        model.repo.commit_and_remove()
+
+    def test_free_stem(self):
+        assert_equal(allocate_package_name(u'land-cover'), u'land-cover')
+        assert_equal(allocate_package_name(u'land-cover'), u'land-cover1')
+        assert_equal(allocate_package_name(u'land-cover'), u'land-cover2')
+
+    def test_existing_names(self):
+        self._create_packages(u'rivers', u'rivers1', u'rivers7', u'rivers-map')
+
+        assert_equal(allocate_package_name(u'rivers'), u'rivers8')
+        assert_equal(allocate_package_name(u'rivers'), u'rivers9')
+
+    def test_name_taken_afterwards(self):
+        assert_equal(allocate_package_name(u'roads'), u'roads')
+        self._create_packages(u'roads', u'roads1')
+
+        assert_equal(allocate_package_name(u'roads'), u'roads2')
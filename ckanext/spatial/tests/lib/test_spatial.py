@@ -1,14 +1,21 @@
 import time
+import math
 import random
 
 from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
 
 from ckan import model
+from ckan.lib.base import config
 from ckan.lib.helpers import json
 from ckan.logic.schema import default_create_package_schema
 from ckan.logic.action.create import package_create
 from ckan.lib.munge import munge_title_to_name
-from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered, bbox_query_ordered_2
+from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered, bbox_query_ordered_2, \
+    update_extent_histogram, estimate_bbox_query, plan_bbox_query, update_hot_regions, get_hot_region
+from ckanext.spatial import lib as spatial_lib
+from ckanext.spatial.model import PackageExtent, ActivePackageExtent, PackageExtentGeometry, PackageExtentPiece
+from ckanext.spatial.model.package_extent import subdivide_supported
 from ckanext.spatial.tests.base import SpatialTestBase
 
 class TestValidateBbox:
@@ -79,6 +86,28 @@ class TestBboxQuery(SpatialQueryTestBase):
         assert_equal(set(package_titles),
                      set(('(0, 3)', '(0, 4)', '(4, 5)')))
 
+    def test_no_pieces(self):
+        # Subdivision is disabled by default, the geometries are checked
+        # directly
+        assert_equal(model.Session.query(PackageExtentPiece).count(), 0)
+
+class TestBboxQueryActivePackages(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 1), (0, 3), (0, 4)]
+
+    def test_deleted_package(self):
+        assert_equal(model.Session.query(ActivePackageExtent).count(), 3)
+
+        model.repo.new_revision()
+        model.Package.get(munge_title_to_name(str((0, 3)))).delete()
+        model.repo.commit_and_remove()
+
+        assert_equal(model.Session.query(ActivePackageExtent).count(), 2)
+        bbox_dict = self.x_values_to_bbox((0, 5))
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query(bbox_dict)]
+        assert_equal(set(package_titles), set(('(0, 1)', '(0, 4)')))
+
 class TestBboxQueryOrdered(SpatialQueryTestBase):
     # x values for the fixtures
     fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5),
@@ -97,6 +126,191 @@ class TestBboxQueryOrdered(SpatialQueryTestBase):
                      ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
 
 
+class TestBboxQuerySubdivided(SpatialQueryTestBase):
+    fixtures_x = [(0, 1)]
+
+    @classmethod
+    def setup_class(cls):
+        cls.original_max_vertices = config.get('ckan.spatial.subdivide_max_vertices')
+        config['ckan.spatial.subdivide_max_vertices'] = '256'
+        SpatialQueryTestBase.setup_class()
+        # A circle of radius 10 centred on (50, 50), with 1000 vertices
+        coordinates = [[50 + 10 * math.cos(2 * math.pi * i / 1000),
+                        50 + 10 * math.sin(2 * math.pi * i / 1000)]
+                       for i in xrange(1000)]
+        coordinates.append(coordinates[0])
+        cls.create_package(name=u'circle', title=u'circle',
+                           extras=[{'key': 'spatial',
+                                    'value': json.dumps({'type': 'Polygon',
+                                                         'coordinates': [coordinates]})}])
+
+    @classmethod
+    def teardown_class(cls):
+        SpatialQueryTestBase.teardown_class()
+        if cls.original_max_vertices is None:
+            del config['ckan.spatial.subdivide_max_vertices']
+        else:
+            config['ckan.spatial.subdivide_max_vertices'] = cls.original_max_vertices
+
+    def test_pieces(self):
+        if not subdivide_supported():
+            raise SkipTest('ST_Subdivide is not supported by this PostGIS version')
+        package = model.Package.get('circle')
+        extent = model.Session.query(PackageExtent) \
+                 .filter(PackageExtent.package_id==package.id).one()
+        pieces = model.Session.query(PackageExtentPiece) \
+                 .filter(PackageExtentPiece.geometry_id==extent.geometry_id).count()
+        assert pieces > 1, pieces
+
+    def test_query(self):
+        bbox_dict = {'minx': 45, 'miny': 45, 'maxx': 55, 'maxy': 55}
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query(bbox_dict)]
+        assert_equal(package_titles, ['circle'])
+
+    def test_query_corner(self):
+        # Inside the extent's bounding box but outside the circle
+        bbox_dict = {'minx': 40, 'miny': 40, 'maxx': 41, 'maxy': 41}
+        assert_equal(bbox_query(bbox_dict).count(), 0)
+
+    def test_query_ordered(self):
+        bbox_dict = {'minx': 45, 'miny': 45, 'maxx': 55, 'maxy': 55}
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query_ordered(bbox_dict)]
+        assert_equal(package_titles, ['circle'])
+
+
+class TestBboxQuerySharedGeometries(SpatialQueryTestBase):
+    fixtures_x = [(0, 3), (4, 5)]
+
+    @classmethod
+    def setup_class(cls):
+        SpatialQueryTestBase.setup_class()
+        # Same extent as the first fixture
+        cls.create_package(name=u'copy', title=u'copy',
+                           extras=[{'key': 'spatial',
+                                    'value': bbox_2_geojson(cls.x_values_to_bbox((0, 3)))}])
+
+    def test_shared_geometry(self):
+        extents = model.Session.query(PackageExtent).all()
+        assert_equal(len(extents), 3)
+        assert_equal(len(set([extent.geometry_id for extent in extents])), 2)
+        assert_equal(model.Session.query(PackageExtentGeometry).count(), 2)
+
+    def test_query(self):
+        bbox_dict = self.x_values_to_bbox((2, 3))
+        assert_equal(bbox_query(bbox_dict).count(), 2)
+        assert_equal(len(bbox_query_ordered(bbox_dict)), 2)
+
+
+class TestBboxQueryHotRegions(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5),
+                  (8, 9)]
+
+    @classmethod
+    def setup_class(cls):
+        SpatialQueryTestBase.setup_class()
+        cls.original_hot_regions = config.get('ckan.spatial.hot_regions')
+        config['ckan.spatial.hot_regions'] = 'test:2,0,7,1'
+        update_hot_regions()
+
+    @classmethod
+    def teardown_class(cls):
+        SpatialQueryTestBase.teardown_class()
+        if cls.original_hot_regions is None:
+            del config['ckan.spatial.hot_regions']
+        else:
+            config['ckan.spatial.hot_regions'] = cls.original_hot_regions
+
+    def test_get_hot_region(self):
+        assert_equal(get_hot_region(self.x_values_to_bbox((2.001, 6.999))).name, 'test')
+        assert_equal(get_hot_region(self.x_values_to_bbox((2.1, 7))), None)
+
+    def test_query(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query(bbox_dict)]
+        assert_equal(set(package_titles),
+                     set(('(0, 9)', '(1, 8)', '(2, 7)', '(3, 6)', '(4, 5)')))
+
+    def test_query_ordered(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query_ordered(bbox_dict)]
+        assert_equal(package_titles,
+                     ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
+
+    def test_new_extent(self):
+        self.create_package(name=u'new', title=u'new',
+                            extras=[{'key': 'spatial',
+                                     'value': bbox_2_geojson(self.x_values_to_bbox((6, 6.5)))}])
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query(bbox_dict)]
+        assert 'new' in package_titles, package_titles
+
+
+class TestBboxQueryPlan(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 1), (0, 3), (0, 4), (4, 5), (6, 7)]
+
+    @classmethod
+    def setup_class(cls):
+        SpatialQueryTestBase.setup_class()
+        update_extent_histogram(4)
+
+    @classmethod
+    def teardown_class(cls):
+        SpatialQueryTestBase.teardown_class()
+        # Don't let other tests use the cached histogram
+        spatial_lib._histogram = None
+
+    def test_estimate(self):
+        estimate, total, covers_all = estimate_bbox_query(self.x_values_to_bbox((6.5, 7)))
+        assert_equal(total, 5)
+        assert estimate < total, estimate
+        assert not covers_all
+
+    def test_estimate_world(self):
+        bbox_dict = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        assert_equal(estimate_bbox_query(bbox_dict), (5, 5, True))
+
+    def test_plan(self):
+        search_params = {'q': 'test', 'fq': '', 'rows': 20}
+        bbox_dict = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'world')
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'index')
+        search_params = {'q': '', 'fq': '', 'rows': 0}
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'count')
+
+    def test_plan_default_rows(self):
+        # The default number of rows is used, so the results are needed
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        assert_equal(plan_bbox_query(bbox_dict, {'q': '', 'fq': ''}), 'index')
+
+    def test_plan_other_extras(self):
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        search_params = {'q': '', 'fq': '', 'rows': 0,
+                         'extras': {'ext_bbox': '2,0,5,1'}}
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'count')
+        # Possibly a filter applied by another plugin
+        search_params['extras']['ext_other'] = 'value'
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'index')
+
+    def test_plan_world_stale_histogram(self):
+        search_params = {'q': '', 'fq': '', 'rows': 20}
+        bbox_dict = {'minx': -2, 'miny': -1, 'maxx': 9, 'maxy': 2}
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'world')
+
+        # Added outside the bounding box after the histogram was updated
+        self.create_package(name=u'outside', title=u'outside',
+                            extras=[{'key': 'spatial',
+                                     'value': bbox_2_geojson(self.x_values_to_bbox((10, 11)))}])
+        assert_equal(plan_bbox_query(bbox_dict, search_params), 'index')
+
+
 class TestBboxQueryPerformance(SpatialQueryTestBase):
     # x values for the fixtures
     fixtures_x = [(random.uniform(0, 3), random.uniform(3,9)) \
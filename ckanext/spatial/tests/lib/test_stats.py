@@ -0,0 +1,94 @@
+from nose.tools import assert_equal
+
+from ckan.lib.base import config
+from ckanext.spatial.lib import stats
+from ckanext.spatial.lib.stats import JobStats, get_job_stats, _percentile
+from ckanext.spatial.tests.base import SpatialTestBase
+
+class TestPercentile:
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert_equal(_percentile(values, 50), 50)
+        assert_equal(_percentile(values, 95), 95)
+        assert_equal(_percentile([3], 95), 3)
+
+class FakeHarvester(object):
+
+    @stats.job_stage('import')
+    def import_stage(self, harvest_object):
+        with stats.timer('parse'):
+            pass
+        stats.count('created')
+        return True
+
+    @stats.job_stage('import')
+    def import_stage_batch(self, harvest_objects):
+        for harvest_object in harvest_objects:
+            self.import_stage(harvest_object)
+        return len(harvest_objects)
+
+class FakeJob(object):
+    id = u'test-job'
+
+class TestJobStats(SpatialTestBase):
+
+    def setup(self):
+        self.original_interval = config.get('ckan.spatial.harvest.stats_flush_interval')
+        config['ckan.spatial.harvest.stats_flush_interval'] = '3600'
+        stats.flush()
+
+    def teardown(self):
+        if self.original_interval is None:
+            del config['ckan.spatial.harvest.stats_flush_interval']
+        else:
+            config['ckan.spatial.harvest.stats_flush_interval'] = self.original_interval
+
+    def test_save(self):
+        job_stats = JobStats(u'job-1', u'import')
+        for seconds in (0.1, 0.2, 0.3, 0.4):
+            job_stats.samples.append((u'validate', seconds))
+        job_stats.count(u'created', 2)
+        job_stats.save()
+
+        job_stats = JobStats(u'job-1', u'import')
+        job_stats.count(u'created')
+        job_stats.save()
+
+        result = get_job_stats(u'job-1')
+
+        validate = result['import']['steps']['validate']
+        assert_equal(validate['count'], 4)
+        assert_equal(validate['p50'], 0.2)
+        assert_equal(validate['p95'], 0.4)
+        assert_equal(result['import']['counters'], {'created': 3})
+
+    def test_job_stage(self):
+        harvest_object = FakeJob()
+        harvest_object.job = FakeJob()
+
+        assert FakeHarvester().import_stage(harvest_object)
+        stats.flush()
+
+        result = get_job_stats(u'test-job')
+        assert_equal(sorted(result['import']['steps'].keys()), ['parse', 'total'])
+        assert_equal(result['import']['counters'], {'created': 1})
+        assert stats.current_stats() is None
+
+    def test_aggregated(self):
+        job = FakeJob()
+        job.id = u'aggregated-job'
+        harvest_object = FakeJob()
+        harvest_object.job = job
+        harvester = FakeHarvester()
+
+        # The stats of single objects are kept in memory until flushed
+        harvester.import_stage(harvest_object)
+        harvester.import_stage(harvest_object)
+        assert_equal(get_job_stats(u'aggregated-job'), {})
+
+        # Batches are saved straight away, along with what was kept
+        assert_equal(harvester.import_stage_batch([harvest_object] * 3), 3)
+        result = get_job_stats(u'aggregated-job')
+        assert_equal(result['import']['counters'], {'created': 5})
+        assert_equal(result['import']['steps']['total']['count'], 3)
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+from nose.tools import assert_equal
+from sqlalchemy import text
+
+from ckan.model import Session, meta
+from ckanext.spatial.model import WmsCheck
+from ckanext.spatial.lib import wms_check
+from ckanext.spatial.lib.wms_check import (normalize_wms_url, is_wms,
+                                           defer_check, set_recommended_wms_preview,
+                                           verify_pending_checks)
+from ckanext.spatial.tests.base import SpatialTestBase
+
+class TestNormalizeWmsUrl:
+
+    def test_normalize(self):
+        assert_equal(normalize_wms_url(' HTTP://Maps.Example.com/wms/Service?request=GetCapabilities&service=WMS'),
+                     'http://maps.example.com/wms/Service')
+
+class TestRecommendedWmsPreview:
+
+    def test_verified_preferred(self):
+        resources = [{'format': 'WMS'},
+                     {'format': None},
+                     {'format': 'WMS', 'verified': True}]
+        set_recommended_wms_preview(resources)
+
+        assert_equal([r.get('ckan_recommended_wms_preview') for r in resources],
+                     [None, None, True])
+
+    def test_unverified(self):
+        resources = [{'format': None}, {'format': 'WMS'}]
+        set_recommended_wms_preview(resources)
+
+        assert_equal([r.get('ckan_recommended_wms_preview') for r in resources],
+                     [None, True])
+
+class TestWmsCheckCache(SpatialTestBase):
+
+    def setup(self):
+        self.checked = []
+        self._check_wms = wms_check.check_wms
+        wms_check.check_wms = self.check_wms
+
+    def teardown(self):
+        wms_check.check_wms = self._check_wms
+        Session.query(WmsCheck).delete()
+        Session.commit()
+
+    def check_wms(self, url):
+        self.checked.append(url)
+        if 'down' in url:
+            raise IOError('Connection refused')
+        return 'wms' in url
+
+    def test_cached(self):
+        assert is_wms('http://example.com/wms?request=GetCapabilities')
+        assert is_wms('http://EXAMPLE.com/wms')
+        assert not is_wms('http://example.com/other')
+        assert not is_wms('http://example.com/other')
+
+        assert_equal(self.checked, ['http://example.com/wms?request=GetCapabilities',
+                                    'http://example.com/other'])
+
+    def test_negative_ttl(self):
+        assert not is_wms('http://example.com/other')
+        WmsCheck.get('http://example.com/other').checked = datetime.now() - timedelta(days=2)
+
+        assert not is_wms('http://example.com/other')
+        assert_equal(len(self.checked), 2)
+
+    def test_deferred(self):
+        assert_equal(defer_check('http://example.com/wms'), None)
+        assert_equal(self.checked, [])
+
+        pending = WmsCheck.get('http://example.com/wms')
+        assert pending
+        assert_equal(pending.is_wms, None)
+
+    def test_errors_not_cached(self):
+        assert not is_wms('http://down.example.com/wms')
+        assert_equal(WmsCheck.get('http://down.example.com/wms'), None)
+
+        assert not is_wms('http://down.example.com/wms')
+        assert_equal(len(self.checked), 2)
+
+    def test_deferred_error(self):
+        defer_check('http://down.example.com/wms')
+        defer_check('http://example.com/wms')
+
+        assert_equal(verify_pending_checks(workers=1), (2, 0))
+        # The URL that failed is still pending
+        assert_equal(WmsCheck.get('http://down.example.com/wms').is_wms, None)
+        assert_equal(WmsCheck.get('http://example.com/wms').is_wms, True)
+
+    def test_saved_concurrently(self):
+        url = 'http://example.com/wms'
+        original_get = WmsCheck.__dict__['get']
+
+        def get_then_save_concurrently(url):
+            # Another process saves a check of the URL right after it is
+            # looked up
+            WmsCheck.get = original_get
+            conn = meta.engine.connect()
+            try:
+                conn.execute(text('INSERT INTO spatial_wms_check (url) VALUES (:url)'), url=url)
+            finally:
+                conn.close()
+            return None
+
+        WmsCheck.get = staticmethod(get_then_save_concurrently)
+        try:
+            wms_check._save_check(url, True)
+        finally:
+            WmsCheck.get = original_get
+        Session.commit()
+
+        assert_equal(WmsCheck.get(url).is_wms, True)
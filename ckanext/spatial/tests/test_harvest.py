@@ -1,3 +1,5 @@
+import os
+import re
 from datetime import datetime, date
 import lxml
 
@@ -15,6 +17,8 @@ from ckanext.spatial.validation import Validators, SchematronValidator
 from ckanext.spatial.harvesters import (GeminiCswHarvester, GeminiDocHarvester,
                                         GeminiWafHarvester, SpatialHarvester)
 from ckanext.spatial.model.package_extent import setup as spatial_db_setup
+from ckanext.spatial.model import HarvestUrlState, HarvestSourceState, HarvestRemovedRecord, \
+                                   GeminiDocument
 from ckanext.spatial.tests.base import SpatialTestBase
 
 from xml_file_server import serve
@@ -802,6 +806,401 @@ class TestHarvest(HarvestFixtureBase):
         source_dict = get_action('harvest_source_show')(self.context,{'id':source.id})
         assert len(source_dict['status']['packages']) == 1
 
+    def test_harvest_batch(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/gemini2.1-waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+
+        # Add an object that fails to import
+        bad_obj = HarvestObject(guid=u'bad', job=job, content=u'<gmd:MD_Metadata')
+        bad_obj.save()
+        objects.insert(1, bad_obj)
+
+        assert_equal(harvester.import_stage_batch(objects), 2)
+
+        pkgs = Session.query(Package).all()
+        assert_equal(len(pkgs), 2)
+
+        for obj in objects:
+            Session.refresh(obj)
+        assert objects[0].current == True
+        assert objects[2].current == True
+        assert objects[0].package_id in [pkg.id for pkg in pkgs]
+        assert not bad_obj.current
+        assert len(bad_obj.errors) == 1
+
+    def test_harvest_not_modified(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/gemini2.1-waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(first_job)
+        for object_id in object_ids:
+            harvester.import_stage(HarvestObject.get(object_id))
+
+        # The validators of each document response were stored
+        url_states = Session.query(HarvestUrlState) \
+                     .filter(HarvestUrlState.source_id==source.id).all()
+        assert_equal(len(url_states), 2)
+        for url_state in url_states:
+            assert url_state.last_modified
+            assert url_state.harvest_object_id in object_ids
+
+        first_job.status = u'Finished'
+        first_job.save()
+
+        # The test server does not support conditional requests, so
+        # simulate that the documents were not modified
+        # (the harvester is a singleton, so the method is restored after)
+        harvester._get_content_conditional = \
+                lambda url, validators=None: (None,) + validators
+        try:
+            second_job = self._create_job(source.id)
+            object_ids = harvester.gather_stage(second_job)
+        finally:
+            del harvester._get_content_conditional
+
+        # Packages were already imported from the documents, so there is
+        # nothing to harvest
+        assert_equal(object_ids, [])
+        assert_equal(len(second_job.gather_errors), 0)
+
+    def test_harvest_unchanged_in_listing(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/gemini2.1-waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        # The test index is not an Apache-style listing, so simulate one
+        # with the modification date and size of each document
+        harvester = GeminiWafHarvester()
+        base_url = u'http://127.0.0.1:8999/gemini2.1-waf/'
+        harvester._extract_entries = lambda content, url: [
+            (base_url + u'wales1.xml', '2012-05-01 10:00', '1.2K'),
+            (base_url + u'wales2.xml', '2012-05-02 11:30', '4.0K')]
+        requested = []
+        def get_content_conditional(url, validators=None):
+            requested.append(url)
+            return GeminiWafHarvester._get_content_conditional(harvester, url, validators)
+        harvester._get_content_conditional = get_content_conditional
+        try:
+            object_ids = harvester.gather_stage(first_job)
+            for object_id in object_ids:
+                harvester.import_stage(HarvestObject.get(object_id))
+            assert_equal(len(requested), 2)
+
+            first_job.status = u'Finished'
+            first_job.save()
+
+            second_job = self._create_job(source.id)
+            object_ids = harvester.gather_stage(second_job)
+        finally:
+            # (the harvester is a singleton)
+            del harvester._extract_entries
+            del harvester._get_content_conditional
+
+        # The documents were not requested again, nor reported as deleted
+        assert_equal(object_ids, [])
+        assert_equal(len(requested), 2)
+        assert_equal(len(second_job.gather_errors), 0)
+        url_states = Session.query(HarvestUrlState) \
+                     .filter(HarvestUrlState.source_id==source.id).all()
+        assert_equal(len(url_states), 2)
+        for url_state in url_states:
+            assert url_state.listing_modified
+
+
+    def test_harvest_unchanged_document_skipped(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset1.xml',
+            'type': u'gemini-single'
+        }
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        with open(os.path.join(os.path.dirname(__file__), 'xml', 'gemini2.1',
+                               'dataset1.xml')) as f:
+            content = f.read()
+        guid = GeminiDocument(content).read_value('guid')
+        content = content.decode('utf8')
+
+        harvester = GeminiDocHarvester()
+        first_obj = HarvestObject(guid=guid, job=first_job, content=content)
+        first_obj.save()
+        harvester.import_stage(first_obj)
+        first_job.status = u'Finished'
+        first_job.save()
+
+        Session.refresh(first_obj)
+        assert first_obj.current
+        package = Package.get(first_obj.package_id)
+        metadata_modified = package.metadata_modified
+        revision_id = package.revision_id
+
+        # Only the formatting changed, which would make the import fail if
+        # the document was not skipped (its metadata date is the same)
+        second_job = self._create_job(source.id)
+        second_obj = HarvestObject(guid=guid, job=second_job,
+                                   content=re.sub(r'>\s+<', '><', content))
+        second_obj.save()
+        harvester.import_stage(second_obj)
+
+        Session.refresh(first_obj)
+        Session.refresh(second_obj)
+        assert_equal(len(second_obj.errors), 0)
+        assert first_obj.current
+        assert not second_obj.current
+        assert_equal(second_obj.package_id, None)
+        package = Package.get(first_obj.package_id)
+        assert_equal(package.metadata_modified, metadata_modified)
+        assert_equal(package.revision_id, revision_id)
+
+    def test_harvest_csw_incremental(self):
+
+        class FakeCswService(object):
+            def __init__(self):
+                self.records = []
+                self.constraints = []
+            def getrecords_xml(self, page=None, timeout=None, max_size=None,
+                               constraint=None, esn='full'):
+                self.constraints.append(constraint)
+                return iter(self.records)
+
+        def modified_since(constraint):
+            return constraint.xpath('string(//*[local-name()="Literal"])')
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/csw',
+            'type': u'csw'
+        }
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        with open(os.path.join(os.path.dirname(__file__), 'xml', 'gemini2.1',
+                               'dataset1.xml')) as f:
+            content = f.read()
+        guid = GeminiDocument(content).read_value('guid')
+        content = content.decode('utf8')
+
+        harvester = GeminiCswHarvester()
+        csw = FakeCswService()
+        harvester._setup_csw_client = lambda url: csw
+        options = ('ckan.spatial.harvest.csw_incremental',
+                   'ckan.spatial.harvest.csw_full_records')
+        original_options = [config.get(option) for option in options]
+        for option in options:
+            config[option] = 'true'
+
+        def run_job(job):
+            object_ids = harvester.gather_stage(job)
+            for object_id in object_ids:
+                harvester.import_stage(HarvestObject.get(object_id))
+            job.status = u'Finished'
+            job.save()
+            return HarvestSourceState.get(source.id)
+
+        try:
+            # All the records are listed the first time
+            csw.records = [(guid, content)]
+            source_state = run_job(first_job)
+            assert_equal(csw.constraints[-1], None)
+            first_gathered = source_state.last_gathered
+            assert first_gathered
+            assert_equal(source_state.pending_job_id, None)
+
+            # The import fails, so the records modified since the first
+            # harvest are listed again the next time
+            csw.records = [(guid, u'<gmd:MD_Metadata>')]
+            source_state = run_job(self._create_job(source.id))
+            assert_equal(modified_since(csw.constraints[-1]),
+                         first_gathered.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            assert_equal(source_state.last_gathered, first_gathered)
+
+            csw.records = []
+            source_state = run_job(self._create_job(source.id))
+            assert_equal(modified_since(csw.constraints[-1]),
+                         first_gathered.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            # Nothing to import, so the next listing starts from this one
+            assert source_state.last_gathered > first_gathered
+        finally:
+            for option, value in zip(options, original_options):
+                if value is None:
+                    del config[option]
+                else:
+                    config[option] = value
+            # (the harvester is a singleton)
+            del harvester._setup_csw_client
+
+    def test_harvest_csw_removed_record(self):
+
+        class FakeCswService(object):
+            records = []
+            def getrecords_xml(self, page=None, timeout=None, max_size=None,
+                               constraint=None, esn='full'):
+                return iter(self.records)
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/csw',
+            'type': u'csw'
+        }
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        records = []
+        for name in ('dataset1.xml', 'service1.xml'):
+            with open(os.path.join(os.path.dirname(__file__), 'xml', 'gemini2.1',
+                                   name)) as f:
+                content = f.read()
+            records.append((GeminiDocument(content).read_value('guid'),
+                            content.decode('utf8')))
+
+        harvester = GeminiCswHarvester()
+        csw = FakeCswService()
+        harvester._setup_csw_client = lambda url: csw
+        options = {'ckan.spatial.harvest.csw_incremental': 'true',
+                   'ckan.spatial.harvest.csw_full_records': 'true',
+                   # All the records are listed every time
+                   'ckan.spatial.harvest.csw_full_gather_interval': '0',
+                   'ckan.spatial.harvest.wms_check': 'off'}
+        original_options = dict((option, config.get(option)) for option in options)
+        config.update(options)
+
+        def run_job(job):
+            object_ids = harvester.gather_stage(job)
+            for object_id in object_ids:
+                harvester.import_stage(HarvestObject.get(object_id))
+            job.status = u'Finished'
+            job.save()
+            return HarvestSourceState.get(source.id)
+
+        def removed_records():
+            return Session.query(HarvestRemovedRecord) \
+                   .filter(HarvestRemovedRecord.source_id==source.id).all()
+
+        try:
+            csw.records = records
+            first_gathered = run_job(first_job).last_gathered
+            assert_equal(removed_records(), [])
+
+            # The service record is removed from the server
+            csw.records = records[:1]
+            job = self._create_job(source.id)
+            source_state = run_job(job)
+            removed = removed_records()
+            assert_equal(len(removed), 1)
+            assert_equal(HarvestObject.get(removed[0].harvest_object_id).guid, records[1][0])
+            # It is not a gather error, so the next listing starts from here
+            assert_equal(len(job.gather_errors), 0)
+            assert source_state.last_gathered > first_gathered
+
+            # It is only reported once
+            run_job(self._create_job(source.id))
+            assert_equal([record.job_id for record in removed_records()], [job.id])
+
+            # Until it is listed again
+            csw.records = records
+            run_job(self._create_job(source.id))
+            assert_equal(removed_records(), [])
+        finally:
+            for option, value in original_options.iteritems():
+                if value is None:
+                    del config[option]
+                else:
+                    config[option] = value
+            # (the harvester is a singleton)
+            del harvester._setup_csw_client
+
+
+class TestValidationCache(SpatialTestBase):
+
+    class CountingValidators(Validators):
+        calls = 0
+        def is_valid(self, xml):
+            TestValidationCache.CountingValidators.calls += 1
+            return False, ['Invalid', xml.tag]
+
+    def setup(self):
+        self.harvester = SpatialHarvester()
+        self.harvester._validator = self.CountingValidators(profiles=['gemini2'])
+        self.CountingValidators.calls = 0
+
+    def test_validated_once(self):
+        from lxml import etree
+        from ckanext.spatial import harvesters
+        content = '<doc><a>1</a></doc>'
+
+        for i in range(2):
+            assert_equal(self.harvester._validate(etree.fromstring(content), content),
+                         (False, ['Invalid', 'doc']))
+        assert_equal(self.CountingValidators.calls, 1)
+
+        # The stored result is used by other processes
+        harvesters._validation_results.clear()
+        assert_equal(self.harvester._validate(etree.fromstring(content), unicode(content)),
+                     (False, [u'Invalid', u'doc']))
+        assert_equal(self.CountingValidators.calls, 1)
+
+
+class TestContentDigest:
+
+    def _digest(self, content):
+        from lxml import etree
+        return GeminiDocHarvester()._content_digest(etree.fromstring(content))
+
+    def test_formatting_ignored(self):
+        assert_equal(self._digest('<a xmlns="urn:x"><b  c="1" d="2">text</b></a>'),
+                     self._digest('''<a xmlns="urn:x">
+                                        <b d="2" c="1">text</b>
+                                     </a>'''))
+
+    def test_changes_detected(self):
+        assert self._digest('<a><b>text</b></a>') != self._digest('<a><b>other</b></a>')
+
+
+class TestWafListing:
+
+    def test_extract_entries_apache_table(self):
+        content = '''<html><body><table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>
+<tr><td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+<tr><td><a href="wales1.xml">wales1.xml</a></td><td align="right">2012-05-01 10:00  </td><td align="right">1.2K</td></tr>
+<tr><td><a href="wales2.xml">wales2.xml</a></td><td align="right">2012-05-02 11:30  </td><td align="right">4.0K</td></tr>
+</table></body></html>'''
+        entries = GeminiWafHarvester()._extract_entries(content, 'http://example.com/waf/')
+        assert_equal(entries, [
+            ('http://example.com/waf/wales1.xml', '2012-05-01 10:00', '1.2K'),
+            ('http://example.com/waf/wales2.xml', '2012-05-02 11:30', '4.0K')])
+
+    def test_extract_entries_apache_pre(self):
+        content = '''<html><body><pre><a href="?C=N;O=D">Name</a>  <a href="?C=M;O=A">Last modified</a>
+<a href="wales1.xml">wales1.xml</a>     01-May-2012 10:00  1234
+<a href="wales2.xml">wales2.xml</a>
+</pre></body></html>'''
+        entries = GeminiWafHarvester()._extract_entries(content, 'http://example.com/waf/index.html')
+        assert_equal(entries, [
+            ('http://example.com/waf/wales1.xml', '01-May-2012 10:00', '1234'),
+            ('http://example.com/waf/wales2.xml', None, None)])
+
 
 class TestValidation(HarvestFixtureBase):
 
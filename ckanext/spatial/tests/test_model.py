@@ -1,14 +1,13 @@
 import logging
 from pprint import pprint
 
-from geoalchemy import WKTSpatialElement
-
 from shapely.geometry import asShape
 from ckan.model import Session, Package
 from ckan import model
 from ckan.lib.helpers import json
 from ckan.tests import CreateTestData
-from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model import PackageExtent, PackageExtentGeometry
+from ckanext.spatial.model.package_extent import get_geometry_id, intern_geometry
 
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -23,6 +22,14 @@ class TestPackageExtent(SpatialTestBase):
     def teardown(self):
         model.repo.rebuild_db()
 
+    def _intern_geometry(self, shape):
+        geometry_id = get_geometry_id(shape.wkt, self.db_srid)
+        intern_geometry(geometry_id, shape.wkt, self.db_srid)
+        return geometry_id
+
+    def _get_geometry(self, package_extent):
+        return Session.query(PackageExtentGeometry).get(package_extent.geometry_id)
+
     def test_create_extent(self):
         package = Package.get('annakarenina')
         assert package
@@ -30,13 +37,14 @@ class TestPackageExtent(SpatialTestBase):
         geojson = json.loads(self.geojson_examples['point'])
 
         shape = asShape(geojson)
-        package_extent = PackageExtent(package_id=package.id,the_geom=WKTSpatialElement(shape.wkt, self.db_srid))
+        package_extent = PackageExtent(package_id=package.id,geometry_id=self._intern_geometry(shape))
         package_extent.save()
 
         assert package_extent.package_id == package.id
-        assert Session.scalar(package_extent.the_geom.x) == geojson['coordinates'][0]
-        assert Session.scalar(package_extent.the_geom.y) == geojson['coordinates'][1]
-        assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+        geometry = self._get_geometry(package_extent)
+        assert Session.scalar(geometry.the_geom.x) == geojson['coordinates'][0]
+        assert Session.scalar(geometry.the_geom.y) == geojson['coordinates'][1]
+        assert Session.scalar(geometry.the_geom.srid) == self.db_srid
 
     def test_update_extent(self):
 
@@ -45,17 +53,18 @@ class TestPackageExtent(SpatialTestBase):
         geojson = json.loads(self.geojson_examples['point'])
 
         shape = asShape(geojson)
-        package_extent = PackageExtent(package_id=package.id,the_geom=WKTSpatialElement(shape.wkt, self.db_srid))
+        package_extent = PackageExtent(package_id=package.id,geometry_id=self._intern_geometry(shape))
         package_extent.save()
-        assert Session.scalar(package_extent.the_geom.geometry_type) == 'ST_Point'
+        assert Session.scalar(self._get_geometry(package_extent).the_geom.geometry_type) == 'ST_Point'
 
         # Update the geometry (Point -> Polygon)
         geojson = json.loads(self.geojson_examples['polygon'])
 
         shape = asShape(geojson)
-        package_extent.the_geom=WKTSpatialElement(shape.wkt, self.db_srid)
+        package_extent.geometry_id=self._intern_geometry(shape)
         package_extent.save()
 
         assert package_extent.package_id == package.id
-        assert Session.scalar(package_extent.the_geom.geometry_type) == 'ST_Polygon'
-        assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+        geometry = self._get_geometry(package_extent)
+        assert Session.scalar(geometry.the_geom.geometry_type) == 'ST_Polygon'
+        assert Session.scalar(geometry.the_geom.srid) == self.db_srid